@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Task metrics and CPU throughput of float32 vs bfloat16 mixed precision (`LightningModel(precision="bf16")`) on the
+real supervised tasks: `ContactECNN` on `UmichContactDataset` and `EMLP` on `COMMomentum`. Datasets and models are
+built from the `cfg/supervised` configuration as in `train_supervised.py`. For every precision the same initialization
+is trained for `--steps` optimizer steps on the training set and evaluated on the test set, reporting the contact
+state/legs accuracy and F1 score, or the linear/angular CoM momentum errors, next to the train and inference
+throughput measured on a batch of training samples.
+
+Usage: python benchmarks/bf16_precision.py [--tasks contact com_momentum] [--robot bolt] [--steps 500]
+                                           [--iters 30] [--test_batches 1.0]
+"""
+import argparse
+import copy
+import os
+import pathlib
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+from hydra import compose, initialize_config_dir
+from pytorch_lightning import Trainer, seed_everything
+from torch.utils.data import ConcatDataset
+
+from nn.LightningModel import LightningModel, PRECISIONS
+from train_supervised import get_datasets, get_model
+
+# Dataset config: (model config, reported test metrics)
+TASKS = {
+    "contact": ("contact_ecnn", ["test_contact_state/acc", "test_contact_state/f1", "test_legs_avg/acc",
+                                 "test_legs_avg/f1"]),
+    "com_momentum": ("emlp", ["test_lin_err", "test_ang_err", "test_lin_cos_sim", "test_ang_cos_sim"]),
+}
+
+
+def throughput(fn, iters, batch_size):
+    for _ in range(3):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return iters * batch_size / (time.perf_counter() - start)
+
+
+def load_task(task, args):
+    root_path = pathlib.Path(root_dir)
+    with initialize_config_dir(config_dir=str(root_path.joinpath("cfg/supervised"))):
+        cfg = compose(config_name="config", overrides=[f"dataset={task}", f"model={TASKS[task][0]}",
+                                                       f"robot_name={args.robot}", "num_workers=0"])
+    datasets, dataloaders = get_datasets(cfg, torch.device("cpu"), root_path)
+    train_dataset = datasets[0]
+    first_dataset = train_dataset.datasets[0].dataset if isinstance(train_dataset, ConcatDataset) else train_dataset
+    return cfg, first_dataset, dataloaders
+
+
+def benchmark_task(task, args):
+    cfg, dataset, (train_dataloader, _, test_dataloader) = load_task(task, args)
+    seed_everything(seed=0)
+    model = get_model(cfg.model, Gin=dataset.Gin, Gout=dataset.Gout)
+    x, y = next(iter(train_dataloader))
+
+    results = {}
+    for precision in PRECISIONS:
+        pl_model = LightningModel(lr=cfg.model.lr, loss_fn=dataset.loss_fn,
+                                  metrics_fn=lambda y_pred, y_gt: dataset.compute_metrics(y_pred, y_gt),
+                                  test_epoch_metrics_fn=(lambda out: dataset.test_metrics(*out)) if hasattr(
+                                      dataset, 'test_metrics') else None,
+                                  precision=precision)
+        pl_model.set_model(copy.deepcopy(model))
+
+        # Throughput on a copy, so both precisions are trained from the same initialization.
+        timed_model = copy.deepcopy(pl_model)
+        optimizer = timed_model.configure_optimizers()
+
+        def train_step():
+            optimizer.zero_grad()
+            timed_model._loss_fn(timed_model.predict(x), y).backward()
+            optimizer.step()
+
+        def inference_step():
+            with torch.no_grad():
+                timed_model.predict(x)
+
+        train = throughput(train_step, args.iters, x.shape[0])
+        timed_model.eval()
+        inference = throughput(inference_step, args.iters, x.shape[0])
+
+        seed_everything(seed=0)
+        trainer = Trainer(accelerator="cpu", max_steps=args.steps, limit_val_batches=0,
+                          limit_test_batches=args.test_batches, logger=False, enable_checkpointing=False,
+                          enable_progress_bar=False, enable_model_summary=False)
+        trainer.fit(pl_model, train_dataloaders=train_dataloader)
+        test_metrics = trainer.test(model=pl_model, dataloaders=test_dataloader, verbose=False)[0]
+        results[precision] = (train, inference, test_metrics)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", nargs="+", default=list(TASKS), choices=list(TASKS))
+    parser.add_argument("--robot", type=str, default="bolt", help="Robot of the CoM momentum dataset")
+    parser.add_argument("--steps", type=int, default=500, help="Optimizer steps of the training of each precision")
+    parser.add_argument("--iters", type=int, default=30, help="Timed iterations of the throughput measurements")
+    parser.add_argument("--test_batches", type=float, default=1.0,
+                        help="Fraction (<=1.0) or number (>1) of test batches to evaluate")
+    args = parser.parse_args()
+    args.test_batches = int(args.test_batches) if args.test_batches > 1 else args.test_batches
+
+    rows = []
+    for task in args.tasks:
+        for precision, (train, inference, test_metrics) in benchmark_task(task, args).items():
+            metrics = " | ".join(f"{k[len('test_'):]}={test_metrics[k]:.4f}" for k in TASKS[task][1])
+            rows.append(f"{task:>12} | {precision:>9} | {train:17.1f} | {inference:21.1f} | "
+                        f"{test_metrics['test_loss']:9.4f} | {metrics}")
+
+    print(f"{'task':>12} | {'precision':>9} | {'train [samples/s]':>17} | {'inference [samples/s]':>21} | "
+          f"{'test loss':>9} | test metrics")
+    print("\n".join(rows))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of eager vs `torch.compile` CPU throughput of `EMLP` and `ContactECNN`, for training (forward, backward and
+optimizer step) and inference. Compiled models fuse the weight assembly (orbit gather) with the linear/conv and ReLU
+that consume it. Use `--fullgraph` to fail on any graph break.
+
+Usage: python benchmarks/compile_throughput.py [--batch_size 64] [--iters 50] [--fullgraph]
+"""
+import argparse
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+
+from datasets.umich_contact_dataset import UmichContactDataset
+from groups.SemiDirectProduct import SparseRep
+from groups.SymmetricGroups import C2
+from nn.ContactECNN import ContactECNN
+from nn.EquivariantModules import EMLP
+
+
+def throughput(fn, iters, batch_size):
+    for _ in range(3):  # Warm up, and compilation of the graphs.
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return iters * batch_size / (time.perf_counter() - start)
+
+
+def benchmark_model(model: torch.nn.Module, x: torch.Tensor, iters: int, fullgraph: bool):
+    y_target = torch.randn_like(model(x)).detach()
+    compiled = torch.compile(model, fullgraph=fullgraph)
+    results = {}
+    for name, fn in {"eager": model, "compiled": compiled}.items():
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+        def train_step():
+            optimizer.zero_grad()
+            torch.nn.functional.mse_loss(fn(x), y_target).backward()
+            optimizer.step()
+
+        def inference_step():
+            with torch.no_grad():
+                fn(x)
+
+        model.train()
+        train = throughput(train_step, iters, x.shape[0])
+        model.eval()
+        inference = throughput(inference_step, iters, x.shape[0])
+        results[name] = (train, inference)
+    with torch.no_grad():
+        error = torch.max(torch.abs(model(x) - compiled(x))).item()
+    return results, error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--fullgraph", action="store_true", help="Raise an error on graph breaks")
+    args = parser.parse_args()
+
+    Gin, Gout = UmichContactDataset.get_in_out_groups()
+    G_emlp_in, G_emlp_out = C2.canonical_group(48, inv_dims=6), C2.canonical_group(12, inv_dims=2)
+    models = {
+        "EMLP": (EMLP(SparseRep(G_emlp_in), SparseRep(G_emlp_out), hidden_group=G_emlp_out, ch=128, num_layers=3),
+                 torch.randn(args.batch_size, G_emlp_in.d)),
+        "ContactECNN": (ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin),
+                        torch.randn(args.batch_size, 150, Gin.d)),
+    }
+
+    print(f"{'model':>12} | {'mode':>8} | {'train [samples/s]':>17} | {'inference [samples/s]':>21}")
+    for model_name, (model, x) in models.items():
+        results, error = benchmark_model(model, x, args.iters, args.fullgraph)
+        for mode, (train, inference) in results.items():
+            print(f"{model_name:>12} | {mode:>8} | {train:17.1f} | {inference:21.1f}")
+        print(f"{model_name:>12} | max|y_eager - y_compiled| = {error:.2e}")
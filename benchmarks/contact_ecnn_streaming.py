@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the per-sample latency of `ContactECNN` over a sliding window: full window forward vs streaming
+inference (`ContactECNN.streaming()`), which only computes the new time columns of the convolutional blocks.
+
+Usage: python benchmarks/contact_ecnn_streaming.py [--ticks 500]
+"""
+import argparse
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+
+from datasets.umich_contact_dataset import UmichContactDataset
+from groups.SemiDirectProduct import SparseRep
+from nn.ContactECNN import ContactECNN
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ticks", type=int, default=500)
+    args = parser.parse_args()
+
+    Gin, Gout = UmichContactDataset.get_in_out_groups()
+    model = ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin).eval()
+    W = model.window_size
+    seq = torch.randn(1, W + args.ticks, Gin.d)
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        y_batch = [model(seq[:, t - W + 1:t + 1]) for t in range(W, seq.shape[1])]
+        t_batch = (time.perf_counter() - start) / args.ticks * 1e3
+
+        stream = model.streaming()
+        stream.reset(seq[:, :W])
+        start = time.perf_counter()
+        y_stream = [stream.step(seq[:, t]) for t in range(W, seq.shape[1])]
+        t_stream = (time.perf_counter() - start) / args.ticks * 1e3
+
+    error = max(torch.max(torch.abs(a - b)).item() for a, b in zip(y_batch, y_stream))
+    print(f"window forward: {t_batch:.3f} ms/sample | streaming: {t_stream:.3f} ms/sample | "
+          f"speedup x{t_batch / t_stream:.1f} | max|y_batch - y_stream| = {error:.2e}")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the kernel assembly of `BasisConv1d`: dense `basis @ basis_coeff` matmul vs orbit index gather, on the
+64/128 channel convolutional blocks of `ContactECNN`.
+
+Usage: python benchmarks/econv1d_kernel_assembly.py [--iters 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+
+from groups.SemiDirectProduct import SparseRep
+from groups.SymmetricGroups import C2
+from nn.EConv1d import BasisConv1d
+from utils.utils import coo2torch_coo
+
+
+def timeit(fn, iters):
+    fn()  # Warm up
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def benchmark_layer(conv: BasisConv1d, iters: int):
+    # Dense basis as it was used before orbit indices were introduced.
+    basis = coo2torch_coo(conv.repW.equivariant_basis())
+    if basis.is_sparse:
+        basis = basis.to_dense()
+    shape = (conv.rep_out.G.d, conv.rep_in.G.d, conv.kernel_size_)
+    assert torch.allclose(torch.matmul(basis, conv.basis_coeff).reshape(shape), conv.weight)
+
+    def dense_fwd_bwd():
+        torch.matmul(basis, conv.basis_coeff).reshape(shape).sum().backward()
+
+    def orbit_fwd_bwd():
+        conv.weight.sum().backward()
+
+    with torch.no_grad():
+        t_dense = timeit(lambda: torch.matmul(basis, conv.basis_coeff).reshape(shape), iters)
+        t_orbit = timeit(lambda: conv.weight, iters)
+    t_dense_bwd = timeit(dense_fwd_bwd, iters)
+    t_orbit_bwd = timeit(orbit_fwd_bwd, iters)
+
+    mem_dense = basis.numel() * basis.element_size()
+    mem_orbit = sum(b.numel() * b.element_size() for b in (conv.basis_orbit_idx, conv.basis_orbit_sign))
+    return t_dense, t_orbit, t_dense_bwd, t_orbit_bwd, mem_dense, mem_orbit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iters", type=int, default=200)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(True)
+    rep_64_1, rep_64_2 = SparseRep(C2.canonical_group(64, inv_dims=8)), SparseRep(C2.canonical_group(64, inv_dims=12))
+    rep_128_1, rep_128_2 = SparseRep(C2.canonical_group(128, inv_dims=24)), SparseRep(C2.canonical_group(128, inv_dims=32))
+    layers = {"64->64": BasisConv1d(rep_64_1, rep_64_2, kernel_size=3, padding=1),
+              "64->128": BasisConv1d(rep_64_2, rep_128_1, kernel_size=3, padding=1),
+              "128->128": BasisConv1d(rep_128_1, rep_128_2, kernel_size=3, padding=1)}
+
+    print(f"{'layer':>10} | {'dense [ms]':>10} | {'orbit [ms]':>10} | {'dense f+b [ms]':>14} | "
+          f"{'orbit f+b [ms]':>14} | {'dense basis [MB]':>16} | {'orbit basis [MB]':>16}")
+    for name, conv in layers.items():
+        t_dense, t_orbit, t_dense_bwd, t_orbit_bwd, mem_dense, mem_orbit = benchmark_layer(conv, args.iters)
+        print(f"{name:>10} | {t_dense:10.3f} | {t_orbit:10.3f} | {t_dense_bwd:14.3f} | {t_orbit_bwd:14.3f} | "
+              f"{mem_dense / 1e6:16.2f} | {mem_orbit / 1e6:16.2f}")
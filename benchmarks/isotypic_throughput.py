@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the standard vs isotypic (`set_isotypic_mode`) execution modes of `EMLP` and `ContactECNN`, reporting the
+CPU step time of training (forward, backward and optimizer step) and inference. Both modes share the same parameters;
+the isotypic mode applies the block diagonal spectral weights block by block, at the cost of the changes of basis of
+the inputs and outputs of every layer. `ContactECNN` is only benchmarked when the `deep_contact_estimator` submodule,
+required by the groups of the contact dataset, is available.
+
+Usage: python benchmarks/isotypic_throughput.py [--batch_size 64] [--iters 50] [--ch 128]
+"""
+import argparse
+import copy
+import importlib.util
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+
+from groups.SemiDirectProduct import SparseRep
+from groups.SymmetricGroups import C2
+from nn.ContactECNN import ContactECNN
+from nn.EquivariantModules import EMLP
+
+
+def step_time(fn, iters):
+    for _ in range(3):  # Warm up, and caching of the (spectral) weights.
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def benchmark_model(model: torch.nn.Module, x: torch.Tensor, iters: int):
+    y_target = torch.randn_like(model(x)).detach()
+    isotypic = copy.deepcopy(model)
+    isotypic.set_isotypic_mode(True)
+    results = {}
+    for name, mode_model in {"standard": model, "isotypic": isotypic}.items():
+        # Train a copy, so both modes are timed (and compared) with the same parameters.
+        trained = copy.deepcopy(mode_model)
+        optimizer = torch.optim.Adam(trained.parameters(), lr=1e-4)
+
+        def train_step():
+            optimizer.zero_grad()
+            torch.nn.functional.mse_loss(trained(x), y_target).backward()
+            optimizer.step()
+
+        def inference_step():
+            with torch.no_grad():
+                mode_model(x)
+
+        trained.train()
+        train = step_time(train_step, iters)
+        mode_model.eval()
+        inference = step_time(inference_step, iters)
+        results[name] = (train, inference)
+    with torch.no_grad():
+        error = torch.max(torch.abs(model(x) - isotypic(x))).item()
+    return results, error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--ch", type=int, default=128, help="Hidden channels of the EMLP")
+    args = parser.parse_args()
+
+    G_emlp_in, G_emlp_out = C2.canonical_group(48, inv_dims=6), C2.canonical_group(12, inv_dims=2)
+    models = {
+        "EMLP": (EMLP(SparseRep(G_emlp_in), SparseRep(G_emlp_out), hidden_group=G_emlp_out, ch=args.ch,
+                      num_layers=3), torch.randn(args.batch_size, G_emlp_in.d)),
+    }
+    # The groups of the contact dataset require the `deep_contact_estimator` submodule.
+    if importlib.util.find_spec("deep_contact_estimator") is not None:
+        from datasets.umich_contact_dataset import UmichContactDataset
+        Gin, Gout = UmichContactDataset.get_in_out_groups()
+        models["ContactECNN"] = (ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin, dropout=0.0),
+                                 torch.randn(args.batch_size, 150, Gin.d))
+    else:
+        print("deep_contact_estimator submodule not found, skipping ContactECNN")
+
+    print(f"{'model':>12} | {'mode':>8} | {'train step [ms]':>15} | {'inference step [ms]':>19}")
+    for model_name, (model, x) in models.items():
+        results, error = benchmark_model(model, x, args.iters)
+        for mode, (train, inference) in results.items():
+            print(f"{model_name:>12} | {mode:>8} | {train:15.2f} | {inference:19.2f}")
+        print(f"{model_name:>12} | max|y_standard - y_isotypic| = {error:.2e}")
@@ -242,6 +242,26 @@ class UmichContactDataset(contact_dataset):
         model.log_metrics(metrics, prefix=prefix)
         model.train()
 
+    @torch.no_grad()
+    def predict_trajectory(self, model, batch_size=1024):
+        """
+        Predictions of `model` for every stride-1 window of the (whole) trajectory of the dataset. Models providing
+        `forward_trajectory` (e.g. `ContactECNN`) share the convolutional work across overlapping windows, other
+        models are evaluated on batches of windows.
+        :return: y_pred (num_data, 16) model outputs and y_gt (num_data,) labels of the last sample of each window.
+        """
+        training = model.training
+        model.eval()
+        data = self.data.to(next(model.parameters()).device)
+        if hasattr(model, 'forward_trajectory'):
+            y_pred = model.forward_trajectory(data, batch_size=batch_size)
+        else:
+            windows = data.unfold(0, self.window_size, 1).permute(0, 2, 1)   # (num_data, window_size, features)
+            y_pred = torch.cat([model(windows[i:i + batch_size]) for i in range(0, self.num_data, batch_size)], dim=0)
+        model.train(training)
+        y_gt = self.label[self.window_size - 1:].to(y_pred.device)
+        return y_pred, y_gt
+
     def decimal2binary(self, x):
         mask = 2 ** torch.arange(4 - 1, -1, -1).to(self.device, x.dtype)
         return x.unsqueeze(-1).bitwise_and(mask).ne(0).byte()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export a trained `EMLP`/`ContactECNN` to TorchScript and ONNX graphs for onboard inference.
+
+Usage:
+    python export_model.py --run_dir <hydra run dir> --ckpt <run_dir>/seed=<s>/version_<s>/best.ckpt --out_dir exported
+"""
+import argparse
+import json
+import logging
+import pathlib
+
+import torch
+from omegaconf import OmegaConf
+
+from datasets.umich_contact_dataset import UmichContactDataset
+from train_supervised import get_model
+from utils.model_export import export_model, EXPORT_FORMATS
+from utils.robot_utils import get_robot_params
+
+log = logging.getLogger(__name__)
+
+
+def load_model(run_dir: pathlib.Path, ckpt_path: pathlib.Path):
+    cfg = OmegaConf.load(run_dir / ".hydra" / "config.yaml")
+    if cfg.dataset.name == "contact":
+        Gin, Gout = UmichContactDataset.get_in_out_groups()
+    else:
+        _, _, _, Gin, Gout = get_robot_params(cfg.robot_name)
+    model = get_model(cfg.model, Gin=Gin, Gout=Gout)
+
+    # Lightning checkpoints pickle the hyperparameters, which the `weights_only` loading of torch>=2.6 rejects.
+    state_dict = torch.load(ckpt_path, map_location="cpu", weights_only=False)["state_dict"]
+    # Lightning stores the model parameters under the `model.` prefix.
+    state_dict = {k[len("model."):]: v for k, v in state_dict.items() if k.startswith("model.")}
+    model.load_state_dict(state_dict)
+    return model
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--run_dir", type=pathlib.Path, required=True, help="Hydra run directory of the experiment")
+    parser.add_argument("--ckpt", type=pathlib.Path, required=True, help="Lightning checkpoint of the model")
+    parser.add_argument("--out_dir", type=pathlib.Path, default=pathlib.Path("exported"))
+    parser.add_argument("--formats", nargs="+", default=list(EXPORT_FORMATS), choices=EXPORT_FORMATS)
+    parser.add_argument("--batch_size", type=int, default=1)
+    args = parser.parse_args()
+
+    model = load_model(args.run_dir, args.ckpt)
+    report = export_model(model, out_dir=args.out_dir, formats=args.formats, batch_size=args.batch_size)
+    with open(args.out_dir / "export_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
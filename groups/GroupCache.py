@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded memoization of group construction (`canonical_group`) and element enumeration (`signed_actions`,
+`discrete_actions`) of `Sym` groups, which are rebuilt with the same arguments for every layer of every model.
+Hit/miss counters of all caches are reported by `group_cache_info` for profiling.
+"""
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+
+class GroupCache:
+    """ Least recently used cache of at most `maxsize` entries, counting hits and misses. """
+
+    def __init__(self, name: str, maxsize: int):
+        self.name, self.maxsize = name, maxsize
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, key: Hashable, build: Callable):
+        """ Returns the entry of `key`, building and storing it with `build()` if missing. """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = build()
+        if self.maxsize > 0:
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.hits, self.misses = 0, 0
+
+    def info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}
+
+    def __repr__(self):
+        return f"GroupCache[{self.name}]({self.info()})"
+
+
+canonical_group_cache = GroupCache("canonical_group", maxsize=256)
+# Actions of large groups (e.g. of the weight space of a layer) hold `|G|` index arrays of the group dimension.
+group_actions_cache = GroupCache("group_actions", maxsize=64)
+GROUP_CACHES = {cache.name: cache for cache in (canonical_group_cache, group_actions_cache)}
+
+
+def group_cache_info() -> dict:
+    """ :return: Dictionary `{cache_name: {hits, misses, size, maxsize}}` of all the group caches. """
+    return {name: cache.info() for name, cache in GROUP_CACHES.items()}
+
+
+def clear_group_caches():
+    for cache in GROUP_CACHES.values():
+        cache.clear()
@@ -1,5 +1,7 @@
-import sys
-from typing import Union
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, Optional, Sequence, Tuple
 
 import jax
 import scipy
@@ -10,8 +12,8 @@ from emlp.reps.linear_operators import lazify, LazyKron, densify, LazyPerm, Lazy
 from emlp.reps.product_sum_reps import ProductRep
 from emlp.reps.representation import Vector, Scalar
 from emlp.reps.representation import Base as BaseRep
-from tqdm import tqdm
 
+from groups.SignedPermutation import SignedPermutation, fixed_point_basis
 from groups.SymmetricGroups import C2, Klein4, Sym
 from scipy.sparse.linalg import LinearOperator
 
@@ -33,9 +35,16 @@ class SemiDirectProduct(Sym):
         self.is_orthogonal = Gin.is_orthogonal and Gout.is_orthogonal
         self.is_permutation = Gin.is_permutation and Gout.is_permutation
 
+        # Signed permutation form of the generators `h_out ⊗ h_in`, when both groups provide it.
+        self.signed_generators = None
+        if getattr(Gin, 'signed_generators', None) is not None and getattr(Gout, 'signed_generators', None) is not None:
+            self.signed_generators = [h_out.kron(h_in) for h_in, h_out in zip(Gin.signed_generators,
+                                                                              Gout.signed_generators)]
         self.discrete_generators = []
-        for h_in, h_out in zip(Gin.discrete_generators, Gout.discrete_generators):
-            if self.is_sparse:
+        for i, (h_in, h_out) in enumerate(zip(Gin.discrete_generators, Gout.discrete_generators)):
+            if self.signed_generators is not None:
+                a = self.signed_generators[i].to_matrix()
+            elif self.is_sparse:
                 a = scipy.sparse.kron(h_out, h_in)
             else:
                 a = LazyKron([dense(h_out), dense(h_in)])
@@ -44,12 +53,16 @@ class SemiDirectProduct(Sym):
         self.G1 = Gin
         self.G2 = Gout
         self.d = Gin.d * Gout.d
+        self.fingerprint = self.structural_fingerprint(self.__class__.__name__, self.d,
+                                                       *[getattr(G, 'fingerprint', repr(G)).encode() for G in (Gin, Gout)])
 
         # TODO: Make functional for continuous groups
         self.lie_algebra = []
 
     @property
     def discrete_actions(self) -> list:
+        if self.signed_generators is not None:
+            return self._memoized_actions("discrete", lambda: [g.to_matrix() for g in self.signed_actions])
         actions = []
         for g_in, g_out in zip(self.G1.discrete_actions, self.G2.discrete_actions):
             if self.is_sparse:
@@ -59,13 +72,15 @@ class SemiDirectProduct(Sym):
             actions.append(a)
         return actions
 
+    @property
+    def signed_actions(self) -> list:
+        return self._memoized_actions("signed", lambda: [g_out.kron(g_in) for g_in, g_out in
+                                                          zip(self.G1.signed_actions, self.G2.signed_actions)])
+
     def get_inout_generators(self):
         return np.array(self.G1.discrete_generators, dtype=np.float32), \
                np.array(self.G2.discrete_generators, dtype=np.float32)
 
-    def __hash__(self):
-        return hash(repr(self))
-
     def __repr__(self):
         outstr = f'{repr(self.G1)} ⋊ {repr(self.G2)}'
         return outstr
@@ -135,59 +150,17 @@ class SparseRep(BaseRep):
         Custom code to obtain the equivariant basis, without the need to do eigendecomposition. Allowing to compute the
         basis of very large matrix without running into memory or complexity issues
         - Modified code from: shorturl.at/kuvBD
-        TODO: Extend to cope with multi group actions, currently works only for C2
-        :param P: (n,n) Generalized Permutation matrix with +-1 entries
+        For a signed permutation group the fixed points `g v = v` are spanned by one vector per orbit of dimensions, see
+        `fixed_point_basis`.
         :return: Q: (n, b) `b` Eigenvectors of the fix-point equation
         """
-        P = self.G.discrete_generators[0]
-        log.info(f"Solving equivariant basis using single generalized permutation matrix {P.shape}")
-        n = P.shape[0]
-
-        idx = scipy.sparse.eye(n, format='coo', dtype=P.dtype)
-        orbits = [idx]
-        # First action is identity e
-        for i, h in enumerate(self.G.discrete_actions[1:]):
-            orbits.append((h @ orbits[0]).tocoo().astype(int))
-
-        # cols_itr = np.asarray([m.col for m in orbits]).T
-        rows_itr = np.asarray([m.row for m in orbits]).T
-        data_itr = np.asarray([m.data for m in orbits]).T
-
-        pending_dims = np.ones((n,), dtype=bool)
-
-        pbar = tqdm(total=len(pending_dims), disable=False, dynamic_ncols=True, maxinterval=20, position=0, leave=True,
-                    file=sys.stdout)
-        pbar.set_description("Finding Eigenvectors")
-
-        n_orbit = 0
-        eig_cols, eig_rows, eig_data = [], [], []
-
-        # TODO: Improve code readability and efficiency
-        # TODO: COO format admits repeated entries, we just need to qualize after avoiding all this problem.
-        # +1 is added in order to keep the sign of dimensions 0, otherwise its lost.
-        u_orbits = [np.unique((r+1) * d) for r, d in zip(rows_itr, data_itr)]
-        inv_dims = [u.item() for u in u_orbits if len(u) == 1]
-        if len(inv_dims) > 0:
-            eig_rows.extend(np.asarray(inv_dims) - 1)
-            eig_cols.extend(range(len(inv_dims)))
-            eig_data.extend(list(np.ones(len(inv_dims))))
-            n_orbit = len(inv_dims)
-            pending_dims[np.asarray(inv_dims) - 1] = False
-            pbar.update(len(inv_dims))
-
-        for idxs, vals in zip(rows_itr, data_itr):
-            if pending_dims[idxs[0]]:
-                eig_rows.extend(idxs)
-                eig_cols.extend([n_orbit] * len(idxs))
-                eig_data.extend(vals)
-                pending_dims[idxs] = False
-                n_orbit += 1
-                pbar.update(len(idxs))
-
-        assert not np.any(pending_dims), "There seems to be dimensions not included into the Null Space"
-        pbar.set_description(f"{n_orbit} eigenvectors found")
-        pbar.close()
-        Q = scipy.sparse.coo_matrix((eig_data, (eig_rows, eig_cols)), shape=(n, n_orbit))
+        if getattr(self.G, 'signed_generators', None) is not None:
+            generators = self.G.signed_generators
+        else:
+            generators = [SignedPermutation.from_matrix(h) for h in self.G.discrete_generators]
+        log.info(f"Solving equivariant basis of {len(generators)} signed permutation generators of dimension {self.G.d}")
+        Q = fixed_point_basis(generators)
+        log.info(f"{Q.shape[-1]} eigenvectors found")
         return Q
 
     def __repr__(self):
@@ -196,6 +169,59 @@ class SparseRep(BaseRep):
     def __str__(self):
         return f"Vs[{str(self.G)}]"
 
+def _solve_sparse_basis(spec_in: Optional[dict], spec_out: dict):
+    """ Worker solving the basis of `SparseRep(SemiDirectProduct(G_in, G_out))`, or of `SparseRep(G_out)` without
+    `spec_in`, from the group specifications (see `Sym.get_spec`). """
+    G_out = Sym.from_spec(spec_out)
+    G = G_out if spec_in is None else SemiDirectProduct(Gin=Sym.from_spec(spec_in), Gout=G_out)
+    return SparseRep(G).sparse_equivariant_basis()
+
+
+def presolve_equivariant_bases(rep_pairs: Sequence[Tuple[Optional[BaseRep], BaseRep]], max_workers: Optional[int] = None):
+    """
+    Solves, in parallel, the equivariant bases of the linear maps between the `(rep_in, rep_out)` pairs of
+    representations (or of the vectors of `rep_out` if `rep_in` is None, e.g. biases), storing them in the basis
+    cache `SparseRep.solcache`. Pairs with the same canonical representation are solved once, and problems already
+    cached are skipped, such that instantiating the layers afterwards only reads the cache.
+    Problems are solved in a pool of (spawned) processes, largest first, so the construction time is bounded by the
+    slowest single solve. Groups that cannot be serialized (non-sparse or without `get_spec`) are solved in-process.
+    :param rep_pairs: (rep_in, rep_out) pairs of representations.
+    :param max_workers: Number of worker processes. Defaults to the number of CPUs, `<= 1` solves sequentially.
+    :return: Number of bases solved.
+    """
+    problems = {}
+    for rep_in, rep_out in rep_pairs:
+        rep = SparseRep(rep_out.G if rep_in is None else SemiDirectProduct(Gin=rep_in.G, Gout=rep_out.G))
+        canon_rep, _ = rep.canonicalize()
+        if canon_rep not in rep.solcache and canon_rep not in problems:
+            problems[canon_rep] = (rep, rep_in, rep_out)
+    if len(problems) == 0:
+        return 0
+
+    parallel, sequential = [], []
+    for canon_rep, (rep, rep_in, rep_out) in problems.items():
+        serializable = rep.G.is_sparse and all(hasattr(r.G, 'get_spec') for r in (rep_in, rep_out) if r is not None)
+        (parallel if serializable else sequential).append((canon_rep, rep, rep_in, rep_out))
+
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    if max_workers <= 1 or len(parallel) <= 1:
+        sequential, parallel = parallel + sequential, []
+    if len(parallel) > 0:
+        parallel.sort(key=lambda p: p[1].size(), reverse=True)
+        log.info(f"Solving {len(parallel)} equivariant bases with {min(max_workers, len(parallel))} processes")
+        # Spawn (not fork) workers, as forking a process with an initialized jax runtime can deadlock.
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(parallel)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {canon_rep: pool.submit(_solve_sparse_basis, None if rep_in is None else rep_in.G.get_spec(),
+                                              rep_out.G.get_spec())
+                       for canon_rep, rep, rep_in, rep_out in parallel}
+            for canon_rep, rep, _, _ in parallel:
+                rep.solcache[canon_rep] = futures[canon_rep].result()
+    for canon_rep, rep, _, _ in sequential:
+        rep.equivariant_basis()
+    return len(problems)
+
+
 if __name__ == "__main__":
 
     # robot, Gin, Gout, _, _ = get_robot_params("solo")
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact representation of signed (generalized) permutation matrices, the group actions of `Sym` groups (`C2`, `Klein4`
+and their `SemiDirectProduct`), as an index array and a sign array. Composition, inversion, Kronecker products and
+the action on (batched) arrays/tensors are O(d), and matrices are only built on demand (see `to_matrix`).
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse import issparse
+
+
+class SignedPermutation:
+    """
+    Signed permutation `g` acting on `R^d` as `(g x)[i] = sign[i] * x[perm[i]]`, i.e. the matrix with the single non-zero
+    entry `sign[i]` of row `i` in column `perm[i]`.
+    """
+    __slots__ = ("perm", "sign", "_hash")
+
+    def __init__(self, perm: Sequence[int], sign: Optional[Sequence[int]] = None):
+        """
+        :param perm: (d,) permutation of `range(d)` in one-line notation.
+        :param sign: (d,) +-1 signs, defaults to a permutation without reflections.
+        """
+        self.perm = np.asarray(perm, dtype=np.int64)
+        self.sign = np.ones_like(self.perm, dtype=np.int8) if sign is None else np.asarray(sign, dtype=np.int8)
+        assert self.perm.ndim == 1 and self.perm.shape == self.sign.shape, f"{self.perm.shape} != {self.sign.shape}"
+        self._hash = None
+
+    @staticmethod
+    def identity(d: int) -> 'SignedPermutation':
+        return SignedPermutation(np.arange(d))
+
+    @staticmethod
+    def from_matrix(P) -> 'SignedPermutation':
+        """
+        :param P: (d, d) dense or sparse generalized permutation matrix with +-1 entries.
+        :raises ValueError: If `P` is not a generalized permutation matrix.
+        """
+        P = scipy.sparse.coo_matrix(P if issparse(P) else np.asarray(P))
+        d = P.shape[0]
+        P.eliminate_zeros()
+        if P.nnz != d or len(np.unique(P.row)) != d or len(np.unique(P.col)) != d or np.any(np.abs(P.data) != 1):
+            raise ValueError("Matrix is not a generalized permutation")
+        perm, sign = np.empty((d,), dtype=np.int64), np.empty((d,), dtype=np.int8)
+        perm[P.row], sign[P.row] = P.col, np.sign(P.data)
+        return SignedPermutation(perm, sign)
+
+    @property
+    def d(self) -> int:
+        return self.perm.shape[0]
+
+    @property
+    def shape(self):
+        return self.d, self.d
+
+    def to_matrix(self, format="coo", dtype=np.int8):
+        """ Sparse matrix of the signed permutation, in a scipy sparse `format`. """
+        P = scipy.sparse.coo_matrix((self.sign.astype(dtype), (np.arange(self.d), self.perm)), shape=self.shape)
+        return P.asformat(format)
+
+    def todense(self, dtype=np.int8) -> np.ndarray:
+        P = np.zeros(self.shape, dtype=dtype)
+        P[np.arange(self.d), self.perm] = self.sign
+        return P
+
+    def diagonal(self) -> np.ndarray:
+        return np.where(self.perm == np.arange(self.d), self.sign, 0).astype(np.int8)
+
+    def trace(self) -> int:
+        return int(np.sum(self.diagonal(), dtype=np.int64))
+
+    def is_identity(self) -> bool:
+        return bool(np.all(self.perm == np.arange(self.d)) and np.all(self.sign == 1))
+
+    def inverse(self) -> 'SignedPermutation':
+        """ Inverse (transpose) of the signed permutation. """
+        perm, sign = np.empty_like(self.perm), np.empty_like(self.sign)
+        perm[self.perm], sign[self.perm] = np.arange(self.d), self.sign
+        return SignedPermutation(perm, sign)
+
+    def __matmul__(self, other):
+        """
+        Composition `self @ other` with another signed permutation, or action on the rows of a (d, ...) array or a
+        (d, m) sparse matrix.
+        """
+        if isinstance(other, SignedPermutation):
+            assert self.d == other.d, f"Dimension mismatch {self.d} != {other.d}"
+            # (A B x)[i] = sA[i] (B x)[pA[i]] = sA[i] sB[pA[i]] x[pB[pA[i]]]
+            return SignedPermutation(other.perm[self.perm], self.sign * other.sign[self.perm])
+        if issparse(other):
+            return scipy.sparse.diags(self.sign.astype(other.dtype)) @ scipy.sparse.csr_matrix(other)[self.perm]
+        return self.apply(np.asarray(other), dim=0)
+
+    def __pow__(self, n: int) -> 'SignedPermutation':
+        base = self if n >= 0 else self.inverse()
+        g = SignedPermutation.identity(self.d)
+        for _ in range(abs(n)):
+            g = g @ base
+        return g
+
+    def apply(self, x, dim: int = -1):
+        """
+        Action on the dimension `dim` of a (batched) numpy array or torch tensor.
+        """
+        shape = [1] * x.ndim
+        shape[dim] = self.d
+        if isinstance(x, np.ndarray):
+            return np.take(x, self.perm, axis=dim) * self.sign.reshape(shape).astype(x.dtype)
+        import torch  # Torch is only required to act on tensors.
+        perm = torch.as_tensor(self.perm, device=x.device)
+        sign = torch.as_tensor(self.sign, device=x.device, dtype=x.dtype).reshape(shape)
+        return torch.index_select(x, dim, perm) * sign
+
+    def kron(self, other: 'SignedPermutation') -> 'SignedPermutation':
+        """ Kronecker product `self ⊗ other`, i.e. the signed permutation of `np.kron(self.todense(), other.todense())`. """
+        perm = (self.perm[:, None] * other.d + other.perm[None, :]).reshape(-1)
+        sign = (self.sign[:, None] * other.sign[None, :]).reshape(-1)
+        return SignedPermutation(perm, sign)
+
+    @staticmethod
+    def direct_sum(gs: Sequence['SignedPermutation']) -> 'SignedPermutation':
+        """ Block diagonal signed permutation acting independently on the concatenated spaces of `gs`. """
+        offsets = np.cumsum([0] + [g.d for g in gs[:-1]])
+        return SignedPermutation(np.concatenate([g.perm + o for g, o in zip(gs, offsets)]),
+                                 np.concatenate([g.sign for g in gs]))
+
+    def __eq__(self, other):
+        if not isinstance(other, SignedPermutation):
+            return NotImplemented
+        return np.array_equal(self.perm, other.perm) and np.array_equal(self.sign, other.sign)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.perm.tobytes(), self.sign.tobytes()))
+        return self._hash
+
+    def __len__(self):
+        return self.d
+
+    def __repr__(self):
+        return f"SignedPermutation(d={self.d})"
+
+
+def fixed_point_basis(generators: Sequence[SignedPermutation], dtype=np.float64) -> scipy.sparse.coo_matrix:
+    """
+    Basis of the fixed points `g v = v` of the group generated by the signed permutations `generators`, i.e. the
+    nullspace of the constraints `[g - I]`. The orbits (cycles) of the dimensions are found with array operations
+    (minimum label propagation along the generators with pointer jumping). Each orbit contributes a single vector with
+    `±1` entries, unless the signs along its cycles are inconsistent (e.g. a dimension mapped to itself with a
+    reflection), in which case it admits no non-zero fixed point.
+    :param generators: Signed permutations of the same dimension `n`.
+    :return: Q: (n, b) sparse basis. Columns hold first the invariant dimensions and then the remaining orbits, both
+    sorted by the minimum index of the orbit. Every row has at most one non-zero entry.
+    """
+    n = generators[0].d
+    assert all(g.d == n for g in generators), "Generators must act on the same space"
+    dims = np.arange(n)
+    # Invariant: `label[i]` is a dimension of the orbit of `i`, with `v[i] = rel[i] * v[label[i]]`.
+    label, rel = dims.copy(), np.ones((n,), dtype=np.int8)
+    while True:
+        prev = label
+        for g in generators:
+            # Edge `v[i] = s[i] v[p[i]]`, relabel both of its ends with the smaller label.
+            j = g.perm
+            fwd = label[j] < label
+            label, rel = np.where(fwd, label[j], label), np.where(fwd, g.sign * rel[j], rel)
+            bwd = label < label[j]
+            label[j[bwd]], rel[j[bwd]] = label[bwd], g.sign[bwd] * rel[bwd]
+        # Pointer jumping.
+        label, rel = label[label], rel * rel[label]
+        if np.array_equal(label, prev):
+            break
+    # `v` is a fixed point iff `v[i] = s_g[i] v[p_g[i]]` for all generators, otherwise the whole orbit is discarded.
+    valid_root = np.ones((n,), dtype=bool)
+    singleton = np.ones((n,), dtype=bool)
+    for g in generators:
+        valid_root[label[rel != g.sign * rel[g.perm]]] = False
+        singleton &= g.perm == dims
+    valid = valid_root[label]
+
+    # Column of each orbit: invariant dimensions first, then the other orbits, both sorted by root.
+    roots = np.flatnonzero(valid & (label == dims))
+    order = np.argsort(~singleton[roots], kind="stable")
+    root_col = np.empty((n,), dtype=np.int64)
+    root_col[roots[order]] = np.arange(len(roots))
+
+    rows = np.flatnonzero(valid)
+    cols = root_col[label[rows]]
+    entries = np.lexsort((rows, cols))
+    rows, cols = rows[entries], cols[entries]
+    return scipy.sparse.coo_matrix((rel[rows].astype(dtype), (rows, cols)), shape=(n, len(roots)))
@@ -3,26 +3,29 @@
 # @Time    : 28/1/22
 # @Author  : Daniel Ordonez 
 # @email   : daniels.ordonez@gmail.com
+import hashlib
 from typing import Optional, Sequence
 
 import jax
 import scipy.sparse
 from scipy import sparse
 from scipy.sparse import issparse
-from tqdm import tqdm
 import numpy as np
 import jax.numpy as jnp
 
 import os
 from emlp.groups import Group
 
+from groups.GroupCache import canonical_group_cache, group_actions_cache
+from groups.SignedPermutation import SignedPermutation, fixed_point_basis
+
 
 class Sym(Group):
 
     def __init__(self, generators):
         """
         @param generators: (n, d, d) `n` generator in matrix form `(d, d)`, where `d` is the dimension
-        of the Vector Space and action representations.
+        of the Vector Space and action representations, or `n` `SignedPermutation`s.
         """
         assert len(generators) > 0, "Zero generator provided"
         self.d = generators[0].shape[0]
@@ -32,36 +35,98 @@ class Sym(Group):
         self.is_sparse = False
 
         self.discrete_generators = []
+        # Signed permutation form of the generators, None if any generator is not a generalized permutation.
+        self.signed_generators = []
         # Ensure its orthogonal matrix
         for i, h in enumerate(generators):
-            if issparse(h):
+            g = h if isinstance(h, SignedPermutation) else None
+            if g is not None:
+                h = g.to_matrix()
+            elif issparse(h):
                 assert np.allclose(sparse.linalg.norm(h, axis=0), 1), f"Generator {i} is not orthogonal: \n{h}"
+                try:
+                    g = SignedPermutation.from_matrix(h)
+                except ValueError:
+                    g = None
+            else:
+                assert np.allclose(np.linalg.norm(h, axis=0), 1), f"Generator {i} is not orthogonal: \n{h}"
+            if issparse(h):
                 if h.min() < 0: self.is_permutation = False
                 self.is_sparse = True
             else:
-                assert np.allclose(np.linalg.norm(h, axis=0), 1), f"Generator {i} is not orthogonal: \n{h}"
                 if np.any(h < 0): self.is_permutation = False
 
             self.discrete_generators.append(h)
+            if self.signed_generators is not None:
+                self.signed_generators = None if g is None else self.signed_generators + [g]
 
         if not self.is_sparse:
             self.discrete_generators = jnp.asarray(self.discrete_generators)
 
         # Count number of dimensions that are invariant.
-        h_diags = np.array([h.diagonal() for h in self.discrete_generators] * 4)
+        if self.signed_generators is not None:
+            h_diags = np.array([g.diagonal() for g in self.signed_generators])
+        else:
+            h_diags = np.array([h.diagonal() for h in self.discrete_generators] * 4)
         inv_h_diags = np.array(h_diags) == 1
         inv_dims = np.all(inv_h_diags, axis=0)
         self.inv_dims = inv_dims
         self.n_inv_dims = np.sum(inv_dims).item()
 
+        if self.signed_generators is not None:
+            chunks = [a.tobytes() for g in self.signed_generators for a in (g.perm, g.sign)]
+        else:
+            chunks = [a for h in self.discrete_generators for a in self.csr_chunks(h)]
+        self.fingerprint = self.structural_fingerprint(self.__class__.__name__, self.d, *chunks)
+
         super().__init__()
 
+    @staticmethod
+    def structural_fingerprint(group_type: str, d: int, *chunks: bytes) -> str:
+        """
+        Digest identifying a group by its type, dimension and generators (e.g. their signed permutation arrays).
+        Computed once per group, it makes hashing, comparing and keying caches by groups O(1).
+        """
+        digest = hashlib.blake2b(f"{group_type}|{d}".encode(), digest_size=16)
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def csr_chunks(h) -> list:
+        """
+        `indptr`, `indices` and `data` bytes of the canonical CSR form (no duplicates nor explicit zeros, sorted indices)
+        of a sparse or dense matrix, equal for equal matrices regardless of their format, and without densifying it.
+        """
+        h = sparse.csr_matrix(h, copy=True) if issparse(h) else sparse.csr_matrix(np.asarray(h))
+        h.sum_duplicates()
+        h.eliminate_zeros()
+        h.sort_indices()
+        return [np.asarray(h.indptr, dtype=np.int64).tobytes(), np.asarray(h.indices, dtype=np.int64).tobytes(),
+                np.asarray(h.data, dtype=np.float64).tobytes()]
+
+    @property
+    def signed_actions(self) -> list:
+        """ Group elements (in the order of `discrete_actions`) as `SignedPermutation`s. """
+        raise NotImplementedError()
+
     @property
     def discrete_actions(self) -> list:
         raise NotImplementedError()
 
+    def _memoized_actions(self, kind: str, build) -> list:
+        """ Group elements enumerated by `build()`, memoized in `group_actions_cache` for signed permutation groups. """
+        if self.signed_generators is None:
+            return build()
+        return list(group_actions_cache((kind, self.fingerprint), build))
+
     def __hash__(self):
-        return hash(str(self.discrete_generators))
+        return hash(self.fingerprint)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sym):
+            return NotImplemented
+        return self.fingerprint == other.fingerprint
 
     def __repr__(self):
         return f"Sym({self.d})"
@@ -93,6 +158,78 @@ class Sym(Group):
     def np_gens(self):
         return np.array([h.todense() for h in self.discrete_generators])
 
+    @staticmethod
+    def matrix2oneline(P):
+        """
+        Inverse of `oneline2matrix`, for matrices with a single non-zero per row: `(P @ x)[i] = signs[i] * x[perm[i]]`
+        :param P: (d, d) Generalized Permutation matrix with +-1 entries, or a `SignedPermutation`
+        :return: perm (d,) int array, signs (d,) int array
+        """
+        g = P if isinstance(P, SignedPermutation) else SignedPermutation.from_matrix(P)
+        return g.perm, g.sign.astype(np.int64)
+
+    def get_spec(self) -> dict:
+        """
+        Serializable specification of the group: its class name and its generators in one-line notation.
+        """
+        return {'group': self.__class__.__name__,
+                'perms': [g.perm.tolist() for g in self.signed_generators],
+                'signs': [g.sign.tolist() for g in self.signed_generators]}
+
+    @staticmethod
+    def from_spec(spec: dict) -> 'Sym':
+        """ Instantiates a group from its specification, see `get_spec`. """
+        generators = [SignedPermutation(p, r) for p, r in zip(spec['perms'], spec['signs'])]
+        if spec['group'] == C2.__name__:
+            return C2(generator=generators[0])
+        elif spec['group'] == Klein4.__name__:
+            return Klein4(generators=generators)
+        raise NotImplementedError(f"Group {spec['group']} cannot be instantiated from its specification")
+
+    def isotypic_basis(self):
+        """
+        Orthogonal change of basis `T` to the isotypic (spectral) decomposition of the representation, for groups
+        isomorphic to a product of C2 groups (C2, Klein4). Every irreducible representation is one dimensional,
+        i.e. a character `χ`, and its isotypic component is the image of the projector `P_χ = 1/|G| Σ_g χ(g) ρ(g)`.
+        In this basis equivariant linear maps `W` are block diagonal: `T_out W T_in^T = diag(W_χ0, W_χ1, ...)`.
+        :return: T (d, d) orthogonal sparse matrix with the coordinates of the isotypic components sorted by
+        character, and dims: (|G|,) the dimension of each isotypic component.
+        """
+        n_gens = len(self.discrete_generators)
+        if not self.is_sparse or self.signed_generators is None:
+            raise NotImplementedError(f"Isotypic decomposition only implemented for sparse products of C2: {self}")
+        actions = self.signed_actions
+        n = len(actions)
+        if n != 2 ** n_gens:
+            raise NotImplementedError(f"Isotypic decomposition only implemented for sparse products of C2: {self}")
+        perms = np.asarray([g.perm for g in actions])
+        signs = np.asarray([g.sign for g in actions], dtype=np.int64)
+        # `discrete_actions` enumerates group elements g_m = Π_j gen_j^(bit j of m). χ_s(g_m) = (-1)^|s & m|.
+        elements = np.arange(n)
+        parity = np.array([[bin(s & m).count("1") % 2 for m in elements] for s in elements])
+        characters = 1 - 2 * parity
+
+        d = self.d
+        rows = np.repeat(np.arange(d), n)
+        orbit_rep = np.min(perms, axis=0)  # Smallest coordinate in the orbit of each dimension.
+        T_blocks, dims = [], []
+        for chi in characters:
+            # Row r of the projector P_χ (up to scale): Σ_g χ(g) signs_g[r] e_{perm_g[r]}
+            P_chi = scipy.sparse.csr_matrix(((chi[:, None] * signs).T.flatten(), (rows, perms.T.flatten())),
+                                            shape=(d, d), dtype=np.float64)
+            P_chi.sum_duplicates()
+            P_chi.eliminate_zeros()
+            # Rows of the same orbit are equal up to sign, keep one (non-zero) row per orbit.
+            keep = np.logical_and(orbit_rep == np.arange(d), np.diff(P_chi.indptr) > 0)
+            T_chi = P_chi[keep]
+            norms = np.sqrt(np.asarray(T_chi.power(2).sum(axis=1))).flatten()
+            if T_chi.shape[0] > 0:
+                T_blocks.append(scipy.sparse.diags(1 / norms) @ T_chi)
+            dims.append(T_chi.shape[0])
+        T = scipy.sparse.vstack(T_blocks, format='csr')
+        assert T.shape == (d, d), f"Isotypic components do not span the vector space {T.shape} != {(d, d)}"
+        return T, dims
+
     @staticmethod
     def canonical_group(d, inv_dims: int = 0) -> 'Sym':
         raise NotImplementedError()
@@ -108,18 +245,27 @@ class C2(Sym):
         super().__init__([generator])
         assert len(self.discrete_generators) == 1, "C2 must contain only one generator (without counting the identity)"
 
-        h = self.discrete_generators[0]
-
-        is_eye = np.isclose(sum(h.diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(h), self.d)
-        is_cyclic = np.isclose(sum((h @ h).diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(h @ h), self.d)
+        if self.signed_generators is not None:
+            h = self.signed_generators[0]
+            is_eye, is_cyclic = h.is_identity(), (h @ h).is_identity()
+        else:
+            h = self.discrete_generators[0]
+            is_eye = np.isclose(sum(h.diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(h), self.d)
+            is_cyclic = np.isclose(sum((h @ h).diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(h @ h), self.d)
         assert not is_eye, f"Generator must not be the identity: \n {h}"
         assert is_cyclic, f"Generator is not cyclic h @ h != I"
 
 
     @property
     def discrete_actions(self) -> list:
+        if self.signed_generators is not None:
+            return self._memoized_actions("discrete", lambda: [g.to_matrix() for g in self.signed_actions])
         return [sparse.eye(self.d, format='coo'), self.discrete_generators[0]]
 
+    @property
+    def signed_actions(self) -> list:
+        return self._memoized_actions("signed", lambda: [SignedPermutation.identity(self.d), self.signed_generators[0]])
+
     def __repr__(self):
         return f"C2[d:{self.d}]" if self.n_inv_dims == 0 else f"C2[d:{self.d}|inv:{self.n_inv_dims}]"
 
@@ -127,7 +273,12 @@ class C2(Sym):
     def canonical_group(d, inv_dims: int = 0) -> 'C2':
         """
         @param d: Vector Space dimension
+        Groups are memoized in `canonical_group_cache`, and hence shared by all callers.
         """
+        return canonical_group_cache((C2.__name__, d, inv_dims), lambda: C2._canonical_group(d, inv_dims))
+
+    @staticmethod
+    def _canonical_group(d, inv_dims: int = 0) -> 'C2':
         assert d > 0, "Vector space dimension must be greater than 0"
         assert inv_dims < d - 1, "At least a single dimension must be symmetric"
 
@@ -154,9 +305,7 @@ class C2(Sym):
             p[:n] = np.flip(p_copy[-n:])
             p[-n:] = np.flip(p_copy[:n])
 
-        H = Sym.oneline2matrix(oneline_notation=p.tolist(), reflexions=r.tolist())
-        # HH = np.asarray(H.todense())
-        G = C2(generator=H)
+        G = C2(generator=SignedPermutation(p, r))
         assert G.n_inv_dims == inv_dims, G.n_inv_dims
         return G
 
@@ -165,38 +314,11 @@ class C2(Sym):
         """
         Custom code to obtain the equivariant basis, without the need to do eigendecomposition. Allowing to compute the
         basis of very large matrix without running into memory or complexity issues
-        :param P: (n,n) Generalized Permutation matrix with +-1 entries
-        :return: Q: (n, b) `b` Eigenvectors of the fix-point equation
+        :param P: (n,n) Generalized Permutation matrix with +-1 entries, or a `SignedPermutation`
+        :return: Q: (n, b) sparse `b` Eigenvectors of the fix-point equation, see `fixed_point_basis`
         """
-        dtype = P.dtype
-        # Modified code from: shorturl.at/kuvBD
-        n = len(P)
-        # compute the cyclic decomposition. a.k.a orbit for each dimension of the vec space acted by the gen permutation
-        w = np.abs(P) @ np.arange(n).astype(np.int32)
-        pendind_dims = set(range(n))
-        cycles = []
-
-        pbar = tqdm(total=n, disable=False,  dynamic_ncols=True, maxinterval=20, position=0, leave=True)
-        while pendind_dims:
-            a = pendind_dims.pop()  # Get the initial point of an orbit.
-            pbar.update(1)
-            # pendind_dims.remove(a)
-            cycles.append([a])
-            while w[a] in pendind_dims:
-                a = w[a]
-                cycles[-1].append(a)
-                pendind_dims.remove(a)
-                pbar.update(1)
-        pbar.close()
-
-        # obtain the eigenvectors
-        Q = np.zeros((n, 0)).astype(dtype)
-        for i, cyc in enumerate(cycles):
-            p = np.sum(P[cyc, :], axis=1)
-            if np.prod(p) == 1:
-                Q = np.hstack((Q, np.zeros((n, 1), dtype=dtype)))
-                Q[cyc, -1] = [np.prod(p[i:-1]) for i in range(len(p))]
-        return Q
+        g = P if isinstance(P, SignedPermutation) else SignedPermutation.from_matrix(P)
+        return fixed_point_basis([g], dtype=np.float64 if isinstance(P, SignedPermutation) else P.dtype)
 
 class Klein4(Sym):
 
@@ -209,11 +331,15 @@ class Klein4(Sym):
         super().__init__(generators)
 
         # Assert generators and their composition is cylic. That is, assert generators produce an abelian group
-        a, b = self.discrete_generators
-
-        is_eye = lambda x: np.isclose(sum(x.diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(x), self.d)
+        if self.signed_generators is not None:
+            a, b = self.signed_generators
+            is_eye = lambda x: x.is_identity()
+            is_cyclic = lambda x: (x @ x).is_identity()
+        else:
+            a, b = self.discrete_generators
+            is_eye = lambda x: np.isclose(sum(x.diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(x), self.d)
+            is_cyclic = lambda x: np.isclose(sum((x @ x).diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(x @ x), self.d)
         a_is_eye, b_is_eye, ab_is_eye = is_eye(a), is_eye(b), is_eye(a @ b)
-        is_cyclic = lambda x: np.isclose(sum((x @ x).diagonal()), self.d) if self.is_sparse else jnp.isclose(jnp.trace(x @ x), self.d)
         a_is_cyclic, b_is_cyclic, ab_is_cyclic = is_cyclic(a),  is_cyclic(b),  is_cyclic(a @ b)
 
         assert not a_is_eye and not b_is_eye, f"Generators cannot be the identity a != b != e"
@@ -224,11 +350,15 @@ class Klein4(Sym):
 
     @property
     def discrete_actions(self) -> list:
+        if self.signed_generators is not None:
+            return self._memoized_actions("discrete", lambda: [g.to_matrix() for g in self.signed_actions])
         a, b = self.discrete_generators
         return [sparse.eye(self.d, format='coo'), a, b, a@b]
 
-    def __hash__(self):
-        return hash(str(self.discrete_generators))
+    @property
+    def signed_actions(self) -> list:
+        a, b = self.signed_generators
+        return self._memoized_actions("signed", lambda: [SignedPermutation.identity(self.d), a, b, a @ b])
 
     def __repr__(self):
         return f"V4[d:{self.d}]" if self.n_inv_dims == 0 else f"V4[d:{self.d}|inv:{self.n_inv_dims}]"
@@ -237,7 +367,12 @@ class Klein4(Sym):
     def canonical_group(d, inv_dims: int = 0) -> 'Klein4':
         """
         @param d: Vector Space dimension
+        Groups are memoized in `canonical_group_cache`, and hence shared by all callers.
         """
+        return canonical_group_cache((Klein4.__name__, d, inv_dims), lambda: Klein4._canonical_group(d, inv_dims))
+
+    @staticmethod
+    def _canonical_group(d, inv_dims: int = 0) -> 'Klein4':
         assert d > 0, "Vector space dimension must be greater than 0"
 
         # Representation reflections
@@ -269,9 +404,7 @@ class Klein4(Sym):
         a = np.concatenate((idx[:feasible_inv_dims//2], equiv_a, idx[len(idx) - feasible_inv_dims//2:]))
         b = np.concatenate((idx[:feasible_inv_dims//2], equiv_b, idx[len(idx) - feasible_inv_dims//2:]))
 
-        rep_a = C2.oneline2matrix(a,)
-        rep_b = C2.oneline2matrix(b,)
-        G = Klein4(generators=[rep_a, rep_b])
+        G = Klein4(generators=[SignedPermutation(a), SignedPermutation(b)])
 
         assert G.n_inv_dims == feasible_inv_dims, G.n_inv_dims
         return G
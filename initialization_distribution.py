@@ -30,6 +30,13 @@ class Identity(torch.nn.Module):
         return x
 
 
+def basis_row_sum(layer: BasisLinear):
+    # Bases stored as orbit indices have a single non-zero per row, its value is the row sum.
+    if layer.basis is None:
+        return layer.basis_orbit_sign
+    return torch.sum(layer.basis, dim=-1)
+
+
 def extract_weight_distribution(model):
     weights, basis_coeff_w, basis = {}, {}, {}
 
@@ -48,14 +55,14 @@ def extract_weight_distribution(model):
             weights[layer_index] = W
             basis_coeff = layer.linear.basis_coeff.view(-1).detach().cpu().numpy()
             basis_coeff_w[layer_index] = basis_coeff
-            base = torch.sum(layer.linear.basis, dim=-1).view(-1).detach().cpu().numpy()
+            base = basis_row_sum(layer.linear).view(-1).detach().cpu().numpy()
             basis[layer_index] = base
         elif isinstance(layer, BasisLinear):
             W = layer.weight.view(-1).detach().cpu().numpy()
             weights[layer_index] = W
             basis_coeff = layer.basis_coeff.view(-1).detach().cpu().numpy()
             basis_coeff_w[layer_index] = basis_coeff
-            base = torch.sum(layer.basis, dim=-1).view(-1).detach().cpu().numpy()
+            base = basis_row_sum(layer).view(-1).detach().cpu().numpy()
             basis[layer_index] = base
 
     df_weights = pd.concat([pd.DataFrame.from_dict({k: v}) for k, v in weights.items()], axis=1)
@@ -10,15 +10,19 @@ import numpy as np
 import scipy.sparse
 import torch
 import torch.nn as nn
-from scipy.sparse import issparse
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from groups.SemiDirectProduct import SparseRep
+from groups.SignedPermutation import SignedPermutation
 from groups.SymmetricGroups import C2
-from nn.EquivariantModules import EquivariantBlock, BasisLinear, EMLP, EquivariantModel
+from nn.EquivariantModules import EquivariantBlock, BasisLinear, EMLP, EquivariantModel, frozen_copy, is_compiling, \
+    TRANSIENT_TENSORS
+from nn.LayerProfiler import measure_training_step
 from nn.EConv1d import BasisConv1d
+from nn.FrozenModules import FrozenContactECNN
 from emlp.groups import Group
 from emlp.reps.representation import Rep, Vector
-from scipy.sparse import block_diag
 
 import logging
 log = logging.getLogger(__name__)
@@ -26,8 +30,9 @@ log = logging.getLogger(__name__)
 class ContactECNN(EquivariantModel):
 
     def __init__(self, rep_in: Rep, rep_out: Rep, hidden_group: Group, window_size=150, cache_dir=None, dropout=0.5,
-                 init_mode="fan_in", inv_dim_scale=1.0):
-        super(ContactECNN, self).__init__(rep_in, rep_out, hidden_group, cache_dir)
+                 init_mode="fan_in", inv_dim_scale=1.0, basis_storage="auto", gradient_checkpointing=False,
+                 equivariance_check="lazy"):
+        super(ContactECNN, self).__init__(rep_in, rep_out, hidden_group, cache_dir, equivariance_check=equivariance_check)
         self.rep_in = rep_in
         self.rep_out = rep_out
         self.hidden_G = hidden_group
@@ -35,6 +40,8 @@ class ContactECNN(EquivariantModel):
         self.window_size = window_size
         self.dropout = dropout
         self.inv_dims_scale = inv_dim_scale
+        self.basis_storage = basis_storage
+        self.gradient_checkpointing = gradient_checkpointing
 
         self.in_invariant_dims = self.rep_in.G.n_inv_dims
         inv_in, inv_out = rep_in.G.n_inv_dims / rep_in.G.d, rep_out.G.n_inv_dims / rep_out.G.d
@@ -48,25 +55,35 @@ class ContactECNN(EquivariantModel):
         rep_ch_128_2 = SparseRep(self.hidden_G.canonical_group(128, inv_dims=ceil(128 * inv_ratios[4])))
         # Group of the flatten feature vector, must comply with the 2D symmetry.
         block2_out_window = int(window_size/4)
-        G = C2(generator=block_diag([rep_ch_128_2.G.discrete_generators[0]]*block2_out_window))
+        G = C2(generator=SignedPermutation.direct_sum([rep_ch_128_2.G.signed_generators[0]] * block2_out_window))
         # MLP reps
         rep_in_mlp = SparseRep(G)
         rep_ch_2048 = SparseRep(self.hidden_G.canonical_group(2048, inv_dims=ceil(2048 * inv_ratios[5])))
         rep_ch_512 = SparseRep(self.hidden_G.canonical_group(512, inv_dims=ceil(512 * inv_ratios[6])))
 
+        # Solve the distinct bases of all layers in parallel, layers below only read the basis cache.
+        self.presolve_bases([(self.rep_in, rep_ch_64_1, True), (rep_ch_64_1, rep_ch_64_2, True),
+                             (rep_ch_64_2, rep_ch_128_1, True), (rep_ch_128_1, rep_ch_128_2, True),
+                             (rep_in_mlp, rep_ch_2048, True), (rep_ch_2048, rep_ch_512, True),
+                             (rep_ch_512, self.rep_out, True)])
+
         self.block1 = nn.Sequential(
-            BasisConv1d(rep_in=self.rep_in, rep_out=rep_ch_64_1, kernel_size=3, stride=1, padding=1),
+            BasisConv1d(rep_in=self.rep_in, rep_out=rep_ch_64_1, kernel_size=3, stride=1, padding=1,
+                        basis_storage=basis_storage),
             nn.ReLU(),
-            BasisConv1d(rep_in=rep_ch_64_1, rep_out=rep_ch_64_2, kernel_size=3, stride=1, padding=1),
+            BasisConv1d(rep_in=rep_ch_64_1, rep_out=rep_ch_64_2, kernel_size=3, stride=1, padding=1,
+                        basis_storage=basis_storage),
             nn.ReLU(),
             nn.Dropout(p=self.dropout),
             nn.MaxPool1d(kernel_size=2, stride=2)
         )
 
         self.block2 = nn.Sequential(
-            BasisConv1d(rep_in=rep_ch_64_2, rep_out=rep_ch_128_1, kernel_size=3, stride=1, padding=1),
+            BasisConv1d(rep_in=rep_ch_64_2, rep_out=rep_ch_128_1, kernel_size=3, stride=1, padding=1,
+                        basis_storage=basis_storage),
             nn.ReLU(),
-            BasisConv1d(rep_in=rep_ch_128_1, rep_out=rep_ch_128_2, kernel_size=3, stride=1, padding=1),
+            BasisConv1d(rep_in=rep_ch_128_1, rep_out=rep_ch_128_2, kernel_size=3, stride=1, padding=1,
+                        basis_storage=basis_storage),
             nn.ReLU(),
             nn.Dropout(p=self.dropout),
             nn.MaxPool1d(kernel_size=2, stride=2)
@@ -75,14 +92,16 @@ class ContactECNN(EquivariantModel):
         self.fc = nn.Sequential(
             EquivariantBlock(rep_in=rep_in_mlp,
                              rep_out=rep_ch_2048,
-                             activation=nn.ReLU),
+                             activation=nn.ReLU,
+                             basis_storage=basis_storage),
             nn.Dropout(p=self.dropout),
             EquivariantBlock(rep_in=rep_ch_2048,
                              rep_out=rep_ch_512,
-                             activation=nn.ReLU),
+                             activation=nn.ReLU,
+                             basis_storage=basis_storage),
 
             nn.Dropout(p=self.dropout),
-            BasisLinear(rep_in=rep_ch_512, rep_out=self.rep_out),
+            BasisLinear(rep_in=rep_ch_512, rep_out=self.rep_out, basis_storage=basis_storage),
         )
 
         # Test Each block equivariance.
@@ -94,11 +113,12 @@ class ContactECNN(EquivariantModel):
 
         self.reset_parameters(init_mode=init_mode)
         # Test entire model equivariance.
-        self.test_module_equivariance(module=self, rep_in=self.rep_in, rep_out=self.rep_out,
-                                      in_shape=(1, 150, rep_in.G.d))
+        self.schedule_equivariance_check()
         self.save_cache_file()
 
     def forward(self, x):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled() and not is_compiling():
+            return self.checkpointed_forward(x)
         x = x.permute(0, 2, 1)
         block1_out = self.block1(x)
         block2_out = self.block2(block1_out)
@@ -108,6 +128,66 @@ class ContactECNN(EquivariantModel):
         fc_out = self.fc(block2_out_reshape)
         return fc_out
 
+    def checkpointed_forward(self, x):
+        """
+        Forward pass keeping for backward only the inputs of the conv blocks and of each layer of `fc`. Materialized
+        weights and activations of each segment are recomputed during the backward pass.
+        """
+        x = x.permute(0, 2, 1)
+        block1_out = self._checkpoint(self.block1, x)
+        block2_out = self._checkpoint(self.block2, block1_out)
+        block2_out = block2_out.permute(0, 2, 1)
+        out = block2_out.reshape(block2_out.shape[0], -1)
+        for module in self.fc:
+            out = self._checkpoint(module, out) if isinstance(module, (EquivariantBlock, BasisLinear)) else module(out)
+        return out
+
+    @staticmethod
+    def _checkpoint(module: torch.nn.Module, x: torch.Tensor) -> torch.Tensor:
+        y = checkpoint(module, x, use_reentrant=False)
+        # Debug references to the last weights/pre-activations would keep the recomputed tensors alive.
+        for m in module.modules():
+            for name in TRANSIENT_TENSORS:
+                if getattr(m, name, None) is not None:
+                    setattr(m, name, None)
+        return y
+
+    def set_gradient_checkpointing(self, enabled: bool = True):
+        """
+        Enables/disables the recomputation of the weights and activations of the conv blocks and `fc` layers during
+        the backward pass, trading compute for the memory of the activations kept for backward during training.
+        """
+        self.gradient_checkpointing = enabled
+
+    def checkpointing_report(self, batch_size: int) -> dict:
+        """
+        Memory kept for backward and time of a training step with and without gradient checkpointing, see
+        `measure_training_step`. The random number generators are forked, so the report does not change the random
+        stream (dropout masks, data order) of a seeded training run.
+        """
+        enabled, training = self.gradient_checkpointing, self.training
+        self.train()
+        device = self.fc[-1].basis_coeff.device
+        report = {}
+        with torch.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+            x = self.example_input(batch_size=batch_size)
+            for mode in (False, True):
+                self.gradient_checkpointing = mode
+                stats = measure_training_step(self, x)
+                report[f"checkpointing={mode}"] = {"saved_mb": stats["saved_bytes"] / 2 ** 20,
+                                                   "step_ms": stats["step_ms"]}
+        self.gradient_checkpointing = enabled
+        self.train(training)
+        return report
+
+    def get_init_kwargs(self) -> dict:
+        return {'window_size': self.window_size,
+                'dropout': self.dropout,
+                'init_mode': self.init_mode,
+                'inv_dim_scale': self.inv_dims_scale,
+                'basis_storage': self.basis_storage,
+                'gradient_checkpointing': self.gradient_checkpointing}
+
     def get_hparams(self):
         return {'window_size': self.window_size,
                 'rep_in': str(self.rep_in),
@@ -115,7 +195,11 @@ class ContactECNN(EquivariantModel):
                 'hidden_group': str(self.hidden_G),
                 'init_mode': self.init_mode,
                 'inv_dims_scale': self.inv_dims_scale,
-                'dropout': self.dropout}
+                'dropout': self.dropout,
+                'isotypic': self.isotypic_mode,
+                'basis_storage': self.basis_storage,
+                'basis_storages': self.basis_storage_summary(),
+                'gradient_checkpointing': self.gradient_checkpointing}
 
     def reset_parameters(self, init_mode=None, model=None):
         assert init_mode is not None or self.init_mode is not None
@@ -136,33 +220,89 @@ class ContactECNN(EquivariantModel):
         log.info(f"{self.model_class} initialized with mode: {self.init_mode}")
 
 
-    @staticmethod
-    def test_module_equivariance(module: torch.nn.Module, rep_in, rep_out, in_shape=None):
-        module.eval()
-        shape = (rep_in.G.d) if in_shape is None else in_shape
-        x = torch.randn(shape)
-        for g_in, g_out in zip(rep_in.G.discrete_generators, rep_out.G.discrete_generators):
-            g_in, g_out = (g_in.todense(), g_out.todense()) if issparse(g_in) else (g_in, g_out)
-            g_in = torch.tensor(np.asarray(g_in), dtype=torch.float32).unsqueeze(0)
-            g_out = torch.tensor(np.asarray(g_out), dtype=torch.float32).unsqueeze(0)
+    def export_frozen(self) -> FrozenContactECNN:
+        frozen = FrozenContactECNN(block1=frozen_copy(self.block1), block2=frozen_copy(self.block2),
+                                   fc=frozen_copy(self.fc)).eval()
+        self._check_frozen_parity(frozen)
+        return frozen
+
+    def example_input(self, batch_size: int = 1) -> torch.Tensor:
+        p = self.fc[-1].basis_coeff
+        return torch.randn((batch_size, self.window_size, self.rep_in.G.d), device=p.device, dtype=p.dtype)
+
+    def streaming(self) -> 'ContactECNNStream':
+        """ Stateful streaming inference over a sliding window, see `ContactECNNStream`. """
+        return ContactECNNStream(self)
+
+    # Smallest input whose first two `block2` outputs are not affected by its right edge.
+    LEFT_EDGE_SAMPLES = 16
 
-            y = module.forward(x)
+    @property
+    def first_right_edge_output(self) -> int:
+        """ First `block2` output position of a window affected by the zero padding of its right edge. """
+        return (self.window_size - 10) // 4 + 1
 
-            if x.ndim == 3:
-                xx = x.permute(0, 2, 1)
-                g_x = (g_in @ xx.unsqueeze(1)).squeeze(1)
-                g_x = g_x.permute(0, 2, 1)
-            else:
-                g_x = g_in @ x
+    def atrous_features(self, x: torch.Tensor):
+        """
+        Features of the convolutional blocks over a sequence longer than a window, without zero padding and without
+        the stride-2 decimation of the max-pooling layers, such that features of windows starting at any time step
+        (of either parity) are available. For a window starting at time `s`, the output of `block2` at position `m`
+        equals `p2[..., s + 4m + 3 - 9]`, for all the positions not affected by the window edges, i.e.
+        `2 <= m < first_right_edge_output`. Requires the model in evaluation mode (no dropout).
+        :param x: (B, d_in, T) sequence.
+        :return: Intermediate features a1, a2, p1, b1, b2, p2 with T-2, T-4, T-5, T-9, T-13, T-15 time steps.
+        """
+        conv1, act1, conv2, act2 = self.block1[0:4]
+        conv3, act3, conv4, act4 = self.block2[0:4]
+        a1 = act1(F.conv1d(x, conv1.weight, conv1.bias))
+        a2 = act2(F.conv1d(a1, conv2.weight, conv2.bias))
+        p1 = torch.maximum(a2[..., :-1], a2[..., 1:])
+        b1 = act3(F.conv1d(p1, conv3.weight, conv3.bias, dilation=2))
+        b2 = act4(F.conv1d(b1, conv4.weight, conv4.bias, dilation=2))
+        p2 = torch.maximum(b2[..., :-2], b2[..., 2:])
+        return a1, a2, p1, b1, b2, p2
 
-            g_y_pred = module.forward(g_x)
+    def edge_features(self, windows: torch.Tensor):
+        """
+        `block2` outputs at the window positions affected by the zero padding of the window edges, computed from the
+        samples at the window edges only.
+        :param windows: (B, d_in, window_size) windows.
+        :return: left (B, C, 2) and right (B, C, window_size // 4 - first_right_edge_output) outputs.
+        """
+        left = self.block2(self.block1(windows[..., :self.LEFT_EDGE_SAMPLES]))[..., :2]
+        # Chunk aligned with the pooling of the window, whose first two outputs are affected by its own left edge.
+        c = 4 * (self.first_right_edge_output - 2)
+        right = self.block2(self.block1(windows[..., c:]))[..., 2:]
+        return left, right
 
-            g_y_true = (g_out[0, :, :] @ y.T).T
+    @torch.no_grad()
+    def forward_trajectory(self, seq: torch.Tensor, batch_size=1024) -> torch.Tensor:
+        """
+        Outputs of all the stride-1 windows of a trajectory, identical to running `forward` on each window. The
+        convolutional blocks run once over the full trajectory (see `atrous_features`), only the few window positions
+        affected by the zero padding of the window edges are computed per window. The per window features are then
+        fed to the `fc` head in batches of `batch_size` windows.
+        :param seq: (T, d_in) trajectory with T >= window_size.
+        :return: (T - window_size + 1, d_out) output of the window ending at each time step `t >= window_size - 1`.
+        """
+        if self.training:
+            raise RuntimeError("Trajectory inference requires the model in evaluation mode, call `model.eval()`")
+        W = self.window_size
+        assert seq.shape[0] >= W, f"Trajectory of {seq.shape[0]} samples is shorter than the window {W}"
+        assert W >= 2 * self.LEFT_EDGE_SAMPLES, f"Window size {W} too small"
+        x = seq.T.unsqueeze(0)
+        p2 = self.atrous_features(x)[-1][0]
+        windows = x[0].unfold(-1, W, 1)   # (d_in, n_windows, W) view, no copy.
+        m = torch.arange(2, self.first_right_edge_output, device=seq.device)
 
-            if not torch.allclose(g_y_true, g_y_pred, atol=1e-4, rtol=1e-4):
-                error = g_y_true - g_y_pred
-                raise RuntimeError(f"{module} is not equivariant to in/out group generators f(g·x) - g·y:{error}")
-        module.train()
+        outputs = []
+        for start in range(0, windows.shape[1], batch_size):
+            s = torch.arange(start, min(start + batch_size, windows.shape[1]), device=seq.device)
+            left, right = self.edge_features(windows[:, s].permute(1, 0, 2))
+            middle = p2[:, s.unsqueeze(1) + 4 * m.unsqueeze(0) + 3 - 9].permute(1, 0, 2)
+            block2_out = torch.cat([left, middle, right], dim=-1).permute(0, 2, 1)
+            outputs.append(self.fc(block2_out.reshape(block2_out.shape[0], -1)))
+        return torch.cat(outputs, dim=0)
 
     def unfreeze_equivariance(self, num_layers=1):
         # Freeze most of model model.
@@ -170,4 +310,100 @@ class ContactECNN(EquivariantModel):
             parameter.requires_grad = False
         last_equiv_layers = self.fc[0::2]
         for e_layer in last_equiv_layers[-num_layers:]:
-            e_layer.unfreeze_equivariance()
\ No newline at end of file
+            e_layer.unfreeze_equivariance()
+
+class RingBuffer:
+    """ Fixed size FIFO of time columns, stored in a preallocated `(B, C, size)` tensor. """
+
+    def __init__(self, x: torch.Tensor, size: int):
+        """ :param x: (B, C, T) initial columns, oldest first. Only the last `size` are kept. """
+        self.size = size
+        self.data = x.new_zeros(tuple(x.shape[:2]) + (size,))
+        self.n_pushed = 0
+        self.push(x[..., -size:])
+
+    def push(self, cols: torch.Tensor):
+        """ :param cols: (B, C, n) columns, oldest first. """
+        idx = (self.n_pushed + torch.arange(cols.shape[-1], device=cols.device)) % self.size
+        self.data[..., idx] = cols
+        self.n_pushed += cols.shape[-1]
+
+    def gather(self, offsets) -> torch.Tensor:
+        """ Columns at `offsets` steps before the latest pushed column (offset 0), in the order of `offsets`. """
+        offsets = torch.as_tensor(offsets, device=self.data.device)
+        return self.data[..., (self.n_pushed - 1 - offsets) % self.size]
+
+
+class ContactECNNStream:
+    """
+    Streaming inference of `ContactECNN` over a window sliding one sample at a time. For each new sample only the new
+    time columns of the convolutions of `block1`/`block2` are computed, the outputs are identical to `model(window)`.
+
+    The convolutional features are kept "à trous" (see `ContactECNN.atrous_features`) in ring buffers, such that the
+    features of every window are available whatever the parity of its start. Only the features of the first two and
+    last positions depend on the zero padding at the window edges; those are recomputed from the raw samples of the
+    window edges at every step (see `ContactECNN.edge_features`).
+    """
+
+    def __init__(self, model: ContactECNN):
+        assert model.window_size >= 2 * model.LEFT_EDGE_SAMPLES, f"Window size {model.window_size} too small"
+        self.model = model
+        self.window_size = model.window_size
+        self.conv1, self.act1, self.conv2, self.act2 = model.block1[0:4]
+        self.conv3, self.act3, self.conv4, self.act4 = model.block2[0:4]
+        self.buffers = None
+
+    @staticmethod
+    def _conv_column(conv: BasisConv1d, cols: torch.Tensor) -> torch.Tensor:
+        """ Single output column of `conv` from its (B, C_in, kernel_size) input columns. """
+        return F.conv1d(cols, weight=conv.weight, bias=conv.bias)
+
+    def _check_eval(self):
+        if self.model.training:
+            raise RuntimeError("Streaming inference requires the model in evaluation mode, call `model.eval()`")
+
+    @torch.no_grad()
+    def reset(self, window: torch.Tensor) -> torch.Tensor:
+        """
+        Initializes the stream state from a full window of samples.
+        :param window: (B, window_size, d_in) tensor.
+        :return: (B, d_out) model output for `window`.
+        """
+        self._check_eval()
+        assert window.shape[1] == self.window_size, f"Expected window of {self.window_size} samples {window.shape}"
+        x = window.permute(0, 2, 1)
+        a1, a2, p1, b1, b2, p2 = self.model.atrous_features(x)
+        self.buffers = {'x': RingBuffer(x, self.window_size), 'a1': RingBuffer(a1, 4), 'a2': RingBuffer(a2, 4),
+                        'p1': RingBuffer(p1, 8), 'b1': RingBuffer(b1, 8), 'b2': RingBuffer(b2, 4),
+                        'p2': RingBuffer(p2, self.window_size)}
+        return self._head()
+
+    @torch.no_grad()
+    def step(self, x_t: torch.Tensor) -> torch.Tensor:
+        """
+        Slides the window one sample forward.
+        :param x_t: (B, d_in) new sample.
+        :return: (B, d_out) model output for the window ending at `x_t`.
+        """
+        self._check_eval()
+        if self.buffers is None:
+            raise RuntimeError("Stream not initialized, call `reset(window)` with the first window of samples")
+        buf = self.buffers
+        buf['x'].push(x_t.unsqueeze(-1))
+        buf['a1'].push(self.act1(self._conv_column(self.conv1, buf['x'].gather([2, 1, 0]))))
+        buf['a2'].push(self.act2(self._conv_column(self.conv2, buf['a1'].gather([2, 1, 0]))))
+        buf['p1'].push(torch.maximum(buf['a2'].gather([1]), buf['a2'].gather([0])))
+        buf['b1'].push(self.act3(self._conv_column(self.conv3, buf['p1'].gather([4, 2, 0]))))
+        buf['b2'].push(self.act4(self._conv_column(self.conv4, buf['b1'].gather([4, 2, 0]))))
+        buf['p2'].push(torch.maximum(buf['b2'].gather([2]), buf['b2'].gather([0])))
+        return self._head()
+
+    def _head(self) -> torch.Tensor:
+        x = self.buffers['x'].gather(torch.arange(self.window_size - 1, -1, -1))
+        left, right = self.model.edge_features(x)
+        # Latest stream feature corresponds to window position m = (window_size - 10) / 4.
+        m = torch.arange(2, self.model.first_right_edge_output)
+        middle = self.buffers['p2'].gather(self.window_size - 10 - 4 * m)
+        block2_out = torch.cat([left, middle, right], dim=-1)
+        block2_out = block2_out.permute(0, 2, 1)
+        return self.model.fc(block2_out.reshape(block2_out.shape[0], -1))
@@ -14,15 +14,18 @@ from torch.nn import functional as F
 from torch.nn.modules.utils import _single
 
 from groups.SemiDirectProduct import SemiDirectProduct, SparseRep
-from nn.EquivariantModules import EquivariantModel
-from utils.utils import coo2torch_coo
+from nn.LayerProfiler import profiled_assembly
+from nn.EquivariantModules import register_basis, orbit_basis_expand, IsotypicBasis, \
+    isotypic_block_apply, MaterializationCache, drop_derived_state, drop_transient_state, is_compiling, basis_matmul
 
 
 class BasisConv1d(torch.nn.Module):
     from torch.nn.common_types import _size_1_t
+    rep_dim = 1  # Channels dimension.
 
     def __init__(self, rep_in: BaseRep, rep_out: BaseRep, kernel_size: _size_1_t, stride: _size_1_t = 1,
-                 padding: Union[str, _size_1_t] = 0, dilation: _size_1_t = 1, groups: int = 1, bias: bool = True) -> None:
+                 padding: Union[str, _size_1_t] = 0, dilation: _size_1_t = 1, groups: int = 1, bias: bool = True,
+                 basis_storage: str = "auto") -> None:
         super().__init__()
 
         # Original Implementation Parameters ___________________________________________________________
@@ -40,53 +43,132 @@ class BasisConv1d(torch.nn.Module):
 
         # Avoid recomputing W when basis coefficients have not changed.
         self._new_coeff, self._new_bias_coeff = True, True
+        self._weight_cache, self._bias_cache = MaterializationCache(), MaterializationCache()
+        self._spectral_weight_cache = MaterializationCache()
+        self._weight, self._bias = None, None  # Last materialized kernel and bias, see `TRANSIENT_TENSORS`.
+        # Isotypic (block diagonal) execution mode, see `set_isotypic_mode`.
+        self.iso_in, self.iso_out = None, None
 
         # Compute the nullspace
         Q = self.repW.equivariant_basis()
-        self._sum_basis_sqrd = Q.power(2).sum() if issparse(Q) else np.sum(np.power(Q))
-        basis = coo2torch_coo(Q) if issparse(Q) else torch.tensor(np.asarray(Q))
-        self.basis = torch.nn.Parameter(basis, requires_grad=False)
+        self._sum_basis_sqrd = Q.power(2).sum() if issparse(Q) else np.sum(np.power(Q, 2))
+        self.n_basis = Q.shape[-1]
+        # Kernel taps share the basis. Orbit indices allow to build the kernel with a single gather over all taps.
+        self.basis_storage = register_basis(self, 'basis', Q, storage=basis_storage, n_cols=self.kernel_size_)
 
         # Create the network parameters. Coefficients for each base, and kernel dim
-        self.basis_coeff = torch.nn.Parameter(torch.rand(self.basis.shape[1], self.kernel_size_), requires_grad=True)
+        self.basis_coeff = torch.nn.Parameter(torch.rand(self.n_basis, self.kernel_size_), requires_grad=True)
 
         if bias:
             Qbias = rep_out.equivariant_basis()
-            bias_basis = coo2torch_coo(Qbias) if issparse(Qbias) else torch.tensor(np.asarray(Qbias))
-            self.bias_basis = torch.nn.Parameter(bias_basis, requires_grad=False)
-            self.bias_basis_coeff = torch.nn.Parameter(torch.randn((self.bias_basis.shape[-1])), requires_grad=True)
+            self.bias_basis_storage = register_basis(self, 'bias_basis', Qbias, storage=basis_storage)
+            self.bias_basis_coeff = torch.nn.Parameter(torch.randn((Qbias.shape[-1],)), requires_grad=True)
         else:
-            self.bias_basis, self.bias_basis_coeff = None, None
+            self.bias_basis_storage = register_basis(self, 'bias_basis', None)
+            self.bias_basis_coeff = None
 
         self.reset_parameters()
-        # Check Equivariance.
-        EquivariantModel.test_module_equivariance(module=self, rep_in=self.rep_in, rep_out=self.rep_out,
-                                                  in_shape=(1, rep_in.G.d, 2))
-        # Add hook to backward pass
-        self.register_full_backward_hook(EquivariantModel.backward_hook)
 
     def forward(self, x):
-        if x.device != self.weight.device:
-            self._new_coeff, self._new_bias_coeff = True, True
+        if self.iso_in is not None:
+            return self.isotypic_forward(x)
         return F.conv1d(input=x, weight=self.weight, bias=self.bias, stride=self.stride_, padding=self.padding_,
                         dilation=self.dilation_, groups=self.groups_)
 
+    def isotypic_forward(self, x):
+        """
+        Forward pass in the isotypic basis of the channels, where the kernel is block diagonal for every tap. As in
+        `BasisLinear.isotypic_forward`, the channels are transformed in and out of the spectral basis by every layer,
+        since the pointwise non-linearities and max-pooling are not equivariant in the spectral basis.
+        """
+        W = self._spectral_weight_cache(self._materialize_spectral_weight, self.basis_coeff)
+        conv = lambda x_chi, W_chi: F.conv1d(input=x_chi, weight=W_chi, stride=self.stride_, padding=self.padding_,
+                                             dilation=self.dilation_)
+        y = isotypic_block_apply(self.iso_in.to_spectral(x, dim=1), W, self.iso_in, self.iso_out, conv, dim=1)
+        y = self.iso_out.from_spectral(y, dim=1)
+        bias = self.bias
+        return y if bias is None else y + bias.unsqueeze(-1)
+
+    def set_isotypic_mode(self, enabled=True):
+        """
+        Enables/disables the execution of the convolution as independent convolutions between the isotypic components
+        of the input and output channel representations. Parameters are unchanged.
+        """
+        if enabled:
+            assert self.groups_ == 1, "Isotypic execution mode requires `groups=1`"
+            device = self.basis_coeff.device
+            self.iso_in = IsotypicBasis(self.rep_in.G).to(device)
+            self.iso_out = IsotypicBasis(self.rep_out.G).to(device)
+        else:
+            self.iso_in, self.iso_out = None, None
+        self._spectral_weight_cache.invalidate()
+
     @property
     def weight(self):
-        # if self._new_coeff:
-        self._weight = torch.matmul(self.basis, self.basis_coeff).reshape((self.rep_out.G.d, self.rep_in.G.d, self.kernel_size_))
-        self._new_coeff = False
+        if is_compiling():
+            return self._materialize_weight()
+        if self._new_coeff:
+            self._weight_cache.invalidate()
+            self._spectral_weight_cache.invalidate()
+            self._new_coeff = False
+        self._weight = self._weight_cache(self._materialize_weight, self.basis_coeff)
         return self._weight
 
     @property
     def bias(self):
-        if self.bias_basis is not None:
-            # if self._new_bias_coeff:
-            self._bias = torch.matmul(self.bias_basis, self.bias_basis_coeff).reshape((self.rep_out.G.d,))
-            self._new_bias_coeff = False
+        if self.bias_basis_coeff is not None:
+            if is_compiling():
+                return self._materialize_bias()
+            if self._new_bias_coeff:
+                self._bias_cache.invalidate()
+                self._new_bias_coeff = False
+            self._bias = self._bias_cache(self._materialize_bias, self.bias_basis_coeff)
             return self._bias
         return None
 
+    @profiled_assembly
+    def _materialize_weight(self):
+        if self.basis_orbit_idx is not None:
+            w = orbit_basis_expand(self.basis_coeff, self.basis_orbit_idx, self.basis_orbit_sign)
+        else:
+            w = basis_matmul(self.basis, self.basis_coeff)
+        return w.reshape((self.rep_out.G.d, self.rep_in.G.d, self.kernel_size_))
+
+    @profiled_assembly
+    def _materialize_bias(self):
+        if self.bias_basis_orbit_idx is not None:
+            b = orbit_basis_expand(self.bias_basis_coeff, self.bias_basis_orbit_idx, self.bias_basis_orbit_sign)
+        else:
+            b = basis_matmul(self.bias_basis, self.bias_basis_coeff)
+        return b.reshape((self.rep_out.G.d,))
+
+    def _materialize_spectral_weight(self):
+        return self.iso_out.to_spectral(self.iso_in.to_spectral(self.weight, dim=1), dim=0)   # T_out W[..., k] T_in^T
+
+    def example_input(self, batch_size: int = 1) -> torch.Tensor:
+        return torch.randn((batch_size, self.rep_in.G.d, self.kernel_size_), device=self.basis_coeff.device,
+                           dtype=self.basis_coeff.dtype)
+
+    def __getstate__(self):
+        return drop_transient_state(super().__getstate__())
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        drop_derived_state(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def to_frozen(self) -> torch.nn.Conv1d:
+        """ Returns a `torch.nn.Conv1d` layer holding the materialized kernel and bias. """
+        W, bias = self.weight, self.bias
+        conv = torch.nn.Conv1d(in_channels=self.rep_in.G.d, out_channels=self.rep_out.G.d,
+                               kernel_size=self.kernel_size_, stride=self.stride_, padding=self.padding_,
+                               dilation=self.dilation_, groups=self.groups_, bias=bias is not None)
+        conv = conv.to(device=W.device, dtype=W.dtype)
+        conv.weight.copy_(W)
+        if bias is not None:
+            conv.bias.copy_(bias)
+        return conv
+
     def reset_parameters(self, mode="fan_in", activation="ReLU"):
         # Compute the constant coming from the derivative of the activation. Torch return the square root of this value
         gain = torch.nn.init.calculate_gain(nonlinearity=activation.lower())
@@ -115,7 +197,7 @@ class BasisConv1d(torch.nn.Module):
 
         prev_basis_coeff = torch.clone(self.basis_coeff)
         torch.nn.init.uniform_(self.basis_coeff, -bound, bound)
-        if self.bias_basis is not None:
+        if self.bias_basis_coeff is not None:
             torch.nn.init.zeros_(self.bias_basis_coeff)
 
         self._new_coeff, self._new_bias_coeff = True, True
@@ -123,6 +205,6 @@ class BasisConv1d(torch.nn.Module):
 
     def __repr__(self):
         string = f"E-Conv1D G[{self.repW.G}]-W{self.rep_out.size() * self.rep_in.size()}-" \
-                 f"Wtrain:{self.basis.shape[-1]}={self.basis_coeff.shape[0] / np.prod(self.repW.size()) * 100:.1f}%" \
-                 f"-init_std:{self.init_std:.3f}"
+                 f"Wtrain:{self.n_basis}={self.basis_coeff.shape[0] / np.prod(self.repW.size()) * 100:.1f}%" \
+                 f"-init_std:{self.init_std:.3f}-{self.basis_storage}"
         return string
\ No newline at end of file
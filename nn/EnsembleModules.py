@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vectorized ensembles of `EMLP`/`MLP` models with identical architecture (e.g. the same model trained from several
+seeds). The parameters of the members are stacked along a leading ensemble dimension and all members are evaluated
+with a single batched matmul per layer, sharing the (non-trainable) bases of the equivariant layers.
+"""
+import copy
+from typing import Sequence
+
+import torch
+
+from nn.EquivariantModules import BasisLinear, EquivariantBlock, LinearBlock, basis_matmul, is_compiling
+
+
+class EnsembleLinear(torch.nn.Module):
+    """
+    Stack of `BasisLinear` or `torch.nn.Linear` layers of the same shape. Maps `(E, B, d_in)` to `(E, B, d_out)` tensors.
+    """
+
+    def __init__(self, layers: Sequence[torch.nn.Module]):
+        super().__init__()
+        layer = layers[0]
+        assert all(type(l) == type(layer) for l in layers), "Ensemble layers must be of the same type"
+        self._layers = list(layers)  # Member layers, not registered as submodules.
+        self.equivariant = isinstance(layer, BasisLinear)
+        if self.equivariant:
+            assert not any(l.unfrozed_equivariance or l.iso_in is not None for l in layers), \
+                "Ensembles of unfrozen or isotypic layers are not supported"
+            self.d_in, self.d_out = layer.rep_in.G.d, layer.rep_out.G.d
+            # Bases are identical for all members, share the ones of the first layer.
+            for name in ('basis', 'bias_basis'):
+                for key in (name, f'{name}_orbit_idx', f'{name}_orbit_sign'):
+                    self.register_buffer(key, getattr(layer, key), persistent=False)
+            self.basis_coeff = torch.nn.Parameter(torch.stack([l.basis_coeff.detach() for l in layers]))
+            has_bias = layer.bias_basis_coeff is not None
+            self.bias_basis_coeff = torch.nn.Parameter(
+                torch.stack([l.bias_basis_coeff.detach() for l in layers])) if has_bias else None
+        elif isinstance(layer, torch.nn.Linear):
+            self.d_in, self.d_out = layer.in_features, layer.out_features
+            self.w = torch.nn.Parameter(torch.stack([l.weight.detach() for l in layers]))
+            has_bias = layer.bias is not None
+            self.b = torch.nn.Parameter(torch.stack([l.bias.detach() for l in layers])) if has_bias else None
+        else:
+            raise NotImplementedError(f"Ensemble of {layer.__class__.__name__} layers not supported")
+
+    @property
+    def ensemble_size(self) -> int:
+        return len(self._layers)
+
+    def _expand(self, coeff: torch.Tensor, name: str) -> torch.Tensor:
+        """ Batched basis expansion `(E, n_basis) -> (E, n)` of the stacked coefficients. """
+        orbit_idx = getattr(self, f'{name}_orbit_idx')
+        if orbit_idx is not None:
+            return torch.index_select(coeff, 1, orbit_idx) * getattr(self, f'{name}_orbit_sign').to(coeff.dtype)
+        return basis_matmul(getattr(self, name), coeff.T).T
+
+    @property
+    def weight(self) -> torch.Tensor:
+        """ (E, d_out, d_in) weights of the members. """
+        if not self.equivariant:
+            return self.w
+        return self._expand(self.basis_coeff, 'basis').reshape((-1, self.d_out, self.d_in))
+
+    @property
+    def bias(self):
+        """ (E, d_out) biases of the members, or None. """
+        if not self.equivariant:
+            return self.b
+        if self.bias_basis_coeff is None:
+            return None
+        return self._expand(self.bias_basis_coeff, 'bias_basis')
+
+    def forward(self, x):
+        bias = self.bias
+        if bias is None:
+            return torch.bmm(x, self.weight.transpose(1, 2))
+        return torch.baddbmm(bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+
+    @torch.no_grad()
+    def write_member(self, i: int):
+        """ Copies the parameters of the i-th member back into its layer. """
+        layer = self._layers[i]
+        if self.equivariant:
+            layer.basis_coeff.copy_(self.basis_coeff[i])
+            if self.bias_basis_coeff is not None:
+                layer.bias_basis_coeff.copy_(self.bias_basis_coeff[i])
+            layer._new_coeff, layer._new_bias_coeff = True, True
+        else:
+            layer.weight.copy_(self.w[i])
+            if self.b is not None:
+                layer.bias.copy_(self.b[i])
+
+    def __repr__(self):
+        kind = "E-Linear" if self.equivariant else "Linear"
+        return f"Ensemble[{self.ensemble_size}]-{kind}({self.d_in}, {self.d_out})"
+
+
+def ensemble_module(modules: Sequence[torch.nn.Module]) -> torch.nn.Module:
+    """ Vectorized counterpart of a module of the `net` of `EMLP`/`MLP`, from the modules of all members. """
+    module = modules[0]
+    if isinstance(module, (EquivariantBlock, LinearBlock)):
+        return torch.nn.Sequential(EnsembleLinear([m.linear for m in modules]), copy.deepcopy(module.activation))
+    if isinstance(module, (BasisLinear, torch.nn.Linear)):
+        return EnsembleLinear(modules)
+    # Parameter free modules (e.g. activations, dropout) act elementwise over the ensemble dimension.
+    assert len(list(module.parameters())) == 0, f"Ensemble of {module.__class__.__name__} not supported"
+    return copy.deepcopy(module)
+
+
+class ModelEnsemble(torch.nn.Module):
+    """
+    Ensemble of `EMLP`/`MLP` models of identical architecture, trained as a single vectorized model. Members keep their
+    own (initial) parameters, so an ensemble of models built with different seeds trains each member exactly as it
+    would be trained alone when the loss is the sum of the member losses (the member parameters are disjoint), except
+    for the order of the training batches, which is shared by all the members.
+    """
+
+    def __init__(self, models: Sequence[torch.nn.Module]):
+        super().__init__()
+        assert len(models) > 0
+        model_cls = models[0].__class__
+        assert all(m.__class__ == model_cls for m in models), "Ensemble members must be of the same class"
+        self._members = list(models)  # Member models, not registered as submodules.
+        self.net = torch.nn.Sequential(*[ensemble_module(modules) for modules in zip(*[m.net for m in models])])
+        # Members are not called by the ensemble, their deferred ("lazy") equivariance checks run on its first forward.
+        self._members_check_hook = self.register_forward_pre_hook(self._verify_members_on_first_forward)
+
+    def _verify_members_on_first_forward(self, _module, _inputs):
+        if is_compiling():
+            return
+        for model in self._members:
+            if getattr(model, 'equivariance_check', 'off') == 'lazy' and not model.equivariance_verified:
+                model.verify_equivariance()
+        self._members_check_hook.remove()
+        self._members_check_hook = None
+
+    @property
+    def ensemble_size(self) -> int:
+        return len(self._members)
+
+    @property
+    def model_class(self):
+        return self._members[0].__class__.__name__
+
+    def forward(self, x):
+        """
+        :param x: (B, d_in) input shared by all members or (E, B, d_in) input of each member.
+        :return: (E, B, d_out) prediction of each member.
+        """
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.ensemble_size, *x.shape)
+        return self.net(x)
+
+    def member(self, i: int) -> torch.nn.Module:
+        """ Returns the i-th member model holding the current (trained) parameters of the ensemble. """
+        for module in self.net.modules():
+            if isinstance(module, EnsembleLinear):
+                module.write_member(i)
+        return self._members[i]
+
+    def get_hparams(self) -> dict:
+        hparams = self._members[0].get_hparams() if hasattr(self._members[0], "get_hparams") else {}
+        hparams['ensemble_size'] = self.ensemble_size
+        return hparams
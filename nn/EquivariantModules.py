@@ -4,10 +4,13 @@
 # @Author  : Daniel Ordonez 
 # @email   : daniels.ordonez@gmail.com
 # Some code was adapted from https://github.com/ElisevanderPol/symmetrizer/blob/master/symmetrizer/nn/modules.py
+import copy
 import itertools
 import logging
 import math
 import pathlib
+import time
+from collections import OrderedDict
 from typing import Union, Optional
 from zipfile import BadZipFile
 
@@ -19,18 +22,302 @@ from emlp.reps.representation import Rep, Vector
 from emlp.reps.representation import Base as BaseRep
 from scipy.sparse import issparse
 
-from groups.SemiDirectProduct import SemiDirectProduct, SparseRep
-from utils.emlp_cache import EMLPCache
-from utils.utils import slugify, coo2torch_coo
+from groups.SemiDirectProduct import SemiDirectProduct, SparseRep, presolve_equivariant_bases
+from groups.SymmetricGroups import Sym
+from nn.FrozenModules import FrozenEMLP
+from nn.LayerProfiler import LayerProfiler, profiled_assembly
+from utils.emlp_cache import EMLPCache, cache_key
+from utils.utils import slugify, coo2orbit_index, sparse2gather, sparse2torch
 
 log = logging.getLogger(__name__)
 
 
+def is_compiling() -> bool:
+    """ True while `torch.compile` traces a module, where Python side state (caches, debug tensors) is bypassed. """
+    compiler = getattr(torch, 'compiler', None)
+    if compiler is not None and hasattr(compiler, 'is_compiling'):
+        return compiler.is_compiling()
+    return torch._dynamo.is_compiling()
+
+
+def assembly_dtype(t: torch.Tensor) -> torch.dtype:
+    """
+    Dtype of the weights assembled from the parameter `t`. Under autocast (e.g. bfloat16 CPU mixed precision) weights
+    are assembled in the autocast dtype of the matmul/conv consuming them, while parameters keep their own dtype.
+    """
+    if t.device.type == "cpu" and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    if t.device.type == "cuda" and torch.is_autocast_enabled():
+        return torch.get_autocast_gpu_dtype()
+    return t.dtype
+
+
+class OrbitBasisExpand(torch.autograd.Function):
+    """
+    `W = sign * coeff[orbit_idx]`, for bases with a single non-zero per row (see `coo2orbit_index`). The gradient of
+    each coefficient is the signed sum of `dW` over its orbit, computed with a single scatter (segment) reduction
+    instead of the `basis.T @ dW` product of the dense basis. `W` is built in `dtype`, while the reduction of the
+    gradient is accumulated in the dtype of the coefficients.
+    """
+
+    @staticmethod
+    def forward(ctx, coeff: torch.Tensor, orbit_idx: torch.Tensor, orbit_sign: torch.Tensor, dtype: torch.dtype):
+        sign = orbit_sign if coeff.ndim == 1 else orbit_sign.unsqueeze(-1)
+        ctx.save_for_backward(orbit_idx, sign)
+        ctx.n_basis, ctx.dtype = coeff.shape[0], coeff.dtype
+        return torch.index_select(coeff.to(dtype), 0, orbit_idx) * sign.to(dtype)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_w: torch.Tensor):
+        orbit_idx, sign = ctx.saved_tensors
+        grad_coeff = grad_w.new_zeros((ctx.n_basis,) + tuple(grad_w.shape[1:]), dtype=ctx.dtype)
+        grad_coeff.index_add_(0, orbit_idx, grad_w.to(ctx.dtype) * sign.to(ctx.dtype))
+        return grad_coeff, None, None, None
+
+
+def orbit_basis_expand(coeff: torch.Tensor, orbit_idx: torch.Tensor, orbit_sign: torch.Tensor):
+    """
+    Gather-based equivalent of `basis @ coeff` for bases with a single non-zero per row (see `coo2orbit_index`).
+    :param coeff: (n_basis,) or (n_basis, k) basis coefficients.
+    :param orbit_idx: (n,) index of the basis vector (orbit) each entry belongs to.
+    :param orbit_sign: (n,) signed value of the single non-zero entry of each row of the basis.
+    :return: (n,) or (n, k) flattened weights, in the `assembly_dtype` of the coefficients.
+    """
+    dtype = assembly_dtype(coeff)
+    if is_compiling():  # Let the compiler derive (and fuse) the scatter backward of the gather.
+        sign = orbit_sign if coeff.ndim == 1 else orbit_sign.unsqueeze(-1)
+        return torch.index_select(coeff.to(dtype), 0, orbit_idx) * sign.to(dtype)
+    return OrbitBasisExpand.apply(coeff, orbit_idx, orbit_sign, dtype)
+
+
+class MaterializationCache:
+    """
+    Caches a tensor materialized from parameters (e.g. `W = basis @ basis_coeff`), keyed on the version counter,
+    storage, device and dtype of the parameters. Optimizer steps and `load_state_dict` modify the parameters in-place,
+    increasing their version counter and thus invalidating the cache. When autograd has to record the
+    materialization the tensor is always rebuilt, as the graph of a cached tensor is freed by the first backward pass.
+    Under `torch.compile` the tensor is also rebuilt, so its materialization is part of (and fused into) the graph.
+    """
+
+    def __init__(self):
+        self.key, self.value = None, None
+
+    def invalidate(self):
+        self.key, self.value = None, None
+
+    def __call__(self, build, *tensors: torch.Tensor):
+        if is_compiling():
+            return build()
+        if torch.is_grad_enabled() and any(t.requires_grad for t in tensors):
+            self.invalidate()
+            return build()
+        key = (torch.is_inference_mode_enabled(), assembly_dtype(tensors[0])) + \
+            tuple((t._version, t.data_ptr(), t.device, t.dtype) for t in tensors)
+        if key != self.key:
+            self.value, self.key = build(), key
+        return self.value
+
+
+def act_signed_permutation(x: torch.Tensor, perm: torch.Tensor, sign: torch.Tensor, dim: int):
+    """ Action `(ρ(g) x)[i] = sign[i] x[perm[i]]` of a signed permutation on dimension `dim` of `x`. """
+    shape = [1] * x.ndim
+    shape[dim] = -1
+    return torch.index_select(x, dim, perm) * sign.reshape(shape)
+
+
+def gather_transform(x: torch.Tensor, idx: torch.Tensor, coef: torch.Tensor, dim: int):
+    """
+    Applies a sparse matrix `M`, in gather form (see `sparse2gather`), to dimension `dim` of `x`.
+    `y.select(dim, i) = sum_k coef[i, k] * x.select(dim, idx[i, k])`
+    """
+    dim = dim % x.ndim
+    x_g = torch.index_select(x, dim, idx.flatten()).unflatten(dim, idx.shape)
+    shape = [1] * x_g.ndim
+    shape[dim], shape[dim + 1] = idx.shape
+    return torch.sum(x_g * coef.reshape(shape), dim=dim + 1)
+
+
+class IsotypicBasis(torch.nn.Module):
+    """
+    Orthogonal change of basis `T` of a representation to its isotypic decomposition (see `Sym.isotypic_basis`).
+    `T` has at most |G| non-zeros per row, so it is applied with gathers. Coordinates of each isotypic component are
+    contiguous and given by `slices`.
+    """
+
+    def __init__(self, G):
+        super().__init__()
+        T, dims = G.isotypic_basis()
+        idx, coef = sparse2gather(T)
+        inv_idx, inv_coef = sparse2gather(T.T)
+        self.register_buffer('idx', idx, persistent=False)
+        self.register_buffer('coef', coef, persistent=False)
+        self.register_buffer('inv_idx', inv_idx, persistent=False)
+        self.register_buffer('inv_coef', inv_coef, persistent=False)
+        bounds = np.cumsum([0] + list(dims))
+        self.slices = [slice(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def to_spectral(self, x: torch.Tensor, dim: int = -1):
+        return gather_transform(x, self.idx, self.coef, dim)
+
+    def from_spectral(self, x: torch.Tensor, dim: int = -1):
+        return gather_transform(x, self.inv_idx, self.inv_coef, dim)
+
+
+def isotypic_block_apply(x: torch.Tensor, W: torch.Tensor, iso_in: IsotypicBasis, iso_out: IsotypicBasis, op,
+                         dim: int):
+    """
+    Applies the block diagonal map `W = diag(W_χ0, W_χ1, ...)` (in spectral basis) block by block.
+    :param x: Input in the spectral basis of `iso_in`, with channels in dimension `dim`.
+    :param W: Weight in spectral basis, with output/input channels in dimensions 0 and 1.
+    :param op: Callable `op(x_χ, W_χ)`, e.g. `F.linear` or `F.conv1d`.
+    :return: Output in the spectral basis of `iso_out`.
+    """
+    blocks = {}
+    for n, (o, i) in enumerate(zip(iso_out.slices, iso_in.slices)):
+        if o.stop > o.start and i.stop > i.start:
+            blocks[n] = op(x.narrow(dim, i.start, i.stop - i.start), W[o, i])
+    assert len(blocks) > 0, "Equivariant map is identically zero"
+    ref = next(iter(blocks.values()))
+    out = []
+    for n, o in enumerate(iso_out.slices):
+        if o.stop == o.start:
+            continue
+        if n in blocks:
+            out.append(blocks[n])
+        else:  # Isotypic component absent in the input, and thus in the image of W.
+            shape = list(ref.shape)
+            shape[dim] = o.stop - o.start
+            out.append(ref.new_zeros(shape))
+    return torch.cat(out, dim=dim)
+
+
+def frozen_copy(module: torch.nn.Module) -> torch.nn.Module:
+    """
+    Copy of `module` where every equivariant layer (defining `to_frozen`) is replaced by its plain PyTorch counterpart.
+    """
+    if hasattr(module, 'to_frozen'):
+        return module.to_frozen()
+    if isinstance(module, torch.nn.Sequential):
+        return torch.nn.Sequential(*[frozen_copy(m) for m in module])
+    return copy.deepcopy(module)
+
+
+# Storage of the layer bases: "orbit" index/sign buffers (bases with a single non-zero per row), or a "dense", "csr" or
+# "coo" basis matrix. "auto" picks orbit storage when possible, and otherwise decides from the basis density and size
+# and a micro-benchmark of the basis expansion (see `auto_basis_storage`).
+BASIS_STORAGES = ("auto", "orbit", "dense", "csr", "coo")
+MAX_DENSE_BASIS_BYTES = 2 ** 28  # Larger bases are never stored dense.
+DENSE_BASIS_DENSITY = 0.25  # Denser bases are stored dense without benchmarking.
+
+
+def basis_matmul(basis: torch.Tensor, coeff: torch.Tensor) -> torch.Tensor:
+    """ `basis @ coeff` for dense, CSR and COO bases, with `coeff` of shape (b,) or (b, k). """
+    if basis.layout == torch.strided:
+        return torch.matmul(basis, coeff.reshape(basis.shape[-1], -1))
+    # Sparse matmuls have no reduced precision kernels, run them in the dtype of the basis.
+    with torch.autocast(device_type=basis.device.type, enabled=False):
+        return torch.matmul(basis, coeff.to(basis.dtype).reshape(basis.shape[-1], -1))
+
+
+def benchmark_basis_storage(Q, layouts, n_cols=1, iters=10) -> dict:
+    """
+    Times the expansion of the basis `Q @ coeff` (forward and backward) for each tensor layout.
+    :param n_cols: Columns of the coefficients, e.g. the kernel size of a convolution.
+    :return: Dictionary `{layout: seconds per iteration}`, without the layouts unsupported by the torch build.
+    """
+    coeff = torch.randn((Q.shape[-1], n_cols), requires_grad=True)
+    timings = {}
+    for layout in layouts:
+        try:
+            basis = sparse2torch(Q, layout)
+            basis_matmul(basis, coeff).sum().backward()  # Warm up
+            start = time.perf_counter()
+            for _ in range(iters):
+                basis_matmul(basis, coeff).sum().backward()
+            timings[layout] = (time.perf_counter() - start) / iters
+        except (RuntimeError, NotImplementedError) as e:
+            log.debug(f"Basis storage {layout} not supported: {e}")
+    return timings
+
+
+def auto_basis_storage(Q, n_cols=1) -> str:
+    """
+    Tensor layout of a basis matrix without orbit structure. Dense storage is used for dense bases, sparse storage
+    for bases whose dense matrix would exceed `MAX_DENSE_BASIS_BYTES`, and otherwise the fastest layout is measured.
+    """
+    numel = np.prod(Q.shape)
+    density = (Q.getnnz() if issparse(Q) else np.count_nonzero(Q)) / numel
+    if numel * 4 > MAX_DENSE_BASIS_BYTES:
+        layouts = ("csr", "coo")
+    elif density >= DENSE_BASIS_DENSITY:
+        return "dense"
+    else:
+        layouts = ("dense", "csr", "coo")
+    timings = benchmark_basis_storage(Q, layouts, n_cols=n_cols)
+    storage = min(timings, key=timings.get) if len(timings) > 0 else "coo"
+    log.debug(f"Basis {Q.shape} density {density:.2e}: {storage} storage, timings {timings}")
+    return storage
+
+
+def register_basis(module: torch.nn.Module, name: str, Q, storage="auto", n_cols=1) -> Optional[str]:
+    """
+    Registers the basis `Q` in `module` either as orbit index/sign buffers `{name}_orbit_idx`, `{name}_orbit_sign`
+    (when each row of `Q` has a single non-zero entry) or as a dense/CSR/COO buffer `{name}`. Bases are derived from
+    the layer representations, so they are not persistent, i.e. not stored in the module `state_dict`.
+    :param Q: Basis matrix, or None for a layer without the basis (e.g. without bias).
+    :param storage: One of `BASIS_STORAGES`.
+    :param n_cols: Columns of the coefficients the basis is applied to, used to benchmark the storage layouts.
+    :return: The storage used, or None if `Q` is None.
+    """
+    if storage not in BASIS_STORAGES:
+        raise ValueError(f"Unknown basis storage {storage}, expected one of {BASIS_STORAGES}")
+    orbit, basis = None, None
+    if Q is not None:
+        Q = Q if issparse(Q) else np.asarray(Q)
+        if storage in ("auto", "orbit"):
+            orbit = coo2orbit_index(Q)
+        if storage == "orbit" and orbit is None:
+            raise ValueError(f"Basis {name} {Q.shape} has rows with more than one non-zero, orbit storage not possible")
+        if orbit is not None:
+            storage = "orbit"
+        else:
+            storage = auto_basis_storage(Q, n_cols) if storage == "auto" else storage
+            basis = sparse2torch(Q, layout=storage)
+    module.register_buffer(name, basis, persistent=False)
+    module.register_buffer(f'{name}_orbit_idx', None if orbit is None else orbit[0], persistent=False)
+    module.register_buffer(f'{name}_orbit_sign', None if orbit is None else orbit[1], persistent=False)
+    return None if Q is None else storage
+
+
+# Module attributes referencing the last materialized weights and pre-activations, for logging and debugging. These
+# can be non-leaf tensors of an autograd graph, which cannot be deep-copied nor pickled.
+TRANSIENT_TENSORS = ('_weight', '_bias', '_preact')
+
+
+def drop_transient_state(state: dict) -> dict:
+    """ Clears the `TRANSIENT_TENSORS` of the `__dict__` of a module, see `BasisLinear.__getstate__`. """
+    for name in TRANSIENT_TENSORS:
+        if state.get(name, None) is not None:
+            state[name] = None
+    return state
+
+
+def drop_derived_state(state_dict: dict, prefix: str):
+    """
+    Removes the (derived) bases of a layer from a `state_dict` saved before bases were made non-persistent.
+    """
+    for name in ('basis', 'bias_basis'):
+        for key in (name, f'{name}_orbit_idx', f'{name}_orbit_sign'):
+            state_dict.pop(prefix + key, None)
+
+
 class BasisLinear(torch.nn.Module):
     """
     Group-equivariant linear layer
     """
-    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, bias=True):
+    rep_dim = -1
+    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, bias=True, basis_storage="auto"):
         super().__init__()
 
         # TODO: Add parameter for direct/whreat product
@@ -40,28 +327,33 @@ class BasisLinear(torch.nn.Module):
         self.rep_out = rep_out
 
         self._new_coeff, self._new_bias_coeff = True, True
+        self._weight_cache, self._bias_cache = MaterializationCache(), MaterializationCache()
+        self._spectral_weight_cache = MaterializationCache()
         # Layer can be "unfreeze" and thus keep variable in case that happens.
         self.unfrozed_equivariance = False
         self.unfrozen_w = None
         self.unfrozen_bias = None
+        self._weight, self._bias = None, None  # Last materialized weight and bias, see `TRANSIENT_TENSORS`.
+        # Isotypic (block diagonal) execution mode, see `set_isotypic_mode`.
+        self.iso_in, self.iso_out = None, None
 
         # Compute the nullspace
         Q = self.repW.equivariant_basis()
         self._sum_basis_sqrd = Q.power(2).sum() if issparse(Q) else np.sum(np.power(Q, 2))
-        basis = coo2torch_coo(Q) if issparse(Q) else torch.tensor(np.asarray(Q))
-        self.basis = torch.nn.Parameter(basis, requires_grad=False)
+        self.n_basis = Q.shape[-1]
+        # Signed-permutation groups yield bases with a single non-zero per row, stored as orbit indices and signs.
+        self.basis_storage = register_basis(self, 'basis', Q, storage=basis_storage)
 
         # Create the network parameters. Coefficients for each base and a b
-        self.basis_coeff = torch.nn.Parameter(torch.randn((self.basis.shape[-1])))
+        self.basis_coeff = torch.nn.Parameter(torch.randn((self.n_basis,)))
 
         if bias:
             Qbias = rep_out.equivariant_basis()
-            bias_basis = coo2torch_coo(Qbias) if issparse(Qbias) else torch.tensor(np.asarray(Qbias))
-            self.bias_basis = torch.nn.Parameter(bias_basis, requires_grad=False)
-            self.bias_basis_coeff = torch.nn.Parameter(torch.randn((self.bias_basis.shape[-1])))
-            self._bias = self.bias
+            self.bias_basis_storage = register_basis(self, 'bias_basis', Qbias, storage=basis_storage)
+            self.bias_basis_coeff = torch.nn.Parameter(torch.randn((Qbias.shape[-1],)))
         else:
-            self.bias_basis, self.bias_basis_coeff = None, None
+            self.bias_basis_storage = register_basis(self, 'bias_basis', None)
+            self.bias_basis_coeff = None
 
         # TODO: Check if necessary
         # self.proj_b = torchify_fn(jit(lambda b: self.P_bias @ b))
@@ -69,10 +361,6 @@ class BasisLinear(torch.nn.Module):
         self.init_std = None
         self.reset_parameters()
 
-        # Check Equivariance.
-        EquivariantModel.test_module_equivariance(module=self, rep_in=self.rep_in, rep_out=self.rep_out)
-        # Add hook to backward pass
-        self.register_full_backward_hook(EquivariantModel.backward_hook)
 
 
 
@@ -80,16 +368,48 @@ class BasisLinear(torch.nn.Module):
         """
         Normal forward pass, using weights formed by the basis and corresponding coefficients
         """
-        if x.device != self.weight.device:
-            self._new_coeff, self._new_bias_coeff = True, True
+        if self.iso_in is not None and not self.unfrozed_equivariance:
+            return self.isotypic_forward(x)
         return F.linear(x, weight=self.weight, bias=self.bias)
 
+    def isotypic_forward(self, x):
+        """
+        Forward pass in the isotypic basis, where W is block diagonal. x is transformed in and out of the spectral
+        basis by every layer: the pointwise non-linearities applied on the output commute with the (signed) permutations
+        of the original basis but not with the spectral change of basis, so the hidden features cannot stay spectral.
+        The block matmuls need up to |G|x fewer multiplications than the dense one, which these two transforms, the
+        slicing and the concatenation of the blocks eat up at the layer sizes of this repo (see
+        `benchmarks/isotypic_throughput.py`).
+        """
+        W = self._spectral_weight_cache(self._materialize_spectral_weight, self.basis_coeff)
+        y = isotypic_block_apply(self.iso_in.to_spectral(x, dim=-1), W, self.iso_in, self.iso_out, F.linear, dim=-1)
+        y = self.iso_out.from_spectral(y, dim=-1)
+        bias = self.bias
+        return y if bias is None else y + bias
+
+    def set_isotypic_mode(self, enabled=True):
+        """
+        Enables/disables the execution of the layer as independent dense maps between the isotypic components of the
+        input and output representations. Parameters are unchanged, only the execution of the layer is affected.
+        """
+        if enabled:
+            device = self.basis_coeff.device
+            self.iso_in = IsotypicBasis(self.rep_in.G).to(device)
+            self.iso_out = IsotypicBasis(self.rep_out.G).to(device)
+        else:
+            self.iso_in, self.iso_out = None, None
+        self._spectral_weight_cache.invalidate()
+
     @property
     def weight(self):
         if not self.unfrozed_equivariance:
-            # if self._new_coeff or self._weight is None:
-            self._weight = torch.matmul(self.basis, self.basis_coeff).reshape((self.rep_out.G.d, self.rep_in.G.d))
-            # self._new_coeff = False
+            if is_compiling():
+                return self._materialize_weight()
+            if self._new_coeff:
+                self._weight_cache.invalidate()
+                self._spectral_weight_cache.invalidate()
+                self._new_coeff = False
+            self._weight = self._weight_cache(self._materialize_weight, self.basis_coeff)
             return self._weight
         else:
             return self.unfrozen_w
@@ -97,15 +417,37 @@ class BasisLinear(torch.nn.Module):
     @property
     def bias(self):
         if not self.unfrozed_equivariance:
-            if self.bias_basis is not None:
-                # if self._new_bias_coeff or self._bias is None:
-                self._bias = torch.matmul(self.bias_basis, self.bias_basis_coeff).reshape((self.rep_out.G.d,))
-                self._new_bias_coeff = False
+            if self.bias_basis_coeff is not None:
+                if is_compiling():
+                    return self._materialize_bias()
+                if self._new_bias_coeff:
+                    self._bias_cache.invalidate()
+                    self._new_bias_coeff = False
+                self._bias = self._bias_cache(self._materialize_bias, self.bias_basis_coeff)
                 return self._bias
             return None
         else:
             return self.unfrozen_bias
 
+    @profiled_assembly
+    def _materialize_weight(self):
+        if self.basis_orbit_idx is not None:
+            w = orbit_basis_expand(self.basis_coeff, self.basis_orbit_idx, self.basis_orbit_sign)
+        else:
+            w = basis_matmul(self.basis, self.basis_coeff)
+        return w.reshape((self.rep_out.G.d, self.rep_in.G.d))
+
+    @profiled_assembly
+    def _materialize_bias(self):
+        if self.bias_basis_orbit_idx is not None:
+            b = orbit_basis_expand(self.bias_basis_coeff, self.bias_basis_orbit_idx, self.bias_basis_orbit_sign)
+        else:
+            b = basis_matmul(self.bias_basis, self.bias_basis_coeff)
+        return b.reshape((self.rep_out.G.d,))
+
+    def _materialize_spectral_weight(self):
+        return self.iso_out.to_spectral(self.iso_in.to_spectral(self.weight, dim=1), dim=0)   # T_out W T_in^T
+
     def reset_parameters(self, mode="fan_in", activation="ReLU"):
         if self.unfrozed_equivariance:
             raise BrokenPipeError("initialization called after unfrozed equivariance")
@@ -140,6 +482,21 @@ class BasisLinear(torch.nn.Module):
         self._new_coeff, self._new_bias_coeff = True, True
         assert not torch.allclose(prev_basis_coeff, self.basis_coeff), "Ups, smth is wrong."
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        drop_derived_state(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def to_frozen(self) -> torch.nn.Linear:
+        """ Returns a `torch.nn.Linear` layer holding the materialized weight and bias. """
+        W, bias = self.weight, self.bias
+        linear = torch.nn.Linear(in_features=self.rep_in.G.d, out_features=self.rep_out.G.d, bias=bias is not None)
+        linear = linear.to(device=W.device, dtype=W.dtype)
+        linear.weight.copy_(W)
+        if bias is not None:
+            linear.bias.copy_(bias)
+        return linear
+
     def unfreeze_equivariance(self):
         w, bias = self.weight, self.bias
         self.unfrozed_equivariance = True
@@ -151,42 +508,257 @@ class BasisLinear(torch.nn.Module):
 
     def __repr__(self):
         string = f"E-Linear G[{self.repW.G}]-W{self.rep_out.size() * self.rep_in.size()}-" \
-                 f"Wtrain:{self.basis.shape[-1]}={self.basis_coeff.shape[0] / np.prod(self.repW.size()) * 100:.1f}%" \
-                 f"-init_std:{self.init_std:.3f}"
+                 f"Wtrain:{self.n_basis}={self.basis_coeff.shape[0] / np.prod(self.repW.size()) * 100:.1f}%" \
+                 f"-init_std:{self.init_std:.3f}-{self.basis_storage}"
         return string
 
+    def __getstate__(self):
+        # Used by `copy.deepcopy` (e.g. `from_template`) and pickling, the last weight/bias may be part of a graph.
+        return drop_transient_state(super().__getstate__())
+
     def to(self, *args, **kwargs):
         # When device or type changes tensors need updating.
         self._new_bias_coeff, self._new_coeff = True, True
         return super(BasisLinear, self).to(*args, **kwargs)
 
+    def example_input(self, batch_size: int = 1) -> torch.Tensor:
+        p = next(self.parameters())
+        return torch.randn((batch_size, self.rep_in.G.d), device=p.device, dtype=p.dtype)
+
+
+def reynolds_project(W: torch.Tensor, out_perm: torch.Tensor, out_sign: torch.Tensor,
+                     in_perm: Optional[torch.Tensor] = None, in_sign: Optional[torch.Tensor] = None):
+    """
+    Reynolds operator (group average) `1/|G| Σ_g ρ_out(g) W ρ_in(g)^-1` for signed-permutation representations,
+    where `(ρ(g) x)[i] = sign_g[i] x[perm_g[i]]`. Since `ρ_in(g)^-1 = ρ_in(g)^T`, each term is a gather of the rows
+    and columns of `W` scaled by the output and input signs. Without `in_perm` the output `W` is a vector (bias).
+    :param W: (d_out, d_in) or (d_out,) free tensor.
+    :param out_perm, out_sign: (|G|, d_out) one-line notation and signs of the output group actions.
+    :param in_perm, in_sign: (|G|, d_in) one-line notation and signs of the input group actions.
+    """
+    W_avg = torch.zeros_like(W)
+    for g in range(out_perm.shape[0]):
+        W_g = torch.index_select(W, 0, out_perm[g])
+        if in_perm is not None:
+            W_g = torch.index_select(W_g, 1, in_perm[g]) * in_sign[g]
+            W_avg = W_avg + out_sign[g].unsqueeze(-1) * W_g
+        else:
+            W_avg = W_avg + out_sign[g] * W_g
+    return W_avg / out_perm.shape[0]
+
+
+def actions_oneline(G: Group):
+    """ One-line notation `(|G|, d)` and signs `(|G|, d)` of all the group actions of a signed-permutation group. """
+    actions = G.signed_actions if getattr(G, 'signed_generators', None) is not None else G.discrete_actions
+    perms, signs = zip(*[Sym.matrix2oneline(g) for g in actions])
+    return torch.tensor(np.asarray(perms), dtype=torch.long), torch.tensor(np.asarray(signs), dtype=torch.float32)
+
+
+class ReynoldsLinear(torch.nn.Module):
+    """
+    Group-equivariant linear layer parametrized by a free weight matrix projected onto the space of equivariant maps
+    with the Reynolds operator (group averaging) instead of a basis of that space. No nullspace is solved at
+    construction and no basis is stored, construction is O(|G|·d_in·d_out).
+    """
+    rep_dim = -1
+    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, bias=True):
+        super().__init__()
+        self.rep_in = rep_in
+        self.rep_out = rep_out
+        assert len(rep_in.G.discrete_actions) == len(rep_out.G.discrete_actions), \
+            f"Input and output groups {rep_in.G}, {rep_out.G} have different order"
+
+        self._new_coeff, self._new_bias_coeff = True, True
+        self._weight_cache, self._bias_cache = MaterializationCache(), MaterializationCache()
+        self.unfrozed_equivariance = False
+        self.unfrozen_w = None
+        self.unfrozen_bias = None
+
+        in_perm, in_sign = actions_oneline(rep_in.G)
+        out_perm, out_sign = actions_oneline(rep_out.G)
+        for name, tensor in zip(('in_perm', 'in_sign', 'out_perm', 'out_sign'), (in_perm, in_sign, out_perm, out_sign)):
+            self.register_buffer(name, tensor, persistent=False)
+        # Dimension of the space of equivariant maps: trace of the Reynolds operator 1/|G| Σ_g tr(ρ_out(g)) tr(ρ_in(g))
+        identity_in, identity_out = torch.arange(rep_in.G.d), torch.arange(rep_out.G.d)
+        tr_in = torch.sum(in_sign * (in_perm == identity_in), dim=1)
+        tr_out = torch.sum(out_sign * (out_perm == identity_out), dim=1)
+        self.n_basis = int(torch.round(torch.mean(tr_in * tr_out)).item())
+
+        self.free_weight = torch.nn.Parameter(torch.randn((rep_out.G.d, rep_in.G.d)))
+        self.free_bias = torch.nn.Parameter(torch.randn((rep_out.G.d,))) if bias else None
+        self._weight, self._bias = None, None  # Last materialized weight and bias, see `TRANSIENT_TENSORS`.
+
+        self.init_std = None
+        self.reset_parameters()
+
+    def forward(self, x):
+        return F.linear(x, weight=self.weight, bias=self.bias)
+
+    @property
+    def weight(self):
+        if not self.unfrozed_equivariance:
+            if is_compiling():
+                return self._materialize_weight()
+            if self._new_coeff:
+                self._weight_cache.invalidate()
+                self._new_coeff = False
+            self._weight = self._weight_cache(self._materialize_weight, self.free_weight)
+            return self._weight
+        else:
+            return self.unfrozen_w
+
+    @property
+    def bias(self):
+        if not self.unfrozed_equivariance:
+            if self.free_bias is not None:
+                if is_compiling():
+                    return self._materialize_bias()
+                if self._new_bias_coeff:
+                    self._bias_cache.invalidate()
+                    self._new_bias_coeff = False
+                self._bias = self._bias_cache(self._materialize_bias, self.free_bias)
+                return self._bias
+            return None
+        else:
+            return self.unfrozen_bias
+
+    @profiled_assembly
+    def _materialize_weight(self):
+        return reynolds_project(self.free_weight, self.out_perm, self.out_sign.to(self.free_weight.dtype),
+                                self.in_perm, self.in_sign.to(self.free_weight.dtype))
+
+    @profiled_assembly
+    def _materialize_bias(self):
+        return reynolds_project(self.free_bias, self.out_perm, self.out_sign.to(self.free_bias.dtype))
+
+    def set_isotypic_mode(self, enabled=True):
+        if enabled:
+            raise NotImplementedError("Isotypic execution mode is only available for basis parametrized layers")
+
+    def reset_parameters(self, mode="fan_in", activation="ReLU"):
+        if self.unfrozed_equivariance:
+            raise BrokenPipeError("initialization called after unfrozed equivariance")
+        gain = torch.nn.init.calculate_gain(nonlinearity=activation.lower())
+        dim_in, dim_out = self.rep_in.G.d, self.rep_out.G.d
+        # The Reynolds operator is an orthogonal projector of rank `n_basis`: projecting i.i.d. entries of variance σ²
+        # yields weights of average variance σ²·n_basis/(dim_in·dim_out). Scale σ² to match the basis parametrization.
+        lambd = self.n_basis
+        if mode.lower() == "fan_in":
+            free_weight_variance = dim_out / lambd
+        elif mode.lower() == "fan_out":
+            free_weight_variance = dim_in / lambd
+        elif mode.lower() == "harmonic_mean":
+            free_weight_variance = 2. / ((lambd / dim_out) + (lambd / dim_in))
+        elif mode.lower() == "arithmetic_mean":
+            free_weight_variance = ((dim_in + dim_out) / 2.) / lambd
+        elif "normal" in mode.lower():
+            split = mode.split('l')
+            std = 0.1 if len(split) == 1 else float(split[1])
+            torch.nn.init.normal_(self.free_weight, 0, std)
+            self._new_coeff, self._new_bias_coeff = True, True
+            return
+        else:
+            raise NotImplementedError(f"{mode} is not a recognized mode for Kaiming initialization")
+
+        self.init_std = gain * math.sqrt(free_weight_variance)
+        bound = math.sqrt(3.0) * self.init_std
+        torch.nn.init.uniform_(self.free_weight, -bound, bound)
+        self._new_coeff, self._new_bias_coeff = True, True
+
+    @torch.no_grad()
+    def to_frozen(self) -> torch.nn.Linear:
+        """ Returns a `torch.nn.Linear` layer holding the projected weight and bias. """
+        W, bias = self.weight, self.bias
+        linear = torch.nn.Linear(in_features=self.rep_in.G.d, out_features=self.rep_out.G.d, bias=bias is not None)
+        linear = linear.to(device=W.device, dtype=W.dtype)
+        linear.weight.copy_(W)
+        if bias is not None:
+            linear.bias.copy_(bias)
+        return linear
+
+    def unfreeze_equivariance(self):
+        w, bias = self.weight, self.bias
+        self.unfrozed_equivariance = True
+        self.unfrozen_w = torch.nn.Parameter(w, requires_grad=True)
+        self.register_parameter('unfrozen_w', self.unfrozen_w)
+        if bias is not None:
+            self.unfrozen_bias = torch.nn.Parameter(bias, requires_grad=True)
+            self.register_parameter('unfrozen_bias', self.unfrozen_bias)
+
+    def __repr__(self):
+        init_std = f"{self.init_std:.3f}" if self.init_std is not None else "None"
+        return f"E-Linear[Reynolds] G[{self.rep_in.G}->{self.rep_out.G}]-W{self.rep_out.size() * self.rep_in.size()}-" \
+               f"Wequiv:{self.n_basis}-init_std:{init_std}"
+
+    def __getstate__(self):
+        # Used by `copy.deepcopy` (e.g. `from_template`) and pickling, the last weight/bias may be part of a graph.
+        return drop_transient_state(super().__getstate__())
+
+    def to(self, *args, **kwargs):
+        self._new_bias_coeff, self._new_coeff = True, True
+        return super(ReynoldsLinear, self).to(*args, **kwargs)
+
+    def example_input(self, batch_size: int = 1) -> torch.Tensor:
+        p = next(self.parameters())
+        return torch.randn((batch_size, self.rep_in.G.d), device=p.device, dtype=p.dtype)
+
+
+# Parametrizations of the equivariant linear layers: a basis of the equivariant maps, or a free weight projected with
+# the Reynolds operator.
+EQUIVARIANT_LINEAR = {"basis": BasisLinear, "reynolds": ReynoldsLinear}
+
 
 class EquivariantBlock(torch.nn.Module):
 
-    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, with_bias=True, activation=torch.nn.Identity):
+    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, with_bias=True, activation=torch.nn.Identity,
+                 parametrization="basis", basis_storage="auto"):
         super(EquivariantBlock, self).__init__()
 
         # TODO: Optional Batch Normalization
-        self.linear = BasisLinear(rep_in, rep_out, with_bias)
+        linear_kwargs = {"basis_storage": basis_storage} if parametrization == "basis" else {}
+        self.linear = EQUIVARIANT_LINEAR[parametrization](rep_in, rep_out, with_bias, **linear_kwargs)
         self.activation = activation()
         self._preact = None   # Debug variable holding last linear activation Tensor, useful for logging.
-        EquivariantModel.test_module_equivariance(self, rep_in, rep_out)
 
     def forward(self, x, **kwargs):
-        self._preact = self.linear(x)
-        return self.activation(self._preact)
+        preact = self.linear(x)
+        if not is_compiling():  # Storing tensors in the module is a side effect `torch.compile` cannot trace.
+            self._preact = preact
+        return self.activation(preact)
 
     def unfreeze_equivariance(self):
         self.linear.unfreeze_equivariance()
 
+    def __getstate__(self):
+        return drop_transient_state(super().__getstate__())
+
+    def to_frozen(self) -> torch.nn.Sequential:
+        return torch.nn.Sequential(self.linear.to_frozen(), copy.deepcopy(self.activation))
+
+# Prebuilt models used by `EquivariantModel.from_template`, least recently used first.
+MODEL_TEMPLATES = OrderedDict()
+MAX_MODEL_TEMPLATES = 4
+
+# Equivariance verification of the models: "eager" checks the model and each of its layers at construction, "lazy"
+# checks the model at its first forward pass and "off" skips it (see `EquivariantModel.verify_equivariance`).
+EQUIVARIANCE_CHECKS = ("eager", "lazy", "off")
+
+
 class EquivariantModel(torch.nn.Module):
+    rep_dim = -1  # Dimension of the input/output tensors where the group acts.
+    basis_workers = None  # Processes solving the layer bases in `presolve_bases`, None uses all CPUs.
 
-    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, hidden_group: Group, cache_dir: Optional[Union[str, pathlib.Path]] = None):
+    def __init__(self, rep_in: BaseRep, rep_out: BaseRep, hidden_group: Group, cache_dir: Optional[Union[str, pathlib.Path]] = None,
+                 equivariance_check="lazy"):
         super(EquivariantModel, self).__init__()
         self.rep_in = rep_in
         self.rep_out = rep_out
         self.hidden_group = hidden_group
         self.cache_dir = cache_dir
+        self.equivariance_check = equivariance_check
+        self.equivariance_verified = False
+        self._equivariance_check_hook = None  # Handle of the lazy check hook, removed once the check passed.
+        self.profiler = None
 
         # Cache dir
         self.cache_dir = cache_dir if cache_dir is None else pathlib.Path(cache_dir).resolve(strict=True)
@@ -197,11 +769,179 @@ class EquivariantModel(torch.nn.Module):
         else:
             log.info(f"Equivariant Module - Basis Cache dir {self.cache_dir}")
         self.load_cache_file()
+        self.isotypic_mode = False
 
-    @staticmethod
-    def backward_hook(module: torch.nn.Module, _inputs, _outputs):
-        if hasattr(module, '_new_coeff') and hasattr(module, '_new_bias_coeff'):
-            module._new_coeff, module._new_bias_coeff = True, True
+    def presolve_bases(self, layer_reps):
+        """
+        Solves the (distinct, not cached) equivariant bases of the layers of the model in parallel before the layers
+        are instantiated, see `presolve_equivariant_bases`.
+        :param layer_reps: (rep_in, rep_out, bias) of each basis parametrized layer of the model.
+        """
+        rep_pairs = [(rep_in, rep_out) for rep_in, rep_out, _ in layer_reps]
+        rep_pairs += [(None, rep_out) for _, rep_out, bias in layer_reps if bias]
+        n_solved = presolve_equivariant_bases(rep_pairs, max_workers=self.basis_workers)
+        log.info(f"{self.model_class}: {n_solved} equivariant bases solved for {len(layer_reps)} layers")
+
+    def enable_profiling(self):
+        """ Starts recording per layer timings and memory usage, see `LayerProfiler`. """
+        if self.profiler is None:
+            self.profiler = LayerProfiler(self)
+        self.profiler.attach()  # Re-attaches a profiler detached by `disable_profiling`, keeping its statistics.
+
+    def disable_profiling(self):
+        """ Removes the profiling hooks, `profile_summary` keeps returning the recorded statistics. """
+        if self.profiler is not None:
+            self.profiler.detach()
+
+    def profile_summary(self, reset=False) -> dict:
+        """
+        :param reset: Clear the recorded statistics after summarizing them.
+        :return: Per layer profiling statistics `{layer_name: {metric: value}}`, empty if profiling was never enabled.
+        """
+        if self.profiler is None:
+            return {}
+        summary = self.profiler.summary()
+        if reset:
+            self.profiler.reset()
+        return summary
+
+    def basis_storages(self) -> dict:
+        """ :return: Dictionary `{layer_name: storage}` of the weight basis storage of each layer, see `BASIS_STORAGES`. """
+        return {name: m.basis_storage for name, m in self.named_modules() if hasattr(m, 'basis_storage')}
+
+    def basis_storage_summary(self) -> str:
+        """ :return: Number of layers per basis storage, e.g. "dense:1,orbit:4". """
+        storages = list(self.basis_storages().values())
+        return ",".join(f"{storage}:{storages.count(storage)}" for storage in sorted(set(storages)))
+
+    def set_isotypic_mode(self, enabled: bool = True):
+        """
+        Execute all equivariant layers as block diagonal maps in the isotypic basis of their representations.
+        Only available for groups isomorphic to products of C2 (C2, Klein4). Each layer changes the basis of its input
+        and output (see `BasisLinear.isotypic_forward`), which outweighs the smaller block matmuls: this mode is not a
+        speed-up on CPU, measure it with `benchmarks/isotypic_throughput.py` before enabling it.
+        """
+        for module in self.modules():
+            if module is not self and hasattr(module, 'set_isotypic_mode') and \
+                    not isinstance(module, EquivariantModel):
+                module.set_isotypic_mode(enabled)
+        self.isotypic_mode = enabled
+        log.info(f"{self.model_class} isotypic execution mode: {enabled}")
+
+    def export_frozen(self) -> torch.nn.Module:
+        """
+        Exports the model to plain PyTorch modules (`torch.nn.Linear`/`torch.nn.Conv1d`) holding the materialized
+        weights, without bases, group representations or dependencies on `emlp`/`jax`. The exported model is returned
+        in evaluation mode.
+        """
+        raise NotImplementedError()
+
+    def example_input(self, batch_size: int = 1) -> torch.Tensor:
+        """ Random input batch with the shape, device and dtype expected by the model. """
+        raise NotImplementedError()
+
+    def get_init_kwargs(self) -> dict:
+        """ Constructor arguments of the model, besides representations, hidden group and cache directory. """
+        raise NotImplementedError()
+
+    def compact_spec(self) -> dict:
+        """
+        Serializable specification from which the model can be rebuilt: model class, group specifications of the
+        input/output representations and hidden group, and constructor arguments.
+        """
+        return {'model_class': self.model_class,
+                'rep_in': self.rep_in.G.get_spec(),
+                'rep_out': self.rep_out.G.get_spec(),
+                'hidden_group': self.hidden_group.get_spec(),
+                'kwargs': self.get_init_kwargs(),
+                'isotypic': self.isotypic_mode}
+
+    def save_compact(self, path: Union[str, pathlib.Path]):
+        """
+        Saves a compact checkpoint holding only the model specification and its `state_dict`, which contains the
+        basis coefficients and biases but not the bases, which are rebuilt (or read from the basis cache) on load.
+        """
+        torch.save({'model_spec': self.compact_spec(), 'state_dict': self.state_dict()}, str(path))
+
+    @classmethod
+    def from_spec(cls, spec: dict, cache_dir: Optional[Union[str, pathlib.Path]] = None) -> 'EquivariantModel':
+        """ Instantiates a model (with freshly initialized parameters) from its specification `compact_spec`. """
+        model_cls = cls if cls.__name__ == spec['model_class'] else None
+        subclasses = list(cls.__subclasses__())
+        while model_cls is None and len(subclasses) > 0:
+            subclass = subclasses.pop()
+            model_cls = subclass if subclass.__name__ == spec['model_class'] else None
+            subclasses.extend(subclass.__subclasses__())
+        if model_cls is None:
+            raise NotImplementedError(f"Model class {spec['model_class']} not found, import it before loading")
+
+        G_in, G_out = Sym.from_spec(spec['rep_in']), Sym.from_spec(spec['rep_out'])
+        hidden_group = Sym.from_spec(spec['hidden_group'])
+        model = model_cls(SparseRep(G_in), SparseRep(G_out), hidden_group, cache_dir=cache_dir, **spec['kwargs'])
+        if spec.get('isotypic', False):
+            model.set_isotypic_mode(True)
+        return model
+
+    @classmethod
+    def load_compact(cls, path: Union[str, pathlib.Path], cache_dir: Optional[Union[str, pathlib.Path]] = None,
+                     map_location='cpu') -> 'EquivariantModel':
+        """
+        Loads a model from a compact checkpoint (see `save_compact`), or from a Lightning checkpoint saved by
+        `LightningModel`, which stores the model specification under `model_spec`.
+        """
+        # The model specification pickles its groups and activations, which the `weights_only` default of torch>=2.6
+        # rejects.
+        ckpt = torch.load(str(path), map_location=map_location, weights_only=False)
+        if 'model_spec' not in ckpt:
+            raise KeyError(f"Checkpoint {path} does not contain a model specification")
+        model = cls.from_spec(ckpt['model_spec'], cache_dir=cache_dir)
+        state_dict = ckpt['state_dict']
+        if any(k.startswith('model.') for k in state_dict):  # Lightning checkpoint.
+            state_dict = {k[len('model.'):]: v for k, v in state_dict.items() if k.startswith('model.')}
+        model.load_state_dict(state_dict)
+        return model
+
+    @classmethod
+    def from_template(cls, rep_in: BaseRep, rep_out: BaseRep, hidden_group: Group, **kwargs) -> 'EquivariantModel':
+        """
+        Instantiates a model from a prebuilt template of the same class, representations, hidden group and
+        constructor arguments, building (and caching) the template on the first call. New instances copy the template
+        structure, sharing its (read-only) bases, orbit indices and representations, and only draw fresh parameters
+        (`reset_parameters`), such that building a model for a new seed skips groups, bases and checks construction.
+        """
+        key = (cls.__name__, rep_in.G.fingerprint, rep_out.G.fingerprint, hidden_group.fingerprint) + \
+              tuple((k, repr(v)) for k, v in sorted(kwargs.items()))
+        template = MODEL_TEMPLATES.pop(key, None)
+        if template is None:
+            log.info(f"Building {cls.__name__} template")
+            template = cls(rep_in, rep_out, hidden_group, **kwargs)
+        MODEL_TEMPLATES[key] = template  # Most recently used last.
+        while len(MODEL_TEMPLATES) > MAX_MODEL_TEMPLATES:
+            MODEL_TEMPLATES.popitem(last=False)
+
+        # Share the derived (constant) state of the template: bases, orbit indices and group representations.
+        memo = {id(b): b for b in template.buffers()}
+        for module in template.modules():
+            memo.update({id(v): v for v in vars(module).values() if isinstance(v, (BaseRep, Group))})
+        model = copy.deepcopy(template, memo)
+        with torch.no_grad():
+            for parameter in model.parameters():  # Coefficients not drawn by `reset_parameters` (e.g. biases).
+                parameter.normal_()
+        model.reset_parameters(init_mode=model.init_mode)
+        return model
+
+    def _check_frozen_parity(self, frozen: torch.nn.Module):
+        """ Ensures the frozen model computes the same function as this model. """
+        training = self.training
+        self.eval()
+        frozen.eval()
+        x = self.example_input(batch_size=8)
+        with torch.no_grad():
+            y, y_frozen = self(x), frozen(x)
+        self.train(training)
+        if not torch.allclose(y, y_frozen, atol=1e-5, rtol=1e-4):
+            raise RuntimeError(f"Frozen {self.model_class} differs from original model: "
+                               f"max|y - y_frozen| = {torch.max(torch.abs(y - y_frozen)).item()}")
 
     @property
     def _cache_file_name(self) -> str:
@@ -230,7 +970,7 @@ class EquivariantModel(torch.nn.Module):
 
             # Remove from memory cache all file-saved caches. Taking advantage of lazy loading.
             for k in list(cache.keys()):
-                if str(k) in lazy_cache:
+                if cache_key(k) in lazy_cache:
                     cache.pop(k)
 
             Rep.solcache = EMLPCache(cache, lazy_cache)
@@ -255,7 +995,7 @@ class EquivariantModel(torch.nn.Module):
         if len(run_cache) == 0:
             log.debug(f"Ignoring cache save as there is no new equivariant basis")
         try:
-            combined_cache = {str(k): np.asarray(v) for k, v in itertools.chain(lazy_cache.items(), cache.items())}
+            combined_cache = {cache_key(k): np.asarray(v) for k, v in itertools.chain(lazy_cache.items(), cache.items())}
             np.savez_compressed(model_cache_file, **combined_cache)
 
             # Since we moved all cache to disk with lazy loading. Remove from memory
@@ -268,33 +1008,86 @@ class EquivariantModel(torch.nn.Module):
             log.warning(f"Error while saving cache to {model_cache_file}: \n {e}")
 
     @staticmethod
-    def test_module_equivariance(module: torch.nn.Module, rep_in, rep_out, in_shape=None):
+    @torch.no_grad()
+    def test_module_equivariance(module: torch.nn.Module, rep_in, rep_out, in_shape=None, in_dim=-1, out_dim=-1,
+                                 atol=1e-4, rtol=1e-4):
+        """
+        Checks `f(ρ_in(g) x) = ρ_out(g) f(x)` for every group element `g` in `discrete_actions` (not only the
+        generators), with a single forward pass of the batch `[x, ρ_in(g_0) x, ρ_in(g_1) x, ...]`. Group actions
+        are applied as signed permutations (see `act_signed_permutation`), without densifying the representations.
+        The check runs in the dtype of the parameters, also when called under `torch.autocast` (e.g. the lazy check
+        of the first bf16 training step), as the tolerances are those of float32.
+        :param in_shape: Shape of the input `x` (including the batch dimension), `(1, rep_in.G.d)` by default.
+        :param in_dim, out_dim: Dimensions of the input and output tensors where the group acts.
+        """
+        training = module.training
         module.eval()
-        shape = (rep_in.G.d,) if in_shape is None else in_shape
-        x = torch.randn(shape)
-        for g_in, g_out in zip(rep_in.G.discrete_generators, rep_out.G.discrete_generators):
-            g_in, g_out = (g_in.todense(), g_out.todense()) if issparse(g_in) else (g_in, g_out)
-            g_in = torch.tensor(np.asarray(g_in), dtype=torch.float32).unsqueeze(0)
-            g_out = torch.tensor(np.asarray(g_out), dtype=torch.float32).unsqueeze(0)
-
-            y = module.forward(x)
-
-            if x.ndim == 3:
-                g_x = (g_in @ x.unsqueeze(1)).squeeze(1)
-            else:
-                g_x = g_in @ x
-
-            g_y_pred = module.forward(g_x)
-            g_y_true = g_out @ y
-            if not torch.allclose(g_y_true, g_y_pred, atol=1e-4, rtol=1e-4):
-                max_error = torch.max(g_y_true - g_y_pred).item()
-                error = (g_y_true - g_y_pred).detach().numpy()
-                raise RuntimeError(f"{module}\nis not equivariant to in/out group generators\n"
-                                   f"max(f(g·x) - g·y) = {np.max(error)}")
-
-            if torch.allclose(g_y_pred, y, atol=1e-4, rtol=1e-4):
-                log.warning(f"\nModule {module} is INVARIANT! not EQUIVARIANT\n")
-        module.train()
+        p = next(module.parameters(), None)
+        shape = (1, rep_in.G.d) if in_shape is None else tuple(in_shape)
+        x = torch.randn(shape, device=None if p is None else p.device, dtype=None if p is None else p.dtype)
+        in_perm, in_sign = actions_oneline(rep_in.G)
+        out_perm, out_sign = actions_oneline(rep_out.G)
+        in_perm, in_sign, out_perm, out_sign = (t.to(x.device) for t in (in_perm, in_sign, out_perm, out_sign))
+
+        g_x = [act_signed_permutation(x, perm, sign.to(x.dtype), in_dim) for perm, sign in zip(in_perm, in_sign)]
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            y, *g_y_pred = torch.split(module.forward(torch.cat([x] + g_x, dim=0)), shape[0], dim=0)
+        module.train(training)
+
+        invariant = True
+        for g, (g_y, perm, sign) in enumerate(zip(g_y_pred, out_perm, out_sign)):
+            g_y_true = act_signed_permutation(y, perm, sign.to(y.dtype), out_dim)
+            if not torch.allclose(g_y_true, g_y, atol=atol, rtol=rtol):
+                raise RuntimeError(f"{module}\nis not equivariant to in/out group action {g}\n"
+                                   f"max(f(g·x) - g·y) = {torch.max(torch.abs(g_y_true - g_y)).item()}")
+            is_identity = torch.equal(perm, torch.arange(len(perm), device=perm.device)) and bool(torch.all(sign > 0))
+            invariant = invariant and (is_identity or torch.allclose(g_y, y, atol=atol, rtol=rtol))
+        if invariant:
+            log.warning(f"\nModule {module} is INVARIANT! not EQUIVARIANT\n")
+
+    def verify_equivariance(self, layers=False):
+        """
+        Checks the equivariance of the model to all the elements of its input/output groups.
+        :param layers: Also check every equivariant layer of the model independently, useful to find a faulty layer.
+        The random inputs of the check are drawn from forked random number generators, so the check does not change
+        the random stream (initialization, dropout masks, data order) of a seeded run. The forward passes of the check
+        are not recorded by an attached profiler.
+        """
+        modules = [self]
+        if layers:
+            modules += [m for m in self.modules() if m is not self and hasattr(m, 'rep_dim')]
+        p = next(self.parameters(), None)
+        devices = [p.device] if p is not None and p.device.type == "cuda" else []
+        profiling = self.profiler is not None and self.profiler.attached
+        if profiling:
+            self.profiler.detach()
+        try:
+            with torch.random.fork_rng(devices=devices):
+                for module in modules:
+                    x = module.example_input(batch_size=1)
+                    self.test_module_equivariance(module, module.rep_in, module.rep_out, in_shape=x.shape,
+                                                  in_dim=module.rep_dim, out_dim=module.rep_dim)
+        finally:
+            if profiling:
+                self.profiler.attach()
+        self.equivariance_verified = True
+
+    def schedule_equivariance_check(self):
+        """ Runs or defers the equivariance verification of the model, according to `equivariance_check`. """
+        if self.equivariance_check == "eager":
+            self.verify_equivariance(layers=True)
+        elif self.equivariance_check == "lazy":
+            self._equivariance_check_hook = self.register_forward_pre_hook(self._verify_on_first_forward)
+        elif self.equivariance_check != "off":
+            raise ValueError(f"Unknown equivariance check mode {self.equivariance_check}: {EQUIVARIANCE_CHECKS}")
+
+    def _verify_on_first_forward(self, _module, _inputs):
+        if is_compiling():
+            return
+        if not self.equivariance_verified:
+            self.verify_equivariance()
+        self._equivariance_check_hook.remove()  # Only reached if the check passed.
+        self._equivariance_check_hook = None
 
     @property
     def model_class(self):
@@ -317,34 +1110,50 @@ class EMLP(EquivariantModel):
             hidden_group (Group): symmetry group
             ch (int or list[int] or Rep or list[Rep]): number of channels in the hidden layers
             num_layers (int): number of hidden layers
+            parametrization (str): "basis" or "reynolds", see `EQUIVARIANT_LINEAR`
+            equivariance_check (str): "eager", "lazy" or "off", see `EQUIVARIANCE_CHECKS`
 
         Returns:
             Module: the EMLP objax module."""
 
     def __init__(self, rep_in, rep_out, hidden_group, ch=64, num_layers=3, with_bias=True, activation=torch.nn.ReLU,
-                 cache_dir=None, init_mode="fan_in", inv_dims_scale=1.0):
-        super().__init__(rep_in, rep_out, hidden_group, cache_dir)
+                 cache_dir=None, init_mode="fan_in", inv_dims_scale=1.0, parametrization="basis",
+                 basis_storage="auto", equivariance_check="lazy"):
+        super().__init__(rep_in, rep_out, hidden_group, cache_dir, equivariance_check=equivariance_check)
         logging.info("Initing EMLP (PyTorch)")
         self.activations = activation
         self.hidden_channels = ch
         self.n_layers = num_layers
         self.init_mode = init_mode
         self.inv_dims_scale = inv_dims_scale
+        self.with_bias = with_bias
+        self.parametrization = parametrization
+        self.basis_storage = basis_storage
         # Parse channels as a single int, a sequence of ints, a single Rep, a sequence of Reps
         rep_inter_in = rep_in
         rep_inter_out = rep_out
         inv_in, inv_out = rep_in.G.n_inv_dims/rep_in.G.d, rep_out.G.n_inv_dims/rep_out.G.d
         inv_ratios = np.linspace(inv_in, inv_out, num_layers + 3, endpoint=True) * self.inv_dims_scale
 
-        layers = []
+        layer_reps = []
         for n, inv_ratio in zip(range(num_layers + 1), inv_ratios[1:-1]):
             rep_inter_out = SparseRep(self.hidden_group.canonical_group(ch, inv_dims=math.ceil(ch * inv_ratio)))
-            layer = EquivariantBlock(rep_in=rep_inter_in, rep_out=rep_inter_out, with_bias=with_bias,
-                                     activation=self.activations)
-            layers.append(layer)
+            layer_reps.append((rep_inter_in, rep_inter_out, with_bias))
             rep_inter_in = rep_inter_out
+        layer_reps.append((rep_inter_in, rep_out, False))
+        if parametrization == "basis":
+            self.presolve_bases(layer_reps)
+
+        layers = []
+        for layer_rep_in, layer_rep_out, bias in layer_reps[:-1]:
+            layer = EquivariantBlock(rep_in=layer_rep_in, rep_out=layer_rep_out, with_bias=bias,
+                                     activation=self.activations, parametrization=parametrization,
+                                     basis_storage=basis_storage)
+            layers.append(layer)
         # Add last layer
-        linear_out = BasisLinear(rep_in=rep_inter_in, rep_out=rep_out, bias=False)
+        linear_kwargs = {"basis_storage": basis_storage} if parametrization == "basis" else {}
+        linear_out = EQUIVARIANT_LINEAR[parametrization](rep_in=rep_inter_in, rep_out=rep_out, bias=False,
+                                                         **linear_kwargs)
         layers.append(linear_out)
 
         # input_layer = layers[0].linear
@@ -353,7 +1162,7 @@ class EMLP(EquivariantModel):
 
         self.net = torch.nn.Sequential(*layers)
         self.reset_parameters(init_mode=self.init_mode)
-        EquivariantModel.test_module_equivariance(self, rep_in, rep_out)
+        self.schedule_equivariance_check()
         self.save_cache_file()
 
     def forward(self, x):
@@ -367,6 +1176,10 @@ class EMLP(EquivariantModel):
                 'Repout': str(self.rep_in),
                 'init_mode': str(self.init_mode),
                 'inv_dim_scale': self.inv_dims_scale,
+                'isotypic': self.isotypic_mode,
+                'parametrization': self.parametrization,
+                'basis_storage': self.basis_storage,
+                'basis_storages': self.basis_storage_summary(),
                 }
 
     def reset_parameters(self, init_mode=None):
@@ -375,10 +1188,29 @@ class EMLP(EquivariantModel):
         for module in self.net:
             if isinstance(module, EquivariantBlock):
                 module.linear.reset_parameters(mode=self.init_mode, activation=module.activation.__class__.__name__.lower())
-            elif isinstance(module, BasisLinear):
+            elif isinstance(module, (BasisLinear, ReynoldsLinear)):
                 module.reset_parameters(mode=self.init_mode, activation="Linear")
         log.info(f"EMLP initialized with mode: {self.init_mode}")
 
+    def export_frozen(self) -> FrozenEMLP:
+        frozen = FrozenEMLP(net=frozen_copy(self.net)).eval()
+        self._check_frozen_parity(frozen)
+        return frozen
+
+    def example_input(self, batch_size: int = 1) -> torch.Tensor:
+        p = next(self.net[-1].parameters())
+        return torch.randn((batch_size, self.rep_in.G.d), device=p.device, dtype=p.dtype)
+
+    def get_init_kwargs(self) -> dict:
+        return {'ch': self.hidden_channels,
+                'num_layers': self.n_layers,
+                'with_bias': self.with_bias,
+                'activation': self.activations,
+                'init_mode': self.init_mode,
+                'inv_dims_scale': self.inv_dims_scale,
+                'parametrization': self.parametrization,
+                'basis_storage': self.basis_storage}
+
     def unfreeze_equivariance(self, num_layers=1):
         assert num_layers >= 1, num_layers
         # Freeze most of model parameters.
@@ -402,6 +1234,9 @@ class LinearBlock(torch.nn.Module):
         self._preact = self.linear(x)
         return self.activation(self._preact)
 
+    def __getstate__(self):
+        return drop_transient_state(super().__getstate__())
+
 
 class MLP(torch.nn.Module):
     """ Standard baseline MLP. Representations and group are used for shapes only. """
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Plain PyTorch counterparts of the equivariant models, holding materialized weights only. These modules are produced
+by `EquivariantModel.export_frozen()` and intentionally depend only on `torch`, so they can be loaded on inference
+hosts without `emlp`/`jax` or the symmetry group definitions.
+"""
+import torch
+
+
+class FrozenEMLP(torch.nn.Module):
+    """ Frozen `EMLP`: a sequence of `torch.nn.Linear` layers and activations. """
+
+    def __init__(self, net: torch.nn.Sequential):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x)
+
+
+class FrozenContactECNN(torch.nn.Module):
+    """ Frozen `ContactECNN`: `torch.nn.Conv1d` blocks followed by a `torch.nn.Linear` head. """
+
+    def __init__(self, block1: torch.nn.Sequential, block2: torch.nn.Sequential, fc: torch.nn.Sequential):
+        super().__init__()
+        self.block1 = block1
+        self.block2 = block2
+        self.fc = fc
+
+    def forward(self, x):
+        x = x.permute(0, 2, 1)
+        block1_out = self.block1(x)
+        block2_out = self.block2(block1_out)
+        # Ensure flattening maintains symmetry constraints
+        block2_out = block2_out.permute(0, 2, 1)
+        block2_out_reshape = block2_out.reshape(block2_out.shape[0], -1)
+        fc_out = self.fc(block2_out_reshape)
+        return fc_out
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-layer instrumentation of equivariant models: forward/backward wall time, weight assembly (basis expansion) time
+vs. matmul/conv time, trainable coefficients vs. basis storage, and activation memory. Hooks are only registered while
+profiling is enabled (see `EquivariantModel.enable_profiling`), so disabled profiling has no overhead.
+"""
+import functools
+import time
+import weakref
+from collections import defaultdict
+
+import torch
+
+
+def tensor_bytes(t: torch.Tensor) -> int:
+    """ Memory of a dense, COO or CSR tensor. """
+    if t.layout == torch.sparse_coo:
+        return tensor_bytes(t._indices()) + tensor_bytes(t._values())
+    if t.layout == torch.sparse_csr:
+        return sum(tensor_bytes(x) for x in (t.crow_indices(), t.col_indices(), t.values()))
+    return t.numel() * t.element_size()
+
+
+def _sync(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+# Layers being profiled `{layer: (profiler, layer_name)}`. Held outside the layers, so copies of a profiled model (e.g.
+# `frozen_copy`, `from_template`) are not profiled and do not reference the original layers.
+PROFILED_LAYERS = weakref.WeakKeyDictionary()
+
+
+def profiled_assembly(fn):
+    """ Decorates the weight/bias assembly method of a layer, timing it while the layer is profiled. """
+    @functools.wraps(fn)
+    def assemble(layer, *args, **kwargs):
+        entry = PROFILED_LAYERS.get(layer) if len(PROFILED_LAYERS) > 0 else None
+        if entry is None:
+            return fn(layer, *args, **kwargs)
+        profiler, name = entry
+        return profiler.time_assembly(name, lambda: fn(layer, *args, **kwargs))
+    return assemble
+
+
+class LayerProfiler:
+    """
+    Profiles every equivariant layer (modules defining `rep_dim`, e.g. `BasisLinear`, `BasisConv1d`) of a model. The
+    weight/bias assembly time is recorded by the layer methods decorated with `profiled_assembly`.
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        self.layers = {name: m for name, m in model.named_modules() if m is not model and hasattr(m, 'rep_dim')}
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self._handles, self._start = [], {}
+
+    @property
+    def attached(self) -> bool:
+        return len(self._handles) > 0
+
+    def attach(self):
+        if self.attached:
+            return self
+        for name, layer in self.layers.items():
+            self._handles += [layer.register_forward_pre_hook(self._forward_pre_hook(name)),
+                              layer.register_forward_hook(self._forward_hook(name)),
+                              layer.register_full_backward_pre_hook(self._backward_pre_hook(name)),
+                              layer.register_full_backward_hook(self._backward_hook(name))]
+            PROFILED_LAYERS[layer] = (self, name)
+        return self
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        for layer in self.layers.values():
+            if PROFILED_LAYERS.get(layer, (None,))[0] is self:
+                del PROFILED_LAYERS[layer]
+
+    def reset(self):
+        self.stats.clear()
+
+    def _device(self, name) -> torch.device:
+        p = next(self.layers[name].parameters(), None)
+        return torch.device("cpu") if p is None else p.device
+
+    def time_assembly(self, name, build):
+        device = self._device(name)
+        _sync(device)
+        start = time.perf_counter()
+        out = build()
+        _sync(device)
+        self.stats[name]["assembly_s"] += time.perf_counter() - start
+        return out
+
+    def _forward_pre_hook(self, name):
+        def hook(module, inputs):
+            if self.layers[name] is not module:  # Hook copied along with the layer (e.g. `deepcopy`).
+                return
+            device = self._device(name)
+            if device.type == "cuda":
+                # The device peak is not reset, as it is also reported by the training loop (`peak_memory_mb`).
+                self._start[(name, "memory")] = (torch.cuda.memory_allocated(device),
+                                                 torch.cuda.max_memory_allocated(device))
+            _sync(device)
+            self._start[(name, "forward")] = time.perf_counter()
+        return hook
+
+    def _forward_hook(self, name):
+        def hook(module, inputs, output):
+            if self.layers[name] is not module:
+                return
+            device = self._device(name)
+            _sync(device)
+            stats = self.stats[name]
+            stats["forward_s"] += time.perf_counter() - self._start.pop((name, "forward"))
+            stats["n_forward"] += 1
+            stats["activation_bytes"] = max(stats["activation_bytes"], output.numel() * output.element_size())
+            if device.type == "cuda":
+                allocated, max_allocated = self._start.pop((name, "memory"))
+                # If the layer did not raise the device peak, its own peak is only known to be above the memory in use.
+                peak = torch.cuda.max_memory_allocated(device)
+                if peak <= max_allocated:
+                    peak = torch.cuda.memory_allocated(device)
+                stats["peak_memory_bytes"] = max(stats["peak_memory_bytes"], peak - allocated)
+        return hook
+
+    def _backward_pre_hook(self, name):
+        def hook(module, grad_output):
+            if self.layers[name] is not module:
+                return
+            _sync(self._device(name))
+            self._start[(name, "backward")] = time.perf_counter()
+        return hook
+
+    def _backward_hook(self, name):
+        def hook(module, grad_input, grad_output):
+            if self.layers[name] is not module:
+                return
+            _sync(self._device(name))
+            start = self._start.pop((name, "backward"), None)
+            if start is not None:
+                self.stats[name]["backward_s"] += time.perf_counter() - start
+                self.stats[name]["n_backward"] += 1
+        return hook
+
+    def summary(self) -> dict:
+        """
+        :return: Dictionary `{layer_name: {metric: value}}` with the mean forward/backward/assembly/compute times in
+        milliseconds, the parameter and basis storage counts and the activation/peak memory in bytes.
+        """
+        summary = {}
+        for name, layer in self.layers.items():
+            stats = self.stats[name]
+            n_forward, n_backward = max(stats["n_forward"], 1), max(stats["n_backward"], 1)
+            basis = list(layer.buffers())
+            forward_ms = stats["forward_s"] / n_forward * 1e3
+            assembly_ms = stats["assembly_s"] / n_forward * 1e3
+            summary[name] = {
+                "forward_ms": forward_ms,
+                "backward_ms": stats["backward_s"] / n_backward * 1e3,
+                "assembly_ms": assembly_ms,
+                "compute_ms": forward_ms - assembly_ms,
+                "trainable_params": sum(p.numel() for p in layer.parameters() if p.requires_grad),
+                "basis_numel": sum(b.numel() if b.layout == torch.strided else b._nnz() for b in basis),
+                "basis_bytes": sum(tensor_bytes(b) for b in basis),
+                "activation_bytes": int(stats["activation_bytes"]),
+                "peak_memory_bytes": int(stats["peak_memory_bytes"]),
+            }
+        return summary
+
+
+def measure_training_step(model: torch.nn.Module, x: torch.Tensor, iters=3) -> dict:
+    """
+    Memory kept for the backward pass and wall time of a forward/backward step of `model` on the batch `x`. The memory
+    counts the storages saved by autograd, which excludes the tensors recomputed by gradient checkpointing (and the
+    inputs of the checkpointed segments).
+    :return: Dictionary with `saved_bytes` and `step_ms`.
+    """
+    saved = {}
+
+    def pack(t: torch.Tensor):
+        # Tensors saved more than once (e.g. parameters used by several ops) share their storage.
+        if t.layout == torch.strided:
+            saved[(t.untyped_storage().data_ptr(), t.device)] = t.untyped_storage().nbytes()
+        return t
+
+    model.zero_grad(set_to_none=True)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        y = model(x)
+    y.sum().backward()
+    model.zero_grad(set_to_none=True)
+
+    device = x.device
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        model(x).sum().backward()
+    _sync(device)
+    step_ms = (time.perf_counter() - start) / iters * 1e3
+    model.zero_grad(set_to_none=True)
+    return {"saved_bytes": sum(saved.values()), "step_ms": step_ms}
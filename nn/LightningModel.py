@@ -1,5 +1,6 @@
 import math
 import pathlib
+import resource
 import time
 from typing import Union, Callable
 
@@ -9,7 +10,7 @@ import torch
 import torch.nn.functional as F
 from torch.utils.data.dataloader import default_collate
 
-from nn.EquivariantModules import BasisLinear, EquivariantBlock, LinearBlock, EMLP, MLP
+from nn.EquivariantModules import BasisLinear, ReynoldsLinear, EquivariantBlock, LinearBlock, EMLP, MLP
 
 import logging
 log = logging.getLogger(__name__)
@@ -17,10 +18,15 @@ log = logging.getLogger(__name__)
 LossCallable = Callable[[torch.Tensor, torch.Tensor, ], torch.Tensor]
 MetricCallable = Callable[[torch.Tensor, torch.Tensor, ], dict]
 
+# Precision of the forward passes: "fp32", or "bf16" mixed precision where weight assembly, matmuls and convolutions run
+# in bfloat16 (see `assembly_dtype`) while parameters, optimizer state, losses and metrics stay in float32.
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16}
+
 class LightningModel(pl.LightningModule):
 
     def __init__(self, lr, loss_fn: LossCallable, metrics_fn: MetricCallable, test_epoch_metrics_fn=None,
-                 val_epoch_metrics_fn=None, log_preact=False, log_w=False):
+                 val_epoch_metrics_fn=None, log_preact=False, log_w=False, profile_layers=False, precision="fp32",
+                 reset_cpu_memory_peak=False):
         super().__init__()
         # self.model_type = model.__class__.__name__
         self.lr = lr
@@ -32,6 +38,12 @@ class LightningModel(pl.LightningModule):
         self.val_epoch_metrics_fn = val_epoch_metrics_fn
         self._log_w = log_w
         self._log_preact = log_preact
+        self._profile_layers = profile_layers
+        self._reset_cpu_memory_peak = reset_cpu_memory_peak
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {list(PRECISIONS)}")
+        # Not `self.precision`, which the Lightning `Trainer` overwrites with its own precision setting (e.g. 32).
+        self.forward_precision = precision
         # Save hyperparams in model checkpoint.
         # TODO: Fix this/home/dordonez/Projects/RobotEquivariantNN/launch/sample_eff
         self.save_hyperparameters()
@@ -44,11 +56,20 @@ class LightningModel(pl.LightningModule):
         y = self.model(x)
         return y
 
+    def predict(self, x):
+        """ Model prediction in the training `precision`, returned in float32. """
+        dtype = PRECISIONS[self.forward_precision]
+        if dtype is None:
+            return self.model(x)
+        with torch.autocast(device_type=self.device.type, dtype=dtype):
+            y = self.model(x)
+        return y.float()
+
     def training_step(self, batch, batch_idx):
         # training_step defined the train loop.
         # It is independent of forward
         x, y = batch
-        y_pred = self.model(x)
+        y_pred = self.predict(x)
         loss = self._loss_fn(y_pred, y)
         # Logging to TensorBoard by default
         self.log("train_loss", loss, prog_bar=False, on_step=True, on_epoch=True, batch_size=y.shape[0])
@@ -60,7 +81,7 @@ class LightningModel(pl.LightningModule):
     def validation_step(self, batch, batch_idx):
         x, y = batch
 
-        y_pred = self.model(x)
+        y_pred = self.predict(x)
         loss = self._loss_fn(y_pred, y)
         metrics = self.compute_metrics(y_pred, y)
 
@@ -72,7 +93,7 @@ class LightningModel(pl.LightningModule):
     def test_step(self, batch, batch_idx):
         x, y = batch
 
-        y_pred = self.model(x)
+        y_pred = self.predict(x)
         loss = self._loss_fn(y_pred, y)
         metrics = self.compute_metrics(y_pred, y)
 
@@ -83,7 +104,7 @@ class LightningModel(pl.LightningModule):
 
     def predict_step(self, batch, batch_idx, **kwargs):
         x, y = batch
-        return self.model(x)
+        return self.predict(x)
 
     def log_metrics(self, metrics: dict, prefix='', batch_size=None):
         for k, v in metrics.items():
@@ -96,8 +117,33 @@ class LightningModel(pl.LightningModule):
 
     def training_epoch_end(self, outputs):
         self.log('time_per_epoch', time.time() - self.epoch_start_time, prog_bar=False, on_epoch=True)
+        self.log('peak_memory_mb', self.peak_memory_mb(), prog_bar=False, on_epoch=True)
         if self._log_w: self.log_weights()
         if self._log_preact: self.log_preactivations()
+        if self._profile_layers: self.log_layer_profile()
+
+    def peak_memory_mb(self) -> float:
+        """
+        Peak memory of the training: GPU memory allocated since the previous call (i.e. during the epoch), or resident
+        memory of the process when training on CPU. The CPU value is the peak of the whole process lifetime
+        (`ru_maxrss`), read without modifying the process state. With `reset_cpu_memory_peak=True` it is instead the
+        peak since the previous call, resetting the resident memory peak of the process through `/proc/self/clear_refs`
+        (Linux only), which also clears the referenced/soft-dirty page bits seen by other tools inspecting the process.
+        """
+        if self.device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return peak / 2 ** 20
+        if self._reset_cpu_memory_peak:
+            try:
+                with open("/proc/self/status") as status:
+                    peak_kb = next(int(line.split()[1]) for line in status if line.startswith("VmHWM:"))
+                with open("/proc/self/clear_refs", "w") as clear_refs:
+                    clear_refs.write("5")  # Resets the resident memory peak (VmHWM) to the current resident memory.
+                return peak_kb / 2 ** 10
+            except (OSError, StopIteration):
+                pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # Linux reports kilobytes.
 
     def validation_epoch_end(self, outputs):
         if self.val_epoch_metrics_fn is not None:
@@ -117,11 +163,13 @@ class LightningModel(pl.LightningModule):
 
     def on_train_start(self):
         # TODO: Add number of layers and hidden channels dimensions.
-        hparams = {'lr': self.lr, 'model': self.model_type}
+        hparams = {'lr': self.lr, 'model': self.model_type, 'precision': self.forward_precision}
         if hasattr(self.model, "get_hparams"):
             hparams.update(self.model.get_hparams())
         if self.logger:
             self.logger.log_hyperparams(hparams, {"val_loss": np.NaN, "train_loss_epoch": np.NaN, "test_loss": np.NaN})
+        if self._profile_layers and hasattr(self.model, "enable_profiling"):
+            self.model.enable_profiling()
 
     def on_train_end(self) -> None:
         ckpt_call = self.trainer.checkpoint_callback
@@ -133,6 +181,11 @@ class LightningModel(pl.LightningModule):
                 ckpt_path.unlink()
                 log.info(f"Removing last ckpt {ckpt_path} from successful training run.")
 
+    def on_save_checkpoint(self, checkpoint: dict) -> None:
+        # Equivariant models store their bases as non-persistent buffers, save what is needed to rebuild them.
+        if hasattr(self.model, "compact_spec"):
+            checkpoint["model_spec"] = self.model.compact_spec()
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.lr)
         return optimizer
@@ -143,11 +196,12 @@ class LightningModel(pl.LightningModule):
         layer_index = 0  # Count layers by linear operators not position in network sequence
         for layer in self.model.net:
             layer_name = f"Layer{layer_index:02d}"
-            if isinstance(layer, EquivariantBlock) or isinstance(layer, BasisLinear):
+            if isinstance(layer, EquivariantBlock) or isinstance(layer, (BasisLinear, ReynoldsLinear)):
                 lin = layer.linear if isinstance(layer, EquivariantBlock) else layer
                 W = lin.weight.view(-1).detach()
-                basis_coeff = lin.basis_coeff.view(-1).detach()
-                tb_logger.add_histogram(tag=f"{layer_name}/c", values=basis_coeff, global_step=self.current_epoch)
+                if isinstance(lin, BasisLinear):
+                    basis_coeff = lin.basis_coeff.view(-1).detach()
+                    tb_logger.add_histogram(tag=f"{layer_name}/c", values=basis_coeff, global_step=self.current_epoch)
                 tb_logger.add_histogram(tag=f"{layer_name}/W", values=W, global_step=self.current_epoch)
                 layer_index += 1
             elif isinstance(layer, LinearBlock) or isinstance(layer, torch.nn.Linear):
@@ -167,8 +221,97 @@ class LightningModel(pl.LightningModule):
                                         global_step=self.current_epoch)
                 layer_index += 1
 
+    def log_layer_profile(self):
+        """ Logs the per layer profiling statistics of the last epoch, see `EquivariantModel.profile_summary`. """
+        if not hasattr(self.model, "profile_summary"): return
+        for layer_name, stats in self.model.profile_summary(reset=True).items():
+            for k, v in stats.items():
+                self.log(f"profile/{layer_name}/{k}", float(v), prog_bar=False, on_epoch=True)
+
     def get_metrics(self):
         # don't show the version number on console logs.
         items = super().get_metrics()
         items.pop("v_num", None)
         return items
+
+
+class EnsembleLightningModel(LightningModel):
+    """
+    Trains a `ModelEnsemble` of seeds in a single vectorized model. The loss is the sum of the member losses, so each
+    member receives the gradient of its own loss. Losses of each member are logged as `seed=<s>/<loss>`, and the
+    parameters of each member at its best validation loss are kept in `best_states` (see `ModelEnsemble.member`).
+    Early stopping is applied per member: a member whose validation loss did not improve for `patience` epochs is
+    finished and its `best_states` entry is final, training stops once all the members are finished.
+    """
+
+    def __init__(self, seeds, lr, loss_fn: LossCallable, metrics_fn: MetricCallable, patience=None, **kwargs):
+        super().__init__(lr, loss_fn, metrics_fn, **kwargs)
+        self.seeds = list(seeds)
+        self.patience = patience
+        self.best_val_loss = [math.inf] * len(self.seeds)
+        self.best_states = [None] * len(self.seeds)
+        self.epochs_without_improvement = [0] * len(self.seeds)
+        self._val_losses = []
+
+    @property
+    def finished(self) -> list:
+        """ :return: Per member flag, True if the member ran out of patience. """
+        if self.patience is None:
+            return [False] * len(self.seeds)
+        return [n >= self.patience for n in self.epochs_without_improvement]
+
+    def set_model(self, model):
+        assert model.ensemble_size == len(self.seeds), f"{len(self.seeds)} seeds for {model.ensemble_size} members"
+        self.model = model
+        self.model_type = model.model_class
+
+    def member_losses(self, y_pred: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        return torch.stack([self._loss_fn(y_pred_i, y) for y_pred_i in y_pred])
+
+    def log_member_losses(self, losses: torch.Tensor, name: str, batch_size=None):
+        self.log(name, torch.mean(losses), prog_bar=False, on_epoch=True, batch_size=batch_size)
+        for seed, loss in zip(self.seeds, losses):
+            self.log(f"seed={seed}/{name}", loss, prog_bar=False, on_step=False, on_epoch=True, batch_size=batch_size)
+
+    def training_step(self, batch, batch_idx):
+        x, y = batch
+        losses = self.member_losses(self.predict(x), y)
+        self.log_member_losses(losses, "train_loss", batch_size=y.shape[0])
+        return torch.sum(losses)
+
+    def validation_step(self, batch, batch_idx):
+        x, y = batch
+        losses = self.member_losses(self.predict(x), y)
+        self.log_member_losses(losses, "val_loss", batch_size=y.shape[0])
+        self._val_losses.append((losses.detach() * y.shape[0], y.shape[0]))
+
+    def validation_epoch_end(self, outputs):
+        if len(self._val_losses) == 0: return
+        val_loss = sum(l for l, _ in self._val_losses) / sum(n for _, n in self._val_losses)
+        self._val_losses = []
+        if self.trainer.sanity_checking: return
+        finished = self.finished
+        for i, loss in enumerate(val_loss.tolist()):
+            if finished[i]: continue
+            if loss < self.best_val_loss[i]:
+                self.best_val_loss[i] = loss
+                self.best_states[i] = {k: v.detach().cpu().clone() for k, v in self.model.member(i).state_dict().items()}
+                self.epochs_without_improvement[i] = 0
+            else:
+                self.epochs_without_improvement[i] += 1
+        self.log("finished_members", float(sum(self.finished)), prog_bar=False)
+        if all(self.finished):
+            log.info(f"All ensemble members ran out of patience ({self.patience} epochs), stopping training")
+            self.trainer.should_stop = True
+
+    def test_step(self, batch, batch_idx):
+        x, y = batch
+        losses = self.member_losses(self.predict(x), y)
+        self.log_member_losses(losses, "test_loss", batch_size=y.shape[0])
+
+    def test_epoch_end(self, outputs):
+        pass
+
+    def predict_step(self, batch, batch_idx, **kwargs):
+        x, y = batch
+        return self.predict(x)
@@ -0,0 +1,75 @@
+import unittest
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+
+from datasets.umich_contact_dataset import UmichContactDataset
+from groups.SemiDirectProduct import SparseRep
+from nn.ContactECNN import ContactECNN
+
+
+class TestContactECNNInference(unittest.TestCase):
+    """
+    Used to test that the incremental inference modes of the ContactECNN match the window by window forward pass.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        Gin, Gout = UmichContactDataset.get_in_out_groups()
+        cls.model = ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin).eval()
+        cls.d_in = Gin.d
+
+    def test_streaming_matches_forward(self):
+        W = self.model.window_size
+        seq = torch.randn(2, W + 9, self.d_in)
+        stream = self.model.streaming()
+        with torch.no_grad():
+            y = stream.reset(seq[:, :W])
+            self.assertTrue(torch.allclose(y, self.model(seq[:, :W]), atol=1e-5))
+            for t in range(W, seq.shape[1]):
+                y = stream.step(seq[:, t])
+                self.assertTrue(torch.allclose(y, self.model(seq[:, t - W + 1:t + 1]), atol=1e-5))
+
+
+    def test_trajectory_matches_forward(self):
+        W = self.model.window_size
+        seq = torch.randn(W + 37, self.d_in)
+        with torch.no_grad():
+            y_traj = self.model.forward_trajectory(seq, batch_size=16)
+            windows = seq.unfold(0, W, 1).permute(0, 2, 1)
+            y = self.model(windows)
+        self.assertEqual(y_traj.shape, y.shape)
+        self.assertTrue(torch.allclose(y_traj, y, atol=1e-5))
+
+
+class TestGradientCheckpointing(unittest.TestCase):
+    """
+    Used to test that gradient checkpointing does not change the gradients of the ContactECNN.
+    """
+
+    def test_checkpointed_gradients(self):
+        Gin, Gout = UmichContactDataset.get_in_out_groups()
+        model = ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin, dropout=0.0).train()
+        x = model.example_input(batch_size=4)
+        grads = []
+        for enabled in (False, True):
+            model.set_gradient_checkpointing(enabled)
+            model.zero_grad()
+            model(x).sum().backward()
+            grads.append([p.grad.clone() for p in model.parameters()])
+        for g, g_ckpt in zip(*grads):
+            self.assertTrue(torch.allclose(g, g_ckpt, atol=1e-5))
+        self.assertIsNone(model.fc[0]._preact)
+
+        rng_state = torch.random.get_rng_state()
+        report = model.checkpointing_report(batch_size=4)
+        self.assertTrue(torch.equal(rng_state, torch.random.get_rng_state()))
+        self.assertLess(report["checkpointing=True"]["saved_mb"], report["checkpointing=False"]["saved_mb"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,611 @@
+import copy
+import unittest
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import numpy as np
+import scipy.sparse
+import torch
+from emlp.reps.representation import Rep
+
+from groups.SemiDirectProduct import SemiDirectProduct, SparseRep
+from groups.SymmetricGroups import C2, Klein4
+from nn.EConv1d import BasisConv1d
+from nn.EnsembleModules import ModelEnsemble
+from nn.EquivariantModules import BasisLinear, EMLP, MLP, EquivariantModel, ReynoldsLinear, orbit_basis_expand, \
+    auto_basis_storage
+from nn.FrozenModules import FrozenEMLP
+from utils.utils import coo2orbit_index, coo2torch_coo
+
+
+class TestOrbitBasis(unittest.TestCase):
+    """
+    Used to test that the orbit index/sign representation of the equivariant bases
+    produces the same weights as the dense basis matrix product.
+    """
+
+    def test_orbit_index_matches_basis(self):
+        """
+        Make sure `sign * c[orbit_idx]` equals `Q @ c` for C2 and Klein4 bases.
+        """
+        for G in [C2, Klein4]:
+            Gin, Gout = G.canonical_group(8, inv_dims=2), G.canonical_group(12, inv_dims=4)
+            Q = SparseRep(SemiDirectProduct(Gin=Gin, Gout=Gout)).equivariant_basis()
+            orbit = coo2orbit_index(Q)
+            self.assertIsNotNone(orbit)
+
+            coeff = torch.randn(Q.shape[-1])
+            W_dense = torch.matmul(coo2torch_coo(Q), coeff)
+            W_orbit = orbit_basis_expand(coeff, *orbit)
+            self.assertTrue(torch.allclose(W_dense, W_orbit))
+
+    def test_orbit_expand_gradcheck(self):
+        """
+        The segment reduction backward of the orbit expansion must match numerical gradients.
+        """
+        Q = SparseRep(SemiDirectProduct(Gin=Klein4.canonical_group(8), Gout=Klein4.canonical_group(4))).equivariant_basis()
+        orbit_idx, orbit_sign = coo2orbit_index(Q)
+        for shape in [(Q.shape[-1],), (Q.shape[-1], 3)]:
+            coeff = torch.randn(shape, dtype=torch.float64, requires_grad=True)
+            self.assertTrue(torch.autograd.gradcheck(
+                lambda c: orbit_basis_expand(c, orbit_idx, orbit_sign.to(torch.float64)), (coeff,)))
+
+    def test_orbit_index_rejects_dense_rows(self):
+        """
+        Rows with more than one non-zero cannot be represented by a single orbit index.
+        """
+        import scipy.sparse
+        Q = scipy.sparse.coo_matrix(np.array([[1., 1.], [0., 1.]]))
+        self.assertIsNone(coo2orbit_index(Q))
+
+    def test_basis_linear_gradient(self):
+        """
+        Gradients w.r.t the basis coefficients must match the ones of the dense basis.
+        """
+        rep_in, rep_out = SparseRep(C2.canonical_group(6)), SparseRep(C2.canonical_group(10, inv_dims=2))
+        layer = BasisLinear(rep_in, rep_out, bias=True)
+        self.assertIsNone(layer.basis)
+
+        Q = coo2torch_coo(layer.repW.equivariant_basis())
+        x = torch.randn(16, rep_in.G.d)
+        layer(x).sum().backward()
+        coeff = layer.basis_coeff.detach().clone().requires_grad_(True)
+        W = torch.matmul(Q, coeff).reshape(rep_out.G.d, rep_in.G.d)
+        torch.nn.functional.linear(x, W).sum().backward()
+        self.assertTrue(torch.allclose(layer.basis_coeff.grad, coeff.grad, atol=1e-5))
+
+    def test_basis_conv1d_kernel(self):
+        """
+        The kernel gathered over all taps at once must match the dense basis applied to the coefficients of each tap,
+        with the same output and gradients as the dense basis storage.
+        """
+        for G in [C2, Klein4]:
+            rep_in, rep_out = SparseRep(G.canonical_group(8, inv_dims=2)), SparseRep(G.canonical_group(12, inv_dims=4))
+            layer = BasisConv1d(rep_in, rep_out, kernel_size=3, padding=1)
+            self.assertEqual(layer.basis_storage, "orbit")
+            self.assertIsNone(layer.basis)
+
+            Q = coo2torch_coo(layer.repW.equivariant_basis())
+            coeff = layer.basis_coeff.detach()
+            W = torch.stack([torch.matmul(Q, coeff[:, t]).reshape(rep_out.G.d, rep_in.G.d) for t in range(3)], dim=-1)
+            self.assertTrue(torch.allclose(layer.weight, W))
+
+            dense = BasisConv1d(rep_in, rep_out, kernel_size=3, padding=1, basis_storage="dense")
+            dense.load_state_dict(layer.state_dict())
+            x = torch.randn(4, rep_in.G.d, 10)
+            y, y_dense = layer(x), dense(x)
+            self.assertTrue(torch.allclose(y, y_dense, atol=1e-5))
+            y.sum().backward()
+            y_dense.sum().backward()
+            self.assertTrue(torch.allclose(layer.basis_coeff.grad, dense.basis_coeff.grad, atol=1e-4))
+
+
+class TestBasisStorage(unittest.TestCase):
+    """
+    Used to test that every basis storage yields the same layer weights and gradients.
+    """
+
+    def test_storage_parity(self):
+        rep_in, rep_out = SparseRep(C2.canonical_group(6)), SparseRep(C2.canonical_group(10, inv_dims=2))
+        x = torch.randn(16, rep_in.G.d)
+        reference = BasisLinear(rep_in, rep_out, bias=True)
+        self.assertEqual(reference.basis_storage, "orbit")
+        reference(x).sum().backward()
+        for storage in ("dense", "csr", "coo"):
+            layer = BasisLinear(rep_in, rep_out, bias=True, basis_storage=storage)
+            self.assertEqual((layer.basis_storage, layer.bias_basis_storage), (storage, storage))
+            layer.load_state_dict(reference.state_dict())
+            self.assertTrue(torch.allclose(layer.weight, reference.weight))
+            self.assertTrue(torch.allclose(layer.bias, reference.bias))
+            layer(x).sum().backward()
+            self.assertTrue(torch.allclose(layer.basis_coeff.grad, reference.basis_coeff.grad, atol=1e-5))
+
+    def test_auto_storage(self):
+        dense_Q = np.random.randn(40, 8)
+        self.assertEqual(auto_basis_storage(dense_Q), "dense")
+        Q = scipy.sparse.random(400, 30, density=0.01, format="coo", dtype=np.float32)
+        self.assertIn(auto_basis_storage(Q), ("dense", "csr", "coo"))
+        with self.assertRaises(ValueError):
+            BasisLinear(SparseRep(C2.canonical_group(4)), SparseRep(C2.canonical_group(4)), basis_storage="bsr")
+
+
+class TestWeightCache(unittest.TestCase):
+    """
+    Used to test that materialized weights are reused only while the coefficients are unchanged.
+    """
+
+    def test_cache_invalidated_by_optimizer_step(self):
+        rep_in, rep_out = SparseRep(C2.canonical_group(6)), SparseRep(C2.canonical_group(10, inv_dims=2))
+        layer = BasisLinear(rep_in, rep_out, bias=True)
+        optimizer = torch.optim.SGD(layer.parameters(), lr=0.1)
+        x = torch.randn(16, rep_in.G.d)
+
+        with torch.no_grad():
+            W = layer.weight
+            self.assertIs(W, layer.weight)
+
+        # Training builds the weight with its autograd graph, and can backpropagate several times.
+        for _ in range(2):
+            optimizer.zero_grad()
+            layer(x).sum().backward()
+            self.assertIsNotNone(layer.basis_coeff.grad)
+        optimizer.step()
+
+        with torch.no_grad():
+            W_new = layer.weight
+            self.assertIsNot(W, W_new)
+            self.assertTrue(torch.allclose(W_new, layer._materialize_weight()))
+
+
+class TestIsotypicMode(unittest.TestCase):
+    """
+    Used to test that the isotypic (block diagonal) execution mode computes the same function.
+    """
+
+    def test_isotypic_basis_is_orthogonal(self):
+        for G in [C2.canonical_group(9, inv_dims=3), Klein4.canonical_group(12, inv_dims=4)]:
+            T, dims = G.isotypic_basis()
+            T = np.asarray(T.todense())
+            self.assertEqual(sum(dims), G.d)
+            self.assertTrue(np.allclose(T @ T.T, np.eye(G.d)))
+
+    def test_isotypic_forward(self):
+        for G in [C2, Klein4]:
+            rep_in, rep_out = SparseRep(G.canonical_group(8, inv_dims=2)), SparseRep(G.canonical_group(12, inv_dims=4))
+            layers = [(BasisLinear(rep_in, rep_out, bias=True), torch.randn(16, rep_in.G.d)),
+                      (BasisConv1d(rep_in, rep_out, kernel_size=3, padding=1), torch.randn(16, rep_in.G.d, 10))]
+            for layer, x in layers:
+                y = layer(x)
+                layer.set_isotypic_mode(True)
+                y_iso = layer(x)
+                layer.set_isotypic_mode(False)
+                self.assertTrue(torch.allclose(y, y_iso, atol=1e-5))
+
+
+class TestReynoldsLinear(unittest.TestCase):
+    """
+    Used to test the Reynolds operator (group averaging) parametrization of equivariant linear layers.
+    """
+
+    def test_projection_onto_equivariant_maps(self):
+        """
+        The projected weight must lie in the span of the equivariant basis, and projecting it again must not change it.
+        """
+        for G in [C2, Klein4]:
+            rep_in, rep_out = SparseRep(G.canonical_group(8, inv_dims=2)), SparseRep(G.canonical_group(12, inv_dims=4))
+            layer = ReynoldsLinear(rep_in, rep_out, bias=True)
+            Q = np.asarray(SparseRep(SemiDirectProduct(Gin=rep_in.G, Gout=rep_out.G)).equivariant_basis().todense())
+            self.assertEqual(layer.n_basis, Q.shape[-1])
+
+            W = layer.weight.detach().numpy().reshape(-1)
+            coeff = np.linalg.lstsq(Q, W, rcond=None)[0]
+            self.assertTrue(np.allclose(Q @ coeff, W, atol=1e-5))
+            with torch.no_grad():
+                layer.free_weight.copy_(layer.weight)
+                layer._new_coeff = True
+                self.assertTrue(np.allclose(layer.weight.numpy().reshape(-1), W, atol=1e-6))
+
+
+class TestCompile(unittest.TestCase):
+    """
+    Used to test that equivariant models are traced by `torch.compile` as a single graph.
+    """
+
+    def test_emlp_fullgraph(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        compiled = torch.compile(model, fullgraph=True)
+        x = torch.randn(8, Gin.d)
+        self.assertTrue(torch.allclose(model(x), compiled(x), atol=1e-5))
+        compiled(x).sum().backward()
+        self.assertIsNotNone(model.net[0].linear.basis_coeff.grad)
+
+
+class TestEquivarianceVerification(unittest.TestCase):
+    """
+    Used to test the batched verification of equivariance over all the group elements.
+    """
+
+    def test_detects_broken_equivariance(self):
+        rep_in, rep_out = SparseRep(Klein4.canonical_group(8, inv_dims=2)), SparseRep(Klein4.canonical_group(12))
+        layer = BasisLinear(rep_in, rep_out, bias=True)
+        EquivariantModel.test_module_equivariance(layer, rep_in, rep_out, in_shape=(4, rep_in.G.d))
+        layer.unfreeze_equivariance()
+        with torch.no_grad():
+            layer.unfrozen_w[0, 0] += 1.
+        with self.assertRaises(RuntimeError):
+            EquivariantModel.test_module_equivariance(layer, rep_in, rep_out, in_shape=(4, rep_in.G.d))
+
+    def test_lazy_verification(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        self.assertFalse(model.equivariance_verified)
+        model(torch.randn(8, Gin.d))
+        self.assertTrue(model.equivariance_verified)
+        self.assertEqual(len(model._forward_pre_hooks), 0)
+        model.verify_equivariance(layers=True)
+
+    def test_lazy_verification_keeps_random_stream(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        x = torch.randn(8, Gin.d)
+        samples = {}
+        for check in ("lazy", "off"):
+            model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1,
+                         equivariance_check=check)
+            torch.manual_seed(0)
+            model(x)
+            samples[check] = torch.rand(4)
+        self.assertTrue(model.equivariance_verified or check == "off")
+        self.assertTrue(torch.equal(samples["lazy"], samples["off"]))
+
+    def test_ensemble_members_verified(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        models = [EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1) for _ in range(2)]
+        ensemble = ModelEnsemble(models)
+        ensemble(torch.randn(8, Gin.d))
+        self.assertTrue(all(model.equivariance_verified for model in models))
+        self.assertEqual(len(ensemble._forward_pre_hooks), 0)
+
+
+class TestBasisPlanner(unittest.TestCase):
+    """
+    Used to test that bases solved in parallel before the layer construction are the ones the layers use.
+    """
+
+    def setUp(self):
+        # Start from an empty `SparseRep.solcache` (shared by all `Rep`s), bases solved by other tests would be reused.
+        self.solcache, Rep.solcache = Rep.solcache, {}
+
+    def tearDown(self):
+        Rep.solcache = self.solcache
+
+    def test_presolve_matches_sequential_solve(self):
+        from groups.SemiDirectProduct import presolve_equivariant_bases
+        reps = [SparseRep(C2.canonical_group(d, inv_dims=d // 4)) for d in (24, 36, 40)]
+        pairs = [(reps[0], reps[1]), (reps[1], reps[2]), (reps[0], reps[1]), (None, reps[2])]
+        n_solved = presolve_equivariant_bases(pairs, max_workers=2)
+        # The repeated pair is solved once.
+        self.assertEqual(n_solved, 3)
+        self.assertEqual(presolve_equivariant_bases(pairs, max_workers=2), 0)
+        for rep_in, rep_out in pairs:
+            rep = rep_out if rep_in is None else SparseRep(SemiDirectProduct(Gin=rep_in.G, Gout=rep_out.G))
+            Q = rep.equivariant_basis()
+            Q_ref = rep.sparse_equivariant_basis()
+            self.assertTrue(np.allclose(Q.todense(), Q_ref.todense()))
+
+
+class TestModelTemplates(unittest.TestCase):
+    """
+    Used to test that models instantiated from templates share the bases but not the parameters.
+    """
+
+    def test_from_template(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        kwargs = dict(ch=16, num_layers=1)
+        model_a = EMLP.from_template(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, **kwargs)
+        model_b = EMLP.from_template(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, **kwargs)
+        layer_a, layer_b = model_a.net[0].linear, model_b.net[0].linear
+        self.assertIs(layer_a.basis_orbit_idx, layer_b.basis_orbit_idx)
+        self.assertFalse(torch.allclose(layer_a.basis_coeff, layer_b.basis_coeff))
+        self.assertFalse(torch.allclose(layer_a.bias_basis_coeff, layer_b.bias_basis_coeff))
+
+        optimizer = torch.optim.SGD(model_a.parameters(), lr=0.1)
+        model_a(torch.randn(8, Gin.d)).sum().backward()
+        optimizer.step()
+        self.assertIsNone(layer_b.basis_coeff.grad)
+        model_b.verify_equivariance(layers=True)
+
+    def test_deepcopy(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        for parametrization in ("basis", "reynolds"):
+            model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1,
+                         parametrization=parametrization)
+            x = torch.randn(8, Gin.d)
+            fresh = copy.deepcopy(model)
+            # After a training step the layers reference weights and pre-activations of the autograd graph.
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+            model(x).sum().backward()
+            optimizer.step()
+            self.assertFalse(model.net[0]._preact.is_leaf)
+            trained = copy.deepcopy(model)
+            self.assertIsNone(trained.net[0]._preact)
+            with torch.no_grad():
+                self.assertTrue(torch.allclose(trained(x), model(x)))
+                self.assertFalse(torch.allclose(fresh(x), model(x)))
+
+
+class TestMixedPrecision(unittest.TestCase):
+    """
+    Used to test the bfloat16 CPU autocast execution of equivariant layers with float32 parameters.
+    """
+
+    def test_bf16_autocast(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        x = torch.randn(8, Gin.d)
+        with torch.no_grad():
+            y = model(x)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                y_bf16 = model(x)
+                self.assertEqual(model.net[-1].weight.dtype, torch.bfloat16)
+            # Weights cached under autocast are not reused in float32.
+            self.assertEqual(model.net[-1].weight.dtype, torch.float32)
+        self.assertEqual(y_bf16.dtype, torch.bfloat16)
+        self.assertTrue(torch.allclose(y_bf16.float(), y, atol=5e-2, rtol=5e-2))
+
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            loss = model(x).float().sum()
+        loss.backward()
+        for p in model.parameters():
+            self.assertEqual(p.dtype, torch.float32)
+            self.assertEqual(p.grad.dtype, torch.float32)
+
+    def test_lazy_check_under_autocast(self):
+        # The lazy equivariance check runs on the first forward pass, here a bf16 training step.
+        Gin, Gout = C2.canonical_group(12, inv_dims=2), C2.canonical_group(8, inv_dims=2)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=128, num_layers=3)
+        dtypes = []
+        model.net[0].register_forward_hook(lambda module, inputs, output: dtypes.append(output.dtype))
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            y = model(torch.randn(8, Gin.d))
+        self.assertTrue(model.equivariance_verified)
+        # The check runs in float32, before the bf16 forward pass.
+        self.assertEqual(dtypes, [torch.float32, torch.bfloat16])
+        self.assertEqual(y.dtype, torch.bfloat16)
+
+    def test_lightning_bf16_training(self):
+        from pytorch_lightning import Trainer
+        from torch.utils.data import DataLoader, TensorDataset
+        from nn.LightningModel import LightningModel
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        pl_model = LightningModel(lr=1e-3, loss_fn=torch.nn.functional.mse_loss, metrics_fn=lambda y_pred, y: {},
+                                  precision="bf16")
+        pl_model.set_model(EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1))
+        data = DataLoader(TensorDataset(torch.randn(32, Gin.d), torch.randn(32, Gout.d)), batch_size=16)
+        trainer = Trainer(max_steps=4, logger=False, enable_checkpointing=False, enable_progress_bar=False,
+                          enable_model_summary=False, limit_val_batches=0)
+        trainer.fit(pl_model, train_dataloaders=data)
+        self.assertEqual(pl_model.forward_precision, "bf16")
+        self.assertEqual(pl_model.predict(torch.randn(2, Gin.d)).dtype, torch.float32)
+
+    def test_copy_lightning_model(self):
+        # As `benchmarks/bf16_precision.py`, which times a copy so every precision trains from the same initialization.
+        from nn.LightningModel import LightningModel, PRECISIONS
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        x, y = torch.randn(8, Gin.d), torch.randn(8, Gout.d)
+        for precision in PRECISIONS:
+            pl_model = LightningModel(lr=1e-2, loss_fn=torch.nn.functional.mse_loss, metrics_fn=lambda y_pred, y: {},
+                                      precision=precision)
+            pl_model.set_model(copy.deepcopy(model))
+            pl_model._loss_fn(pl_model.predict(x), y).backward()  # Materialized weights are part of a graph.
+            timed_model = copy.deepcopy(pl_model)
+            optimizer = timed_model.configure_optimizers()
+            optimizer.zero_grad()
+            timed_model._loss_fn(timed_model.predict(x), y).backward()
+            optimizer.step()
+            for p, p_timed in zip(pl_model.parameters(), timed_model.parameters()):
+                self.assertFalse(torch.equal(p, p_timed))
+            for p, p_init in zip(pl_model.model.parameters(), model.parameters()):
+                self.assertTrue(torch.equal(p, p_init))
+
+
+class TestModelEnsemble(unittest.TestCase):
+    """
+    Used to test that a vectorized ensemble trains each member as if it was trained alone.
+    """
+
+    def check_ensemble(self, build_model, d_in, d_out, n_members=3):
+        models = []
+        for seed in range(n_members):
+            torch.manual_seed(seed)
+            models.append(build_model())
+        reference = [copy.deepcopy(m) for m in models]
+        ensemble = ModelEnsemble(models)
+        x, y = torch.randn(16, d_in), torch.randn(16, d_out)
+        y_pred = ensemble(x)
+        self.assertEqual(y_pred.shape, (n_members, 16, d_out))
+        for i, model in enumerate(reference):
+            self.assertTrue(torch.allclose(y_pred[i], model(x), atol=1e-5))
+
+        optimizer = torch.optim.Adam(ensemble.parameters(), lr=1e-2)
+        sum(torch.nn.functional.mse_loss(y_i, y) for y_i in y_pred).backward()
+        optimizer.step()
+        for i, model in enumerate(reference):
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+            torch.nn.functional.mse_loss(model(x), y).backward()
+            optimizer.step()
+            with torch.no_grad():
+                self.assertTrue(torch.allclose(ensemble(x)[i], model(x), atol=1e-5))
+                self.assertTrue(torch.allclose(ensemble.member(i)(x), model(x), atol=1e-5))
+
+    def test_emlp_ensemble(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        self.check_ensemble(lambda: EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1),
+                            d_in=Gin.d, d_out=Gout.d)
+
+    def test_template_ensemble(self):
+        # Members built as in `train_ensemble`, which already ran a forward pass recording autograd graphs.
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+
+        def build_model():
+            model = EMLP.from_template(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+            model(torch.randn(2, Gin.d)).sum().backward()
+            model.zero_grad()
+            return model
+        self.check_ensemble(build_model, d_in=Gin.d, d_out=Gout.d)
+
+    def test_mlp_ensemble(self):
+        self.check_ensemble(lambda: MLP(d_in=6, d_out=4, ch=16, num_layers=1), d_in=6, d_out=4)
+
+    def test_member_early_stopping(self):
+        from pytorch_lightning import Trainer
+        from torch.utils.data import DataLoader, TensorDataset
+        from nn.LightningModel import EnsembleLightningModel
+        seeds = [0, 1]
+        models = []
+        for seed in seeds:
+            torch.manual_seed(seed)
+            models.append(MLP(d_in=6, d_out=4, ch=16, num_layers=1))
+        # Without learning, the validation loss of every member stops improving after the first epoch.
+        pl_model = EnsembleLightningModel(seeds, lr=0.0, loss_fn=torch.nn.functional.mse_loss,
+                                          metrics_fn=lambda y_pred, y: {}, patience=2)
+        pl_model.set_model(ModelEnsemble(models))
+        data = DataLoader(TensorDataset(torch.randn(32, 6), torch.randn(32, 4)), batch_size=16)
+        trainer = Trainer(max_epochs=20, logger=False, enable_checkpointing=False, enable_progress_bar=False,
+                          enable_model_summary=False, num_sanity_val_steps=0)
+        trainer.fit(pl_model, train_dataloaders=data, val_dataloaders=data)
+        self.assertEqual(pl_model.finished, [True, True])
+        self.assertEqual(pl_model.epochs_without_improvement, [2, 2])
+        self.assertLess(trainer.current_epoch, 20)
+        self.assertTrue(all(state is not None for state in pl_model.best_states))
+
+
+class TestLayerProfiler(unittest.TestCase):
+    """
+    Used to test the per layer profiling statistics of equivariant models.
+    """
+
+    def test_profile_summary(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        self.assertEqual(model.profile_summary(), {})
+        model.enable_profiling()
+        for _ in range(3):
+            model(torch.randn(8, Gin.d)).sum().backward()
+        summary = model.profile_summary(reset=True)
+        model.disable_profiling()
+
+        self.assertEqual(set(summary), {'net.0.linear', 'net.1.linear', 'net.2'})
+        for name, stats in summary.items():
+            self.assertGreater(stats['forward_ms'], 0)
+            self.assertGreater(stats['backward_ms'], 0)
+            self.assertGreaterEqual(stats['forward_ms'], stats['assembly_ms'])
+            self.assertEqual(stats['trainable_params'], model.get_submodule(name).basis_coeff.numel() +
+                             (model.get_submodule(name).bias_basis_coeff.numel() if name != 'net.2' else 0))
+        self.assertNotIn('_materialize_weight', vars(model.net[2]))
+
+    def test_reenable_profiling(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        model.enable_profiling()
+        model(torch.randn(8, Gin.d))
+        model.disable_profiling()
+        model(torch.randn(8, Gin.d))
+        # Forward passes while disabled are not recorded, and re-enabling resumes recording.
+        self.assertEqual(model.profiler.stats['net.2']['n_forward'], 1)
+        model.enable_profiling()
+        model(torch.randn(8, Gin.d))
+        self.assertEqual(model.profiler.stats['net.2']['n_forward'], 2)
+        model.disable_profiling()
+
+    def test_copy_of_profiled_model(self):
+        """
+        Copies of a profiled model must assemble weights from their own coefficients, without being profiled.
+        """
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        model.enable_profiling()
+        model_copy = copy.deepcopy(model)
+        with torch.no_grad():
+            model_copy.net[2].basis_coeff.mul_(2.0)
+        model_copy.net[2]._new_coeff = True
+        self.assertTrue(torch.allclose(model_copy.net[2].weight, 2 * model.net[2].weight))
+        model_copy(torch.randn(8, Gin.d))
+        self.assertEqual(model.profiler.stats['net.2']['n_forward'], 0)
+        model.disable_profiling()
+
+
+class TestCompactCheckpoint(unittest.TestCase):
+    """
+    Used to test that compact checkpoints store coefficients only and rebuild the same model.
+    """
+
+    def test_save_load_compact(self):
+        import tempfile
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1)
+        self.assertFalse(any('basis' in k and 'coeff' not in k for k in model.state_dict()))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "model.ckpt")
+            model.save_compact(path)
+            loaded = EquivariantModel.load_compact(path)
+
+        self.assertIsInstance(loaded, EMLP)
+        x = torch.randn(8, Gin.d)
+        model.eval(), loaded.eval()
+        self.assertTrue(torch.allclose(model(x), loaded(x)))
+
+
+class TestFrozenExport(unittest.TestCase):
+    """
+    Used to test that frozen exports are plain PyTorch modules computing the same function as the equivariant model.
+    """
+
+    def test_emlp_export_frozen(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        x = torch.randn(8, Gin.d)
+        for parametrization in ("basis", "reynolds"):
+            model = EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=2,
+                         parametrization=parametrization)
+            # Export after an optimizer step, the frozen weights must not come from stale materialized weights.
+            optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+            model(x).sum().backward()
+            optimizer.step()
+
+            frozen = model.export_frozen()
+            self.assertIsInstance(frozen, FrozenEMLP)
+            self.assertFalse(frozen.training)
+            self.assertTrue(model.training)
+            self.assertEqual(len(list(frozen.buffers())), 0)
+            for module in frozen.modules():
+                if module is not frozen:
+                    self.assertTrue(type(module).__module__.startswith("torch.nn"), type(module))
+            self.assertEqual(sum(isinstance(m, torch.nn.Linear) for m in frozen.modules()), 4)
+
+            model.eval()
+            with torch.no_grad():
+                y = model(x)
+                self.assertTrue(torch.allclose(frozen(x), y, atol=1e-5))
+                # The export holds copies of the weights, later updates of the model do not change it.
+                for p in model.parameters():
+                    p.mul_(2.0)
+                model.net[-1]._new_coeff = True
+                self.assertTrue(torch.allclose(frozen(x), y, atol=1e-5))
+
+    def test_basis_conv1d_to_frozen(self):
+        rep_in, rep_out = SparseRep(Klein4.canonical_group(8, inv_dims=2)), SparseRep(Klein4.canonical_group(12))
+        layer = BasisConv1d(rep_in, rep_out, kernel_size=3, padding=1)
+        conv = layer.to_frozen()
+        self.assertIs(type(conv), torch.nn.Conv1d)
+        x = torch.randn(4, rep_in.G.d, 10)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(conv(x), layer(x), atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
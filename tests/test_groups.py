@@ -0,0 +1,189 @@
+import unittest
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import numpy as np
+import scipy.sparse
+import torch
+
+from groups.GroupCache import GroupCache, canonical_group_cache, group_actions_cache
+from groups.SemiDirectProduct import SemiDirectProduct, SparseRep
+from groups.SignedPermutation import SignedPermutation, fixed_point_basis
+from groups.SymmetricGroups import C2, Klein4, Sym
+
+
+def random_signed_permutation(rng, d):
+    return SignedPermutation(rng.permutation(d), rng.choice([-1, 1], size=d))
+
+
+class TestSignedPermutation(unittest.TestCase):
+    """
+    Used to test that the index/sign arithmetic of `SignedPermutation` matches the one of its matrix.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.a, self.b = random_signed_permutation(self.rng, 7), random_signed_permutation(self.rng, 7)
+
+    def test_matrix_roundtrip(self):
+        self.assertEqual(SignedPermutation.from_matrix(self.a.to_matrix()), self.a)
+        self.assertEqual(SignedPermutation.from_matrix(self.a.todense()), self.a)
+        self.assertTrue(np.array_equal(self.a.to_matrix().todense(), self.a.todense()))
+        with self.assertRaises(ValueError):
+            SignedPermutation.from_matrix(np.ones((3, 3)))
+
+    def test_composition_and_inverse(self):
+        A, B = self.a.todense().astype(int), self.b.todense().astype(int)
+        self.assertTrue(np.array_equal((self.a @ self.b).todense(), A @ B))
+        self.assertTrue(np.array_equal(self.a.inverse().todense(), A.T))
+        self.assertTrue((self.a @ self.a.inverse()).is_identity())
+        self.assertTrue(np.array_equal((self.a ** 3).todense(), np.linalg.matrix_power(A, 3)))
+        self.assertEqual(self.a.trace(), np.trace(A))
+
+    def test_kron_and_direct_sum(self):
+        c = random_signed_permutation(self.rng, 3)
+        A, C = self.a.todense().astype(int), c.todense().astype(int)
+        self.assertTrue(np.array_equal(self.a.kron(c).todense(), np.kron(A, C)))
+        direct_sum = np.zeros((10, 10), dtype=int)
+        direct_sum[:7, :7], direct_sum[7:, 7:] = A, C
+        self.assertTrue(np.array_equal(SignedPermutation.direct_sum([self.a, c]).todense(), direct_sum))
+
+    def test_apply(self):
+        A = self.a.todense().astype(np.float32)
+        x = self.rng.standard_normal((5, 7)).astype(np.float32)
+        self.assertTrue(np.allclose(self.a.apply(x, dim=-1), x @ A.T))
+        self.assertTrue(np.allclose(self.a @ x.T, A @ x.T))
+        x_t = torch.tensor(x)
+        self.assertTrue(torch.allclose(self.a.apply(x_t, dim=-1), x_t @ torch.tensor(A).T))
+
+    def test_fixed_point_basis(self):
+        # Cycle (0 1 2) with an odd number of reflections admits no fixed point, (3 4) and the fixed dimension 5 do.
+        g = SignedPermutation([1, 2, 0, 4, 3, 5], [1, 1, -1, -1, -1, 1])
+        Q = fixed_point_basis([g]).toarray()
+        self.assertTrue(np.array_equal(Q, [[0, 0], [0, 0], [0, 0], [0, 1], [0, -1], [1, 0]]))
+        # The nullspace of several generators matches the nullspace of the stacked constraints `[g - I]`.
+        gens = [random_signed_permutation(self.rng, 7) for _ in range(2)] + [SignedPermutation([1, 0, 2, 3, 4, 5, 6])]
+        Q = fixed_point_basis(gens).toarray()
+        C = np.vstack([g.todense() - np.eye(7) for g in gens])
+        self.assertEqual(Q.shape[-1], 7 - np.linalg.matrix_rank(C))
+        for g in gens:
+            self.assertTrue(np.allclose(g.todense() @ Q, Q))
+
+    def test_c2_equivariant_basis(self):
+        G = C2.canonical_group(9, inv_dims=2)
+        Q = C2.get_equivariant_basis(np.asarray(G.discrete_generators[0].todense()))
+        self.assertEqual(Q.shape[-1], np.mean([g.trace() for g in G.signed_actions]))
+        self.assertTrue(np.allclose(G.signed_generators[0].todense() @ Q.toarray(), Q.toarray()))
+
+
+class TestSignedGroups(unittest.TestCase):
+    """
+    Used to test that groups built from `SignedPermutation`s match their matrix counterparts.
+    """
+
+    def assertActionsMatch(self, G):
+        self.assertEqual(len(G.signed_actions), len(G.discrete_actions))
+        for g, h in zip(G.signed_actions, G.discrete_actions):
+            self.assertTrue(np.array_equal(g.todense(), np.asarray(h.todense())))
+
+    def test_actions(self):
+        G_c2, G_k4 = C2.canonical_group(12, inv_dims=2), Klein4.canonical_group(16, inv_dims=4)
+        for G in (G_c2, G_k4, SemiDirectProduct(Gin=G_c2, Gout=C2.canonical_group(4))):
+            self.assertActionsMatch(G)
+
+    def test_matrix_generators(self):
+        G = C2.canonical_group(10, inv_dims=2)
+        G_matrix = C2(generator=G.signed_generators[0].to_matrix())
+        self.assertEqual(G_matrix.signed_generators, G.signed_generators)
+        self.assertEqual(G_matrix.n_inv_dims, G.n_inv_dims)
+
+    def test_fingerprint(self):
+        G = C2.canonical_group(10, inv_dims=2)
+        G_matrix = C2(generator=G.signed_generators[0].to_matrix())
+        self.assertEqual(G_matrix, G)
+        self.assertEqual(hash(G_matrix), hash(G))
+        # Same dimension and invariant dimensions (hence the same repr) but a different generator.
+        p, r = G.signed_generators[0].perm.copy(), G.signed_generators[0].sign.copy()
+        p[[1, 2, 7, 8]] = [7, 8, 1, 2]  # Pairs (1 8)(2 7) -> (1 7)(2 8)
+        G_other = C2(generator=SignedPermutation(p, r))
+        self.assertEqual(repr(G_other), repr(G))
+        self.assertNotEqual(G_other, G)
+        self.assertNotEqual(G_other.fingerprint, G.fingerprint)
+        self.assertNotEqual(Klein4.canonical_group(8), C2.canonical_group(8))
+        G_in, G_out = Klein4.canonical_group(8), Klein4.canonical_group(12, inv_dims=4)
+        self.assertEqual(SemiDirectProduct(Gin=G_in, Gout=G_out), SemiDirectProduct(Gin=G_in, Gout=G_out))
+        self.assertNotEqual(SemiDirectProduct(Gin=G_in, Gout=G_out), SemiDirectProduct(Gin=G_out, Gout=G_in))
+
+    def test_csr_chunks(self):
+        # Matrix generators are hashed in canonical CSR form: equal for dense, duplicated or unsorted COO entries.
+        h = np.asarray(C2.canonical_group(6, inv_dims=2).signed_generators[0].todense())
+        coo = scipy.sparse.coo_matrix(h)
+        rows, cols = np.r_[coo.row, 0][::-1], np.r_[coo.col, 1][::-1]
+        h_coo = scipy.sparse.coo_matrix((np.r_[coo.data, 0.0][::-1], (rows, cols)), shape=h.shape)
+        self.assertEqual(Sym.csr_chunks(h_coo), Sym.csr_chunks(h))
+        self.assertEqual(Sym.csr_chunks(scipy.sparse.csc_matrix(h)), Sym.csr_chunks(h))
+        self.assertNotEqual(Sym.csr_chunks(np.eye(6)), Sym.csr_chunks(h))
+
+    def test_spec_roundtrip(self):
+        for G in (C2.canonical_group(12, inv_dims=2), Klein4.canonical_group(16, inv_dims=4)):
+            G_spec = Sym.from_spec(G.get_spec())
+            self.assertEqual(G_spec.__class__, G.__class__)
+            self.assertEqual(G_spec.signed_generators, G.signed_generators)
+
+
+class TestSparseEquivariantBasis(unittest.TestCase):
+    """
+    Used to test that the orbit basis of `SparseRep` spans the fixed points of all the group actions.
+    """
+
+    def test_fixed_points(self):
+        for G in [C2, Klein4]:
+            for G_in, G_out in [(G.canonical_group(8, inv_dims=2), G.canonical_group(12, inv_dims=4)),
+                                (G.canonical_group(8), G.canonical_group(4))]:
+                G_w = SemiDirectProduct(Gin=G_in, Gout=G_out)
+                Q = np.asarray(SparseRep(G_w).sparse_equivariant_basis().todense())
+                for g in G_w.signed_actions:
+                    self.assertTrue(np.allclose(g.todense() @ Q, Q))
+                # The dimension of the fixed point space is the mean of the characters (traces) of the actions.
+                n_fixed = np.mean([g.trace() for g in G_w.signed_actions])
+                self.assertEqual(Q.shape[-1], n_fixed)
+                self.assertEqual(np.linalg.matrix_rank(Q), Q.shape[-1])
+                self.assertTrue(np.all(np.count_nonzero(Q, axis=1) <= 1))
+
+
+class TestGroupCache(unittest.TestCase):
+    """
+    Used to test the memoization of canonical groups and group elements.
+    """
+
+    def test_lru_eviction(self):
+        cache = GroupCache("test", maxsize=2)
+        for key in [1, 2, 1, 3, 2]:
+            cache(key, lambda: key)
+        self.assertEqual(cache.info(), {"hits": 1, "misses": 4, "size": 2, "maxsize": 2})
+        self.assertEqual(list(cache.entries), [3, 2])
+
+    def test_canonical_group_memoized(self):
+        canonical_group_cache.clear()
+        G = Klein4.canonical_group(16, inv_dims=4)
+        self.assertIs(Klein4.canonical_group(16, inv_dims=4), G)
+        self.assertIsNot(C2.canonical_group(16, inv_dims=4), G)
+        self.assertEqual(canonical_group_cache.hits, 1)
+        self.assertEqual(canonical_group_cache.misses, 2)
+
+    def test_actions_memoized(self):
+        group_actions_cache.clear()
+        G_in, G_out = Klein4.canonical_group(8), Klein4.canonical_group(12, inv_dims=4)
+        actions = SemiDirectProduct(Gin=G_in, Gout=G_out).signed_actions
+        misses = group_actions_cache.misses
+        # A new instance of the same group reuses the enumerated elements.
+        self.assertEqual(SemiDirectProduct(Gin=G_in, Gout=G_out).signed_actions, actions)
+        self.assertEqual(group_actions_cache.misses, misses)
+        self.assertGreater(group_actions_cache.hits, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
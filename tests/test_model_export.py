@@ -0,0 +1,60 @@
+import unittest
+import importlib.util
+import os
+import sys
+import tempfile
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+import torch
+
+from groups.SemiDirectProduct import SparseRep
+from groups.SymmetricGroups import C2
+from nn.ContactECNN import ContactECNN
+from nn.EquivariantModules import EMLP
+from utils.model_export import export_model
+
+HAS_ONNX = all(importlib.util.find_spec(m) is not None for m in ("onnx", "onnxruntime"))
+# The groups of the contact dataset require the `deep_contact_estimator` submodule.
+HAS_CONTACT_DATASET = importlib.util.find_spec("deep_contact_estimator") is not None
+
+
+class TestModelExport(unittest.TestCase):
+    """
+    Used to test that the exported graphs match the eager models, without modifying the exported model.
+    """
+
+    def assertExported(self, model, formats):
+        model.train()
+        with tempfile.TemporaryDirectory() as out_dir:
+            report = export_model(model, out_dir, formats=formats, batch_size=2, latency_iters=5)
+            for fmt in formats:
+                extension = "pt" if fmt == "torchscript" else fmt
+                self.assertTrue(os.path.exists(os.path.join(out_dir, f"{model.model_class}.{extension}")))
+        self.assertEqual(set(report), {"eager", "frozen", *formats})
+        for name, stats in report.items():
+            self.assertLessEqual(stats["max_abs_error"], 1e-4, name)
+            self.assertGreater(stats["mean_ms"], 0)
+        self.assertTrue(model.training)
+
+    def test_emlp_torchscript(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        self.assertExported(EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1),
+                            formats=("torchscript",))
+
+    @unittest.skipUnless(HAS_CONTACT_DATASET, "deep_contact_estimator submodule is required for the contact groups")
+    def test_contact_ecnn_torchscript(self):
+        from datasets.umich_contact_dataset import UmichContactDataset
+        Gin, Gout = UmichContactDataset.get_in_out_groups()
+        self.assertExported(ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin), formats=("torchscript",))
+
+    @unittest.skipUnless(HAS_ONNX, "onnx and onnxruntime are required for the ONNX export")
+    def test_emlp_onnx(self):
+        Gin, Gout = C2.canonical_group(6), C2.canonical_group(4)
+        self.assertExported(EMLP(SparseRep(Gin), SparseRep(Gout), hidden_group=Gout, ch=16, num_layers=1),
+                            formats=("onnx",))
+
+
+if __name__ == '__main__':
+    unittest.main()
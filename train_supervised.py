@@ -21,8 +21,10 @@ from pytorch_lightning import Trainer, seed_everything
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping
 from pytorch_lightning import loggers as pl_loggers
 
+from groups.GroupCache import group_cache_info
 from groups.SemiDirectProduct import SparseRep
-from nn.LightningModel import LightningModel
+from nn.EnsembleModules import ModelEnsemble
+from nn.LightningModel import LightningModel, EnsembleLightningModel
 
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -41,19 +43,29 @@ log = logging.getLogger(__name__)
 
 def get_model(cfg, Gin=None, Gout=None, cache_dir=None):
     if "ecnn" in cfg.model_type.lower():
-        model = ContactECNN(SparseRep(Gin), SparseRep(Gout), Gin, cache_dir=cache_dir, dropout=cfg.dropout,
-                            init_mode=cfg.init_mode, inv_dim_scale=cfg.inv_dims_scale)
+        model = ContactECNN.from_template(SparseRep(Gin), SparseRep(Gout), Gin, cache_dir=cache_dir,
+                                          dropout=cfg.dropout, init_mode=cfg.init_mode,
+                                          inv_dim_scale=cfg.inv_dims_scale,
+                                          basis_storage=cfg.get('basis_storage', 'auto'),
+                                          gradient_checkpointing=cfg.get('gradient_checkpointing', False),
+                                          equivariance_check=cfg.get('equivariance_check', 'lazy'))
     elif "cnn" == cfg.model_type.lower():
         model = contact_cnn()
     elif "emlp" == cfg.model_type.lower():
-        model = EMLP(rep_in=SparseRep(Gin), rep_out=SparseRep(Gout), hidden_group=Gout, num_layers=cfg.num_layers,
-                     ch=cfg.num_channels, init_mode=cfg.init_mode, activation=torch.nn.ReLU,
-                     with_bias=cfg.bias, cache_dir=cache_dir, inv_dims_scale=cfg.inv_dims_scale).to(dtype=torch.float32)
+        model = EMLP.from_template(rep_in=SparseRep(Gin), rep_out=SparseRep(Gout), hidden_group=Gout,
+                                   num_layers=cfg.num_layers, ch=cfg.num_channels, init_mode=cfg.init_mode,
+                                   activation=torch.nn.ReLU, with_bias=cfg.bias, cache_dir=cache_dir,
+                                   inv_dims_scale=cfg.inv_dims_scale,
+                                   parametrization=cfg.get('parametrization', 'basis'),
+                                   basis_storage=cfg.get('basis_storage', 'auto'),
+                                   equivariance_check=cfg.get('equivariance_check', 'lazy')).to(dtype=torch.float32)
     elif 'mlp' == cfg.model_type.lower():
         model = MLP(d_in=Gin.d, d_out=Gout.d, num_layers=cfg.num_layers, init_mode=cfg.init_mode,
                     ch=cfg.num_channels, with_bias=cfg.bias, activation=torch.nn.ReLU).to(dtype=torch.float32)
     else:
         raise NotImplementedError(cfg.model_type)
+    if cfg.get('isotypic', False):
+        model.set_isotypic_mode(True)
     return model
 
 def create_train_val_datasets(cfg, device):
@@ -244,6 +256,97 @@ def get_ckpt_storage_path(log_path, use_volatile=True):
         return log_path
 
 
+def train_ensemble(cfg, device, root_path, cache_dir):
+    """
+    Trains the seeds `cfg.seed, ..., cfg.seed + cfg.ensemble_size - 1` of an `EMLP`/`MLP` as a single vectorized
+    `ModelEnsemble`, sharing the data pipeline and the layer bases. Seeds only differ in the model initialization. The
+    best checkpoint and test metrics of each seed are written to the same `seed=<s>` directories as single seed runs,
+    and seeds whose run already finished are skipped. Each member is early stopped with its own patience.
+    """
+    assert cfg.model.model_type.lower() in ['emlp', 'mlp'], f"Ensembles of {cfg.model.model_type} not supported"
+    seeds = []
+    for seed in [cfg.seed + i for i in range(cfg.ensemble_size)]:
+        seed_logger = pl_loggers.TensorBoardLogger(".", name=f'seed={seed}', version=seed, default_hp_metric=False)
+        ckpt_call = ModelCheckpoint(dirpath=get_ckpt_storage_path(seed_logger.log_dir, use_volatile=cfg.use_volatile),
+                                    filename='best', monitor="val_loss", save_last=True)
+        training_done, _, _ = check_if_resume_experiment(ckpt_call)
+        if training_done or (pathlib.Path(seed_logger.log_dir) / 'test_metrics.csv').exists():
+            log.info(f"Run of seed={seed} already finished, skipping it")
+            continue
+        seeds.append(seed)
+    if len(seeds) == 0:
+        log.info("All the seeds of the ensemble already finished")
+        return
+
+    datasets, dataloaders = get_datasets(cfg, device, root_path)
+    train_dataset, val_dataset, test_dataset = datasets
+    train_dataloader, val_dataloader, test_dataloader = dataloaders
+    first_dataset = train_dataset.datasets[0].dataset if hasattr(train_dataset, 'datasets') else train_dataset
+
+    models = []
+    for seed in seeds:
+        seed_everything(seed=seed)
+        models.append(get_model(cfg.model, Gin=first_dataset.Gin, Gout=first_dataset.Gout, cache_dir=cache_dir))
+    ensemble = ModelEnsemble(models)
+    log.info(ensemble)
+
+    original_dataset_samples = int(0.7 * len(train_dataset) / cfg.dataset.train_ratio)
+    batches_per_original_epoch = original_dataset_samples // cfg.dataset.batch_size
+    epochs = cfg.dataset.max_epochs * batches_per_original_epoch // (len(train_dataset) // cfg.dataset.batch_size)
+
+    # Same patience as the `EarlyStopping` of single seed runs, tracked per member by `pl_model`.
+    pl_model = EnsembleLightningModel(seeds, lr=cfg.model.lr, loss_fn=first_dataset.loss_fn,
+                                      metrics_fn=lambda x, y: first_dataset.compute_metrics(x, y),
+                                      patience=max(10, int(epochs * 0.2)),
+                                      precision=cfg.get('precision', 'fp32'))
+    pl_model.set_model(ensemble)
+
+    tb_logger = pl_loggers.TensorBoardLogger(".", name=f'ensemble seeds={seeds[0]}-{seeds[-1]}', version=cfg.seed,
+                                             default_hp_metric=False)
+    log.info(f"\n\nInitiating Ensemble Training of seeds {seeds}\n\n")
+    trainer = Trainer(gpus=1 if torch.cuda.is_available() and device != 'cpu' else 0,
+                      logger=tb_logger,
+                      accelerator="auto",
+                      log_every_n_steps=max(int(batches_per_original_epoch * cfg.dataset.log_every_n_epochs), 50),
+                      max_epochs=epochs if not cfg.debug_loops else 3,
+                      check_val_every_n_epoch=1,
+                      enable_checkpointing=False,  # Best parameters of each member are kept by `pl_model`.
+                      fast_dev_run=cfg.debug,
+                      enable_progress_bar=True,
+                      limit_train_batches=1.0 if not cfg.debug_loops else 0.005,
+                      limit_val_batches=1.0 if not cfg.debug_loops else 0.005,
+                      )
+    trainer.fit(model=pl_model, train_dataloaders=train_dataloader, val_dataloaders=val_dataloader)
+
+    log.info("\n\nInitiating Testing\n\n")
+    test_metrics_fn = (lambda x: first_dataset.test_metrics(*x)) if hasattr(first_dataset, 'test_metrics') else None
+    for i, seed in enumerate(seeds):
+        model = ensemble.member(i)
+        if pl_model.best_states[i] is not None:
+            model.load_state_dict(pl_model.best_states[i])
+        seed_pl_model = LightningModel(lr=cfg.model.lr, loss_fn=first_dataset.loss_fn,
+                                       metrics_fn=lambda x, y: first_dataset.compute_metrics(x, y),
+                                       test_epoch_metrics_fn=test_metrics_fn, val_epoch_metrics_fn=test_metrics_fn,
+                                       precision=cfg.get('precision', 'fp32'))
+        seed_pl_model.set_model(model)
+
+        seed_logger = pl_loggers.TensorBoardLogger(".", name=f'seed={seed}', version=seed, default_hp_metric=False)
+        # Same checkpoint layout as `ModelCheckpoint`, i.e. the model parameters under the `model.` prefix.
+        ckpt_path = pathlib.Path(get_ckpt_storage_path(seed_logger.log_dir, use_volatile=cfg.use_volatile))
+        ckpt_path.mkdir(exist_ok=True, parents=True)
+        checkpoint = {"state_dict": seed_pl_model.state_dict(),
+                      "hyper_parameters": {'lr': cfg.model.lr, 'seed': seed, 'ensemble_size': len(seeds)}}
+        seed_pl_model.on_save_checkpoint(checkpoint)
+        torch.save(checkpoint, ckpt_path / "best.ckpt")
+
+        test_trainer = Trainer(gpus=1 if torch.cuda.is_available() and device != 'cpu' else 0, logger=seed_logger,
+                               accelerator="auto", enable_checkpointing=False, fast_dev_run=cfg.debug,
+                               limit_test_batches=1.0 if not cfg.debug_loops else 0.005)
+        get_test_set_metrics(path=pathlib.Path(seed_logger.log_dir), trainer=test_trainer, model=seed_pl_model,
+                             train_dataloader=train_dataloader, test_dataloader=test_dataloader,
+                             val_dataloader=val_dataloader)
+
+
 @hydra.main(config_path='cfg/supervised', config_name='config')
 def main(cfg: DictConfig):
     log.info("\n\n NEW RUN \n\n")
@@ -258,6 +361,10 @@ def main(cfg: DictConfig):
     cache_dir.mkdir(exist_ok=True)
     cache_dir = None  # if cfg.dataset.name == "com_momentum" else cache_dir
 
+    if cfg.get('ensemble_size', 1) > 1:
+        train_ensemble(cfg, device, root_path, cache_dir)
+        return
+
     # Check if experiment already run
     tb_logger = pl_loggers.TensorBoardLogger(".", name=f'seed={cfg.seed}', version=cfg.seed, default_hp_metric=False)
     ckpt_folder_path = get_ckpt_storage_path(tb_logger.log_dir, use_volatile=cfg.use_volatile)
@@ -291,6 +398,10 @@ def main(cfg: DictConfig):
         first_dataset = train_dataset.datasets[0].dataset
         model = get_model(cfg.model, Gin=first_dataset.Gin, Gout=first_dataset.Gout, cache_dir=cache_dir)
         log.info(model)
+        log.info(f"Group caches: {group_cache_info()}")
+        if cfg.model.get('gradient_checkpointing', False):
+            log.info(f"Gradient checkpointing memory/time tradeoff: "
+                     f"{model.checkpointing_report(batch_size=cfg.dataset.batch_size)}")
 
         # Prepare Lightning
         test_set_metrics_fn = (lambda x: first_dataset.test_metrics(*x)) if hasattr(first_dataset,
@@ -305,6 +416,9 @@ def main(cfg: DictConfig):
                                   metrics_fn=lambda x, y: first_dataset.compute_metrics(x, y),
                                   test_epoch_metrics_fn=test_set_metrics_fn,
                                   val_epoch_metrics_fn=val_set_metrics_fn,
+                                  profile_layers=cfg.get('profile_layers', False),
+                                  precision=cfg.get('precision', 'fp32'),
+                                  reset_cpu_memory_peak=cfg.get('reset_cpu_memory_peak', False),
                                   )
         pl_model.set_model(model)
 
@@ -6,6 +6,12 @@ import itertools
 from scipy.sparse import issparse
 
 
+def cache_key(rep) -> str:
+    """ String key of a representation in the (file saved) basis cache: `str(rep)` and the fingerprint of its group. """
+    fingerprint = getattr(getattr(rep, 'G', None), 'fingerprint', None)
+    return str(rep) if fingerprint is None else f"{rep}#{fingerprint}"
+
+
 class EMLPCache(dict):
 
     def __init__(self, cache=None, lazy_cache=None):
@@ -23,19 +29,23 @@ class EMLPCache(dict):
         return itertools.chain(self.cache.values(), self.lazy_cache.values())
 
     def __contains__(self, item):
-        return str(item) in self.lazy_cache or item in self.cache
+        key = cache_key(item)
+        return key in self.lazy_cache or key in self.cache or item in self.cache
 
     def __getitem__(self, y):
         # Search first in lazy cache then in running cache
-        if str(y) in self.lazy_cache:
-            M = self.lazy_cache[str(y)]
+        key = cache_key(y)
+        if key in self.lazy_cache:
+            M = self.lazy_cache[key]
             if M.dtype == np.object:
                 M = M.item()
                 assert issparse(M), "Object Array loaded and its not a sparse matrix, dunno whats this."
-                self.cache[str(y)] = M
-                self.lazy_cache.files.remove(str(y))  # Move to memory, remove from file.
-                return self.cache[str(y)]
-            return self.lazy_cache[str(y)]
+                self.cache[key] = M
+                self.lazy_cache.files.remove(key)  # Move to memory, remove from file.
+                return self.cache[key]
+            return self.lazy_cache[key]
+        elif key in self.cache:
+            return self.cache[key]
         elif isinstance(y, Base):
             return self.cache[y]
         else:
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+TorchScript and ONNX export of the equivariant models (`EMLP`, `ContactECNN`). Models are first frozen into plain
+PyTorch modules (see `EquivariantModel.export_frozen`), which removes the property-based weight construction,
+backward hooks and equivariance checks that prevent scripting/tracing.
+"""
+import copy
+import logging
+import pathlib
+import time
+from typing import Sequence, Union
+
+import numpy as np
+import torch
+
+log = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("torchscript", "onnx")
+
+
+def export_torchscript(frozen: torch.nn.Module, path: Union[str, pathlib.Path]) -> torch.jit.ScriptModule:
+    scripted = torch.jit.script(frozen.eval())
+    scripted = torch.jit.freeze(scripted)
+    torch.jit.save(scripted, str(path))
+    log.info(f"TorchScript model saved to {path}")
+    return scripted
+
+
+def export_onnx(frozen: torch.nn.Module, example_input: torch.Tensor, path: Union[str, pathlib.Path],
+                opset_version=13):
+    torch.onnx.export(frozen.eval(), example_input, str(path), input_names=["x"], output_names=["y"],
+                      dynamic_axes={"x": {0: "batch"}, "y": {0: "batch"}}, opset_version=opset_version)
+    log.info(f"ONNX model saved to {path}")
+
+
+def onnx_session(path: Union[str, pathlib.Path]):
+    """ ONNX runtime inference callable, or None if `onnxruntime` is not installed. """
+    try:
+        import onnxruntime
+    except ImportError:
+        log.warning("onnxruntime not installed, ONNX parity check and latency report are skipped")
+        return None
+    session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    return lambda x: torch.from_numpy(session.run(None, {"x": x.cpu().numpy()})[0])
+
+
+def cpu_latency(fn, x: torch.Tensor, iters=200, warmup=20) -> dict:
+    """ Latency statistics of `fn(x)` in milliseconds. """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(x)
+        times = []
+        for _ in range(iters):
+            start = time.perf_counter()
+            fn(x)
+            times.append((time.perf_counter() - start) * 1e3)
+    return {"mean_ms": float(np.mean(times)), "p50_ms": float(np.percentile(times, 50)),
+            "p90_ms": float(np.percentile(times, 90))}
+
+
+def export_model(model, out_dir: Union[str, pathlib.Path], formats: Sequence[str] = EXPORT_FORMATS,
+                 batch_size=1, atol=1e-4, latency_iters=200) -> dict:
+    """
+    Exports an `EquivariantModel` to TorchScript and/or ONNX graphs, checking their parity with the eager model and
+    reporting their CPU latency.
+    :param model: `EMLP` or `ContactECNN` model, not modified.
+    :param out_dir: Directory where `<model_class>.pt` and `<model_class>.onnx` are saved.
+    :param formats: Subset of `EXPORT_FORMATS`.
+    :param batch_size: Batch size of the example input used for parity check and latency measurements.
+    :return: Dictionary with the parity error and latency statistics of the eager and exported models.
+    """
+    assert all(f in EXPORT_FORMATS for f in formats), f"Unknown export format in {formats}"
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    # Export a CPU copy in eval mode, the device and training mode of the caller's model are left untouched.
+    model = copy.deepcopy(model).cpu().eval()
+    frozen = model.export_frozen()
+    x = model.example_input(batch_size=batch_size)
+    with torch.no_grad():
+        y = model(x)
+
+    runtimes = {"eager": model, "frozen": frozen}
+    if "torchscript" in formats:
+        runtimes["torchscript"] = export_torchscript(frozen, out_dir / f"{model.model_class}.pt")
+    if "onnx" in formats:
+        onnx_path = out_dir / f"{model.model_class}.onnx"
+        export_onnx(frozen, x, onnx_path)
+        session = onnx_session(onnx_path)
+        if session is not None:
+            runtimes["onnx"] = session
+
+    report = {}
+    for name, fn in runtimes.items():
+        with torch.no_grad():
+            error = torch.max(torch.abs(fn(x) - y)).item()
+        if error > atol:
+            raise RuntimeError(f"{name} export of {model.model_class} differs from eager model: max error {error}")
+        report[name] = {"max_abs_error": error, **cpu_latency(fn, x, iters=latency_iters)}
+        log.info(f"{model.model_class} [{name}] max|y - y_eager|={error:.2e} "
+                 f"latency mean={report[name]['mean_ms']:.3f}ms p90={report[name]['p90_ms']:.3f}ms")
+    return report
@@ -30,13 +30,72 @@ def dense(x):
 
 
 def coo2torch_coo(M: scipy.sparse.coo_matrix):
-    density = M.getnnz() / np.prod(M.shape)
     memory = np.prod(M.shape) * 32
-    if memory > 1e9:
-        idx = np.vstack((M.row, M.col))
-        return torch.sparse_coo_tensor(idx, M.data, size=M.shape, dtype=torch.float32).coalesce()
-    else:
-        return torch.tensor(np.asarray(M.todense(), dtype=np.float32))
+    return sparse2torch(M, layout="coo" if memory > 1e9 else "dense")
+
+
+def sparse2torch(M, layout: str = "dense", dtype=torch.float32) -> torch.Tensor:
+    """
+    Converts a (scipy sparse or dense) matrix to a torch tensor with the given layout.
+    :param M: (n, m) matrix.
+    :param layout: "dense", "csr" or "coo".
+    """
+    if layout == "dense":
+        return torch.tensor(np.asarray(dense(M)), dtype=dtype)
+    M = scipy.sparse.coo_matrix(M)
+    M.sum_duplicates()
+    if layout == "coo":
+        idx = torch.from_numpy(np.vstack((M.row, M.col)).astype(np.int64))
+        return torch.sparse_coo_tensor(idx, M.data, size=M.shape, dtype=dtype).coalesce()
+    elif layout == "csr":
+        M = M.tocsr()
+        return torch.sparse_csr_tensor(torch.from_numpy(M.indptr.astype(np.int64)),
+                                       torch.from_numpy(M.indices.astype(np.int64)),
+                                       torch.tensor(M.data, dtype=dtype), size=M.shape)
+    raise ValueError(f"Unknown tensor layout {layout}, expected one of dense, csr, coo")
+
+
+def coo2orbit_index(M: scipy.sparse.spmatrix):
+    """
+    Compact representation of a basis matrix in which every row has at most a single non-zero entry, as is the case
+    for the bases of signed-permutation groups (e.g. C2, Klein4) returned by `SparseRep.sparse_equivariant_basis`.
+    Then `M @ c == sign * c[orbit_idx]` and the basis can be applied with a single gather.
+    :param M: (n, b) sparse basis matrix. Repeated COO entries are summed.
+    :return: (orbit_idx, orbit_sign) `(n,)` int64 and float32 tensors, or None if any row has more than one non-zero.
+    Rows with no non-zero entry get index 0 and sign 0.
+    """
+    M = scipy.sparse.csr_matrix(M)
+    M.sum_duplicates()
+    M.eliminate_zeros()
+    nnz_per_row = np.diff(M.indptr)
+    if np.any(nnz_per_row > 1):
+        return None
+    rows = np.repeat(np.arange(M.shape[0]), nnz_per_row)
+    orbit_idx = np.zeros((M.shape[0],), dtype=np.int64)
+    orbit_sign = np.zeros((M.shape[0],), dtype=np.float32)
+    orbit_idx[rows] = M.indices
+    orbit_sign[rows] = M.data
+    return torch.from_numpy(orbit_idx), torch.from_numpy(orbit_sign)
+
+
+def sparse2gather(M: scipy.sparse.spmatrix):
+    """
+    Padded gather representation of a sparse matrix with few non-zeros per row:
+    `(M @ x)[i] = sum_k coef[i, k] * x[idx[i, k]]`.
+    :param M: (n, m) sparse matrix.
+    :return: (idx, coef) `(n, w)` int64 and float32 tensors, where `w` is the maximum number of non-zeros per row.
+    """
+    M = scipy.sparse.csr_matrix(M)
+    M.sum_duplicates()
+    nnz_per_row = np.diff(M.indptr)
+    width = max(int(np.max(nnz_per_row, initial=0)), 1)
+    rows = np.repeat(np.arange(M.shape[0]), nnz_per_row)
+    pos = np.arange(M.nnz) - np.repeat(M.indptr[:-1], nnz_per_row)
+    idx = np.zeros((M.shape[0], width), dtype=np.int64)
+    coef = np.zeros((M.shape[0], width), dtype=np.float32)
+    idx[rows, pos] = M.indices
+    coef[rows, pos] = M.data
+    return torch.from_numpy(idx), torch.from_numpy(coef)
 
 
 def pprint_dict(d: dict):